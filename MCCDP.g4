@@ -86,13 +86,13 @@ defineStatement
     ;
 
 scalingFactor: '<' expr '>';
-functionStatement: decorator? 'async'? 'function' namespacedId '(' params? ')' typeDecl? block;
-classStatement: decorator? 'class' namespacedId ('extends' namespacedId)? ('implements' namespacedId (',' namespacedId)*)? ('{' (defineStatement | classStatement | functionStatement)* '}')?;
-interfaceStatement: 'interface' namespacedId ('extends' namespacedId (',' namespacedId)*) '{' (defineStatement | functionStatement)* '}';
+functionStatement: decorator* 'async'? 'function' namespacedId '(' params? ')' typeDecl? block;
+classStatement: decorator? 'class' namespacedId ('extends' namespacedId)? ('implements' namespacedId (',' namespacedId)*)? ('{' (defineStatement ';' | classStatement | functionStatement)* '}')?;
+interfaceStatement: 'interface' namespacedId ('extends' namespacedId (',' namespacedId)*)? '{' (defineStatement ';' | functionStatement)* '}';
 
 params: param (',' param)*;
 param: ID (':' type) ('=' expr)?;
-type: ID;
+type: ID | 'score' | 'data';
 
 decorator: '@' namespacedIdSingleColon ('(' exprList? ')')?;
 selector: ('@a' | '@e' | '@s' | '@r' | '@p') ('[' argList? ']')?;
@@ -5,4 +5,10 @@ from mcc_types import *
 BUILT_IN_FUNCTIONS = {
     "say": BuiltInFunction("say", [FunctionArgument("message", Any)]),
     "at": BuiltInFunction("at", [FunctionArgument("selector", Selector)])
-}
\ No newline at end of file
+}
+
+# 以记分板槽位传递的参数类型，其余类型的参数通过 storage 复合标签和函数宏传递
+SCORE_PARAM_TYPES = {"score", "int", "bool"}
+
+# 内置装饰器，作为函数的编译选项而不是函数标签
+BUILT_IN_DECORATORS = {"cache_selectors", "optimize_selectors", "force_promote", "no_promote"}
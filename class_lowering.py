@@ -0,0 +1,126 @@
+from command_gen import *
+from fixed_point import raw_value
+from ir import FunctionIR
+from value_numbering import rename
+
+TYPE_OBJECTIVE = "__type"
+
+# 类的降级：在全部代码编译完成、类层次确定之后执行。
+# - 每个类生成 __init 函数，由构造调用以 execute as 在实体上执行：添加类型标签、设置类型编号和字段初值；
+# - 类型编号按类层次的先序分配，同一子树的编号连续；
+# - 方法调用点先调用 <静态类型>.__dispatch.<方法>，这里按静态类型的全部可能的实际类型解析实现：
+#   只有一个实现时调用点直接改为调用该实现，否则生成按 __type 二分查找的分派树
+
+
+def type_slot(namespace: str) -> Scoreboard:
+    return Scoreboard(namespace, TYPE_OBJECTIVE, [], "@s")
+
+
+def init_function(class_type: ClassType) -> Function:
+    return Function(class_type.namespace, "__init", [], [class_type.name])
+
+
+def dispatch_function(class_type: ClassType, method: Function, name: str, executor: Selector = None) -> Function:
+    function = Function(class_type.namespace, name, method.params, [class_type.name, "__dispatch"], executor, method.return_type)
+    function.slots = method.slots
+    return function
+
+
+def assign_type_ids(classes: dict[str, ClassType]) -> dict[str, int]:
+    children = {key: [] for key in classes}
+    roots = []
+    for key, class_type in classes.items():
+        if class_type.is_interface:
+            continue
+        if class_type.parent is None or str(class_type.parent) not in children:
+            roots.append(key)
+        else:
+            children[str(class_type.parent)].append(key)
+    type_ids = {}
+    stack = roots[::-1]
+    while stack:
+        key = stack.pop()
+        type_ids[key] = len(type_ids) + 1
+        stack.extend(children[key][::-1])
+    return type_ids
+
+
+def class_objectives(namespace: str, classes: dict[str, ClassType]) -> list[CommandGenerator]:
+    if not classes:
+        return []
+    objectives = [TYPE_OBJECTIVE] + [f"__field{i}" for i in range(max(class_type.score_fields() for class_type in classes.values()))]
+    return [ScoreboardObjectivesAddCommandGenerator(namespace, objective, "dummy") for objective in objectives]
+
+
+def init_commands(class_type: ClassType, type_id: int) -> list:
+    commands = [TagAddCommandGenerator(Selector("s"), ancestor.tag()) for ancestor in class_type.ancestors()]
+    commands.append(ScoreboardPlayersSetCommandGenerator(type_slot(class_type.namespace), type_id))
+    data = {}
+    for name, field in class_type.fields.items():
+        default = class_type.defaults.get(name)
+        if isinstance(field, Scoreboard):
+            commands.append(ScoreboardPlayersSetCommandGenerator(field, raw_value(default.value if default is not None else 0, field.scale)))
+        elif default is not None:
+            data[name] = default
+    if data:
+        commands.append(DataMergeEntityCommandGenerator(Selector("s"), CompoundConstant({"data": CompoundConstant(data)})))
+    return commands
+
+
+def implementations(class_type: ClassType, name: str, classes: dict[str, ClassType], type_ids: dict[str, int]) -> list[tuple[int, int, Function]]:
+    # 静态类型的每个可能的实际类型对应的实现，相邻编号上相同的实现合并为一个区间；其他类型的实体不会出现在调用点，区间可以跨过它们
+    ranges = []
+    for key, type_id in sorted(type_ids.items(), key=lambda item: item[1]):
+        candidate = classes[key]
+        if not candidate.is_subtype(class_type):
+            continue
+        method = candidate.find_method(name)
+        if ranges and str(ranges[-1][2]) == str(method):
+            ranges[-1] = (ranges[-1][0], type_id, method)
+        else:
+            ranges.append((type_id, type_id, method))
+    return ranges
+
+
+def dispatch_commands(function: Function, ranges: list[tuple[int, int, Function]], functions: dict[str, list]) -> list:
+    type_score = type_slot(function.namespace)
+    if len(ranges) <= 2:
+        return [ExecuteRunCommandGenerator([ExecuteIfScoreMatchCommandGenerator(type_score, Range(start, end))], FunctionCommandGenerator(method))
+                for start, end, method in ranges]
+    middle = len(ranges) // 2
+    commands = []
+    for i, (part, bounds) in enumerate(((ranges[:middle], Range(None, ranges[middle][0] - 1)), (ranges[middle:], Range(ranges[middle][0], None)))):
+        if len(part) == 1:
+            target = part[0][2]
+        else:
+            target = Function(function.namespace, str(i), [], function.scope + [function.name])
+            functions[str(target)] = dispatch_commands(target, part, functions)
+        commands.append(ExecuteRunCommandGenerator([ExecuteIfScoreMatchCommandGenerator(type_score, bounds)], FunctionCommandGenerator(target)))
+    return commands
+
+
+def lower_classes(functions: dict[str, FunctionIR], classes: dict[str, ClassType], dispatches: dict[str, tuple[str, str]]) -> dict[str, FunctionIR]:
+    if not classes:
+        return functions
+    functions = dict(functions)
+    type_ids = assign_type_ids(classes)
+    for key, type_id in type_ids.items():
+        init_key = str(init_function(classes[key]))
+        functions[init_key] = FunctionIR.from_commands(init_key, init_commands(classes[key], type_id))
+    names = {}
+    for key, (class_key, name) in dispatches.items():
+        class_type = classes[class_key]
+        ranges = implementations(class_type, name, classes, type_ids)
+        if len({str(method) for _, _, method in ranges}) <= 1:
+            # 单一实现（没有可实例化的子类型时使用静态类型自身的实现）：去虚化为直接调用
+            names[key] = str(ranges[0][2] if ranges else class_type.find_method(name))
+        else:
+            function = dispatch_function(class_type, class_type.find_method(name), name)
+            parts = {}
+            commands = dispatch_commands(function, ranges, parts)
+            functions.update((part_key, FunctionIR.from_commands(part_key, part)) for part_key, part in parts.items())
+            functions[key] = FunctionIR.from_commands(key, commands)
+    if names:
+        # 分派函数只出现在调用点，即基本块末尾
+        functions = {key: function.replace_calls(lambda command: rename(command, names)) for key, function in functions.items()}
+    return functions
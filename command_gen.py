@@ -1,229 +1,273 @@
 from mcc_types import *
 
 
+# 扁平命令 IR：opcode 为命令开头的固定关键字，operands 为已渲染的参数或嵌套节点；文本只渲染一次并缓存
 class CommandGenerator:
-    def __init__(self):
-        pass
+    __slots__ = ("opcode", "operands", "_text", "_hash")
 
-    def get_params(self) -> list[str]:
-        return []
+    def __init__(self, opcode: str, operands: tuple = ()):
+        self.opcode = opcode
+        self.operands = operands
+        self._text = None
+        self._hash = None
 
     def __str__(self):
-        return " ".join(self.get_params())
+        if self._text is None:
+            if self.operands:
+                self._text = self.opcode + " " + " ".join(str(operand) for operand in self.operands)
+            else:
+                self._text = self.opcode
+        return self._text
 
+    def __repr__(self):
+        return f"{type(self).__name__}(opcode='{self.opcode}', operands={self.operands})"
 
-class ScoreboardCommandGenerator(CommandGenerator):
-    def __init__(self):
-        super().__init__()
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, CommandGenerator):
+            return NotImplemented
+        return self.opcode == other.opcode and self.operands == other.operands
 
-    def get_params(self) -> list[str]:
-        return super().get_params() + ["scoreboard"]
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash((self.opcode, self.operands))
+        return self._hash
 
 
-class ScoreboardObjectivesCommandGenerator(ScoreboardCommandGenerator):
-    def __init__(self):
-        super().__init__()
+class ScoreboardObjectivesAddCommandGenerator(CommandGenerator):
+    __slots__ = ("namespace", "objective", "criteria", "display_name")
 
-    def get_params(self) -> list[str]:
-        return super().get_params() + ["objectives"]
-
-
-class ScoreboardObjectivesAddCommandGenerator(ScoreboardObjectivesCommandGenerator):
     def __init__(self, namespace: str, objective: str, criteria: str, display_name=None):
-        super().__init__()
+        operands = (f"{namespace}.{objective}", criteria)
+        if display_name is not None:
+            operands += (str(display_name),)
+        super().__init__("scoreboard objectives add", operands)
         self.namespace = namespace
         self.objective = objective
         self.criteria = criteria
         self.display_name = display_name
 
-    def get_params(self) -> list[str]:
-        params = super().get_params() + ["add", f"{self.namespace}.{self.objective}", self.criteria]
-        if self.display_name is not None:
-            params.append(str(self.display_name))
-        return params
-
-
-class ScoreboardPlayersCommandGenerator(ScoreboardCommandGenerator):
-    def __init__(self):
-        super().__init__()
 
-    def get_params(self) -> list[str]:
-        return super().get_params() + ["players"]
+class ScoreboardPlayersSetCommandGenerator(CommandGenerator):
+    __slots__ = ("scoreboard", "value")
 
-
-class ScoreboardPlayersSetCommandGenerator(ScoreboardPlayersCommandGenerator):
     def __init__(self, scoreboard: Scoreboard, value: int):
-        super().__init__()
+        super().__init__("scoreboard players set", (scoreboard.final_name(), scoreboard.final_objective(), str(value)))
         self.scoreboard = scoreboard
         self.value = value
 
-    def get_params(self) -> list[str]:
-        return super().get_params() + ["set", self.scoreboard.final_name(), self.scoreboard.final_objective(), str(self.value)]
 
+class ScoreboardPlayersAddCommandGenerator(CommandGenerator):
+    __slots__ = ("scoreboard", "value")
 
-class ScoreboardPlayersAddCommandGenerator(ScoreboardPlayersCommandGenerator):
     def __init__(self, scoreboard: Scoreboard, value: int):
-        super().__init__()
+        super().__init__("scoreboard players add", (scoreboard.final_name(), scoreboard.final_objective(), str(value)))
         self.scoreboard = scoreboard
         self.value = value
 
-    def get_params(self) -> list[str]:
-        return super().get_params() + ["add", self.scoreboard.final_name(), self.scoreboard.final_objective(), str(self.value)]
 
+class ScoreboardPlayersRemoveCommandGenerator(CommandGenerator):
+    __slots__ = ("scoreboard", "value")
 
-class ScoreboardPlayersRemoveCommandGenerator(ScoreboardPlayersCommandGenerator):
     def __init__(self, scoreboard: Scoreboard, value: int):
-        super().__init__()
+        super().__init__("scoreboard players remove", (scoreboard.final_name(), scoreboard.final_objective(), str(value)))
         self.scoreboard = scoreboard
         self.value = value
 
-    def get_params(self) -> list[str]:
-        return super().get_params() + ["remove", self.scoreboard.final_name(), self.scoreboard.final_objective(), str(self.value)]
 
+class ScoreboardPlayersOperationCommandGenerator(CommandGenerator):
+    __slots__ = ("scoreboard", "scoreboard2", "operation")
 
-class ScoreboardPlayersOperationCommandGenerator(ScoreboardPlayersCommandGenerator):
     def __init__(self, scoreboard: Scoreboard, scoreboard2: Scoreboard, operation: str):
-        super().__init__()
+        super().__init__("scoreboard players operation", (scoreboard.final_name(), scoreboard.final_objective(), operation, scoreboard2.final_name(), scoreboard2.final_objective()))
         self.scoreboard = scoreboard
         self.scoreboard2 = scoreboard2
         self.operation = operation
 
-    def get_params(self) -> list[str]:
-        return super().get_params() + ["operation", self.scoreboard.final_name(), self.scoreboard.final_objective(), self.operation, self.scoreboard2.final_name(), self.scoreboard2.final_objective()]
 
+class DataModifyStorageSetValueCommandGenerator(CommandGenerator):
+    __slots__ = ("storage", "value")
 
-class DataCommandGenerator(CommandGenerator):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, storage: StorageDataPath, value: NBTTag):
+        super().__init__(f"data modify {storage.kind}", (storage.final_name(), storage.final_path(), "set", "value", str(value)))
+        self.storage = storage
+        self.value = value
 
-    def get_params(self):
-        return super().get_params() + ["data"]
 
+class ScoreboardPlayersGetCommandGenerator(CommandGenerator):
+    __slots__ = ("scoreboard",)
 
-class DataModifyCommandGenerator(DataCommandGenerator):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, scoreboard: Scoreboard):
+        super().__init__("scoreboard players get", (scoreboard.final_name(), scoreboard.final_objective()))
+        self.scoreboard = scoreboard
 
-    def get_params(self):
-        return super().get_params() + ["modify"]
 
+class DataModifyStorageSetFromStorageCommandGenerator(CommandGenerator):
+    __slots__ = ("storage", "source")
 
-class DataModifyStorageCommandGenerator(DataModifyCommandGenerator):
-    def __init__(self, storage: StorageDataPath):
-        super().__init__()
+    def __init__(self, storage: StorageDataPath, source: StorageDataPath):
+        super().__init__(f"data modify {storage.kind}", (storage.final_name(), storage.final_path(), "set", "from", source.kind, source.final_name(), source.final_path()))
         self.storage = storage
+        self.source = source
 
-    def get_params(self):
-        return super().get_params() + ["storage", self.storage.final_name(), self.storage.final_path()]
 
+class DataGetStorageCommandGenerator(CommandGenerator):
+    __slots__ = ("storage",)
 
-class DataModifyStorageSetCommandGenerator(DataModifyStorageCommandGenerator):
     def __init__(self, storage: StorageDataPath):
-        super().__init__(storage)
+        super().__init__(f"data get {storage.kind}", (storage.final_name(), storage.final_path()))
+        self.storage = storage
 
-    def get_params(self):
-        return super().get_params() + ["set"]
 
+class DataMergeStorageCommandGenerator(CommandGenerator):
+    __slots__ = ("target", "value")
 
-class DataModifyStorageSetValueCommandGenerator(DataModifyStorageSetCommandGenerator):
-    def __init__(self, storage: StorageDataPath, value: NBTTag):
-        super().__init__(storage)
+    def __init__(self, target: str, value: CompoundConstant | str):
+        super().__init__("data merge storage", (target, str(value)))
+        self.target = target
         self.value = value
 
-    def get_params(self) -> list[str]:
-        return super().get_params() + [str(self.value)]
+
+class DataModifyStorageMergeValueCommandGenerator(CommandGenerator):
+    __slots__ = ("target", "path", "value")
+
+    def __init__(self, target: str, path: str, value: CompoundConstant | str):
+        super().__init__("data modify storage", (target, path, "merge", "value", str(value)))
+        self.target = target
+        self.path = path
+        self.value = value
+
+
+class DataMergeEntityCommandGenerator(CommandGenerator):
+    __slots__ = ("target", "value")
+
+    def __init__(self, target: Selector, value: CompoundConstant):
+        super().__init__("data merge entity", (str(target), str(value)))
+        self.target = target
+        self.value = value
+
+
+class TagAddCommandGenerator(CommandGenerator):
+    __slots__ = ("target", "tag")
+
+    def __init__(self, target: Selector, tag: str):
+        super().__init__("tag", (str(target), "add", tag))
+        self.target = target
+        self.tag = tag
 
 
 class FunctionCommandGenerator(CommandGenerator):
+    __slots__ = ("function",)
+
     def __init__(self, function: Function):
-        super().__init__()
+        super().__init__("function", (str(function),))
         self.function = function
 
-    def get_params(self) -> list[str]:
-        return super().get_params() + ["function", str(self.function)]
 
+class FunctionWithStorageCommandGenerator(CommandGenerator):
+    __slots__ = ("function", "storage")
 
-class SayCommandGenerator(CommandGenerator):
-    def __init__(self, message: str):
-        super().__init__()
-        self.message = message
-
-    def get_params(self) -> list[str]:
-        return super().get_params() + ["say", self.message]
+    def __init__(self, function: Function, storage: StorageDataPath):
+        super().__init__("function", (str(function), "with", "storage", storage.final_name(), storage.final_path()))
+        self.function = function
+        self.storage = storage
 
 
-class ExecuteCommandGenerator(CommandGenerator):
-    def __init__(self, sub_commands: list["ExecuteSubCommandGenerator"]):
-        super().__init__()
-        self.sub_commands = sub_commands
+class SayCommandGenerator(CommandGenerator):
+    __slots__ = ("message",)
 
-    def get_params(self) -> list[str]:
-        return super().get_params() + ["execute"] + [param for sub_command in self.sub_commands for param in sub_command.get_params()]
+    def __init__(self, message: str):
+        super().__init__("say", (message,))
+        self.message = message
 
 
 class ExecuteSubCommandGenerator(CommandGenerator):
-    def __init__(self):
-        super().__init__()
+    __slots__ = ()
 
 
 class ExecuteAsCommandGenerator(ExecuteSubCommandGenerator):
+    __slots__ = ("target",)
+
     def __init__(self, target: Selector):
-        super().__init__()
+        super().__init__("as", (str(target),))
         self.target = target
 
-    def get_params(self) -> list[str]:
-        return super().get_params() + ["as", str(self.target)]
-
 
 class ExecuteAtCommandGenerator(ExecuteSubCommandGenerator):
+    __slots__ = ("target",)
+
     def __init__(self, target: Selector):
-        super().__init__()
+        super().__init__("at", (str(target),))
         self.target = target
 
-    def get_params(self) -> list[str]:
-        return super().get_params() + ["at", str(self.target)]
 
+class ExecuteStoreResultStorageCommandGenerator(ExecuteSubCommandGenerator):
+    __slots__ = ("storage", "data_type", "scale")
 
-class ExecuteIfCommandGenerator(ExecuteSubCommandGenerator):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, storage: StorageDataPath, data_type: str, scale: int | float):
+        super().__init__(f"store result {storage.kind}", (storage.final_name(), storage.final_path(), data_type, str(scale)))
+        self.storage = storage
+        self.data_type = data_type
+        self.scale = scale
 
-    def get_params(self) -> list[str]:
-        return super().get_params() + ["if"]
 
+class ExecuteStoreResultScoreCommandGenerator(ExecuteSubCommandGenerator):
+    __slots__ = ("scoreboard",)
 
-class ExecuteIfScoreCommandGenerator(ExecuteIfCommandGenerator):
     def __init__(self, scoreboard: Scoreboard):
-        super().__init__()
+        super().__init__("store result score", (scoreboard.final_name(), scoreboard.final_objective()))
         self.scoreboard = scoreboard
 
-    def get_params(self) -> list[str]:
-        return super().get_params() + ["score", self.scoreboard.final_name(), self.scoreboard.final_objective()]
 
+class ExecuteIfScoreCompareCommandGenerator(ExecuteSubCommandGenerator):
+    __slots__ = ("scoreboard", "scoreboard2", "operation")
 
-class ExecuteIfScoreCompareCommandGenerator(ExecuteIfScoreCommandGenerator):
     def __init__(self, scoreboard1: Scoreboard, scoreboard2: Scoreboard, operation: str):
-        super().__init__(scoreboard1)
+        super().__init__("if score", (scoreboard1.final_name(), scoreboard1.final_objective(), operation, scoreboard2.final_name(), scoreboard2.final_objective()))
+        self.scoreboard = scoreboard1
         self.scoreboard2 = scoreboard2
         self.operation = operation
 
-    def get_params(self) -> list[str]:
-        return super().get_params() + [self.operation, self.scoreboard2.final_name(), self.scoreboard2.final_objective()]
 
+class ExecuteIfScoreMatchCommandGenerator(ExecuteSubCommandGenerator):
+    __slots__ = ("scoreboard", "range")
 
-class ExecuteIfScoreMatchCommandGenerator(ExecuteIfScoreCommandGenerator):
     def __init__(self, scoreboard1: Scoreboard, range1: Range):
-        super().__init__(scoreboard1)
+        super().__init__("if score", (scoreboard1.final_name(), scoreboard1.final_objective(), "matches", str(range1)))
+        self.scoreboard = scoreboard1
         self.range = range1
 
-    def get_params(self) -> list[str]:
-        return super().get_params() + ["matches", str(self.range)]
+
+class ExecuteIfEntityCommandGenerator(ExecuteSubCommandGenerator):
+    __slots__ = ("target",)
+
+    def __init__(self, target: Selector):
+        super().__init__("if entity", (str(target),))
+        self.target = target
+
+
+class ExecuteCommandGenerator(CommandGenerator):
+    __slots__ = ("sub_commands",)
+
+    def __init__(self, sub_commands: list[ExecuteSubCommandGenerator], operands: tuple = ()):
+        super().__init__("execute", (*sub_commands, *operands))
+        self.sub_commands = sub_commands
 
 
 class ExecuteRunCommandGenerator(ExecuteCommandGenerator):
-    def __init__(self, sub_commands: list["ExecuteSubCommandGenerator"], command: CommandGenerator):
-        super().__init__(sub_commands)
+    __slots__ = ("command",)
+
+    def __init__(self, sub_commands: list[ExecuteSubCommandGenerator], command: CommandGenerator):
+        super().__init__(sub_commands, ("run", command))
         self.command = command
 
-    def get_params(self) -> list[str]:
-        return super().get_params() + ["run", *self.command.get_params()]
+
+class PromotionSyncCommandGenerator(CommandGenerator):
+    # 调用前后同步被提升的 data 变量的命令，记录被调函数和变量路径；整个程序编译完之后才判断是否需要保留
+    __slots__ = ("callee", "path")
+
+    def __init__(self, command: CommandGenerator, callee: str, path: str):
+        super().__init__(command.opcode, command.operands)
+        self.callee = callee
+        self.path = path
@@ -0,0 +1,185 @@
+import argparse
+import json
+import os
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from antlr4 import FileStream
+
+from datapack import Datapack, create_emitter
+from driver import compile_stream
+from linker import CompiledModule, link
+from listener_interp import ListenerInterp
+from settings import OPT_LEVEL, OUTPUT_PATH, SOURCE_SUFFIX, SERVER_HOST, SERVER_PORT
+
+
+class CompiledUnit:
+    def __init__(self, mtime: float, datapack: Datapack | None, errors: list[str]):
+        self.mtime = mtime
+        self.datapack = datapack
+        self.errors = errors
+
+
+class CompileServer:
+    # 常驻进程：ANTLR 运行时、生成的解析器模块及其 DFA 缓存在多次构建间保持热状态，只重新编译发生变化的源文件
+    def __init__(self, source_dir: str, output: str = OUTPUT_PATH, host: str = SERVER_HOST, port: int = SERVER_PORT, interval: float = 0.5, modules: list[CompiledModule] = None, opt_level: int = OPT_LEVEL):
+        self.source_dir = source_dir
+        self.opt_level = opt_level
+        self.modules = modules or []
+        self.emitter = create_emitter(output)
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.units: dict[str, CompiledUnit] = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.server: socketserver.ThreadingTCPServer | None = None
+
+    def sources(self) -> dict[str, float]:
+        sources = {}
+        for root, dirs, files in os.walk(self.source_dir):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(SOURCE_SUFFIX):
+                    path = os.path.join(root, name)
+                    sources[path] = os.stat(path).st_mtime
+        return sources
+
+    def unit_name(self, path: str) -> str:
+        # 由相对路径得到编译单元前缀；含有标识符中不能出现的 -，不会与函数名冲突
+        relative = os.path.relpath(path, self.source_dir).removesuffix(SOURCE_SUFFIX)
+        return "file-" + re.sub(r"[^a-z0-9_]+", "-", relative.lower())
+
+    def compile_file(self, path: str) -> tuple[Datapack | None, list[str]]:
+        listener_interp = ListenerInterp(mode="memory", verbose=False, opt_level=self.opt_level, unit=self.unit_name(path))
+        for module in self.modules:
+            listener_interp.import_module(module)
+        try:
+            errors = compile_stream(FileStream(path, encoding="utf-8"), listener_interp)
+        except Exception as e:
+            return None, [f"{type(e).__name__}: {e}"]
+        if errors:
+            return None, errors
+        return listener_interp.datapack, []
+
+    def update(self) -> list[str]:
+        # 重新编译发生变化的源文件，返回重新编译或被删除的路径
+        sources = self.sources()
+        compiled = []
+        for path in self.units.keys() - sources.keys():
+            del self.units[path]
+            compiled.append(path)
+        for path, mtime in sources.items():
+            unit = self.units.get(path)
+            if unit is None or unit.mtime != mtime:
+                self.units[path] = CompiledUnit(mtime, *self.compile_file(path))
+                compiled.append(path)
+        return compiled
+
+    def link(self) -> Datapack:
+        datapack = Datapack()
+        for path in sorted(self.units):
+            datapack.merge(self.units[path].datapack)
+        return link(datapack, self.modules, self.opt_level)
+
+    def build(self) -> dict:
+        with self.lock:
+            start = time.perf_counter()
+            compiled = self.update()
+            errors = {path: unit.errors for path, unit in self.units.items() if unit.errors}
+            written = []
+            if compiled and not errors:
+                try:
+                    written = self.emitter.emit(self.link())
+                except ValueError as e:
+                    errors["<link>"] = [str(e)]
+            return {
+                "ok": not errors,
+                "compiled": compiled,
+                "written": written,
+                "errors": errors,
+                "time_ms": round((time.perf_counter() - start) * 1000, 3),
+            }
+
+    def watch(self):
+        while not self.stopped.wait(self.interval):
+            result = self.build()
+            if result["compiled"]:
+                print(json.dumps(result, ensure_ascii=False))
+
+    def handle(self, request: dict) -> dict:
+        command = request.get("command")
+        if command == "build":
+            return self.build()
+        elif command == "status":
+            with self.lock:
+                return {"ok": True, "sources": sorted(self.units), "errors": {path: unit.errors for path, unit in self.units.items() if unit.errors}}
+        elif command == "shutdown":
+            self.stop()
+            return {"ok": True}
+        else:
+            return {"ok": False, "errors": {"<request>": [f"Unknown command {command}"]}}
+
+    def serve_forever(self):
+        compile_server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        response = compile_server.handle(json.loads(line))
+                    except json.JSONDecodeError as e:
+                        response = {"ok": False, "errors": {"<request>": [str(e)]}}
+                    self.wfile.write((json.dumps(response, ensure_ascii=False) + "\n").encode("utf-8"))
+                    self.wfile.flush()
+
+        print(json.dumps(self.build(), ensure_ascii=False))
+        threading.Thread(target=self.watch, daemon=True).start()
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        with socketserver.ThreadingTCPServer((self.host, self.port), Handler) as self.server:
+            print(f"Listening on {self.host}:{self.port}")
+            self.server.serve_forever()
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            threading.Thread(target=self.server.shutdown).start()
+
+
+def request(command: str, host: str = SERVER_HOST, port: int = SERVER_PORT) -> dict:
+    with socket.create_connection((host, port)) as sock:
+        sock.sendall((json.dumps({"command": command}) + "\n").encode("utf-8"))
+        with sock.makefile("r", encoding="utf-8") as f:
+            return json.loads(f.readline())
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="compile_server")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    serve_parser = subparsers.add_parser("serve")
+    serve_parser.add_argument("source_dir")
+    serve_parser.add_argument("output", nargs="?", default=OUTPUT_PATH)
+    serve_parser.add_argument("--interval", type=float, default=0.5)
+    serve_parser.add_argument("-l", "--link", action="append", default=[], metavar="MODULE")
+    serve_parser.add_argument("-O", "--opt-level", type=int, default=OPT_LEVEL)
+    for action in ["build", "status", "shutdown"]:
+        subparsers.add_parser(action)
+    args = parser.parse_args(argv[1:])
+    if args.action == "serve":
+        modules = [CompiledModule.load(path) for path in args.link]
+        CompileServer(args.source_dir, args.output, args.host, args.port, args.interval, modules, args.opt_level).serve_forever()
+    else:
+        result = request(args.action, args.host, args.port)
+        print(json.dumps(result, ensure_ascii=False, indent=4))
+        if not result.get("ok"):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
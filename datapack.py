@@ -0,0 +1,139 @@
+import json
+import os
+import sys
+import zipfile
+
+from command_gen import CommandGenerator
+from ir import FunctionIR
+from settings import ENTRANCE_FUNCTION
+
+
+class Datapack:
+    def __init__(self, functions: dict[str, list] = None, function_tags: dict[str, list[str]] = None):
+        self.functions = functions if functions is not None else {}
+        self.function_tags = function_tags if function_tags is not None else {}
+
+    @staticmethod
+    def function_path(key: str):
+        namespace, path = key.split(":", 1)
+        return f"data/{namespace}/function/{path}.mcfunction"
+
+    @staticmethod
+    def function_tag_path(key: str):
+        namespace, name = key.split(":", 1)
+        return f"data/{namespace}/tags/function/{name}.json"
+
+    def merge(self, other: "Datapack"):
+        for key, commands in other.functions.items():
+            if key not in self.functions:
+                self.functions[key] = list(commands)
+            elif key.split(":", 1)[1] == ENTRANCE_FUNCTION:
+                existing = self.functions[key]
+                existing.extend(command for command in commands if not (isinstance(command, CommandGenerator) and command.opcode == "scoreboard objectives add" and command in existing))
+            else:
+                raise ValueError(f"Function {key} is defined more than once")
+        for key, values in other.function_tags.items():
+            tag_values = self.function_tags.setdefault(key, [])
+            tag_values.extend(value for value in values if value not in tag_values)
+        return self
+
+    def files(self) -> dict[str, str]:
+        files = {}
+        for key, values in self.function_tags.items():
+            files[self.function_tag_path(key)] = json.dumps({"values": values}, indent=4)
+        for key, commands in self.functions.items():
+            files[self.function_path(key)] = "".join(str(command) + "\n" for command in commands)
+        return files
+
+    def dump(self, blocks: bool = False) -> str:
+        # 调试用的文本形式：函数标签和全部函数；blocks 为真时在每条命令前标出所在的基本块
+        lines = ["[FUNCTION TAGS]"]
+        for key, values in self.function_tags.items():
+            lines.append(key)
+            lines.extend(f"- {value}" for value in values)
+            lines.append("")
+        lines += ["", "[COMMANDS]"]
+        for key, commands in self.functions.items():
+            lines += [key, "-----------"]
+            if blocks:
+                for i, block in enumerate(FunctionIR.from_commands(key, commands).blocks):
+                    lines.extend(f"[{i}] {command}" for command in block.commands)
+            else:
+                lines.extend(str(command) for command in commands)
+            lines.append("")
+        return "\n".join(lines) + "\n"
+
+
+class DirectoryEmitter:
+    # 记住上一次写出的内容，之后只写入发生变化的文件并删除不再生成的文件
+    def __init__(self, path: str):
+        self.path = path
+        self.written: dict[str, str] = {}
+
+    def emit(self, datapack: Datapack) -> list[str]:
+        files = datapack.files()
+        changed = []
+        for name, text in files.items():
+            if self.written.get(name) == text:
+                continue
+            file_path = os.path.join(self.path, name)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "w") as f:
+                f.write(text)
+            changed.append(name)
+        for name in self.written.keys() - files.keys():
+            file_path = os.path.join(self.path, name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            changed.append(name)
+        self.written = files
+        return changed
+
+
+class ZipEmitter:
+    # zip 中的条目无法单独替换，有变化时整体重写（先写临时文件再替换）
+    def __init__(self, path: str):
+        self.path = path
+        self.written: dict[str, str] = {}
+
+    def emit(self, datapack: Datapack) -> list[str]:
+        files = datapack.files()
+        changed = [name for name, text in files.items() if self.written.get(name) != text]
+        changed += [name for name in self.written.keys() - files.keys()]
+        if changed or not os.path.exists(self.path):
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with zipfile.ZipFile(temp_path, "w", zipfile.ZIP_DEFLATED) as f:
+                for name in sorted(files):
+                    f.writestr(name, files[name])
+            os.replace(temp_path, self.path)
+        self.written = files
+        return changed
+
+
+class DumpEmitter:
+    # 调试输出：整个数据包写成一个文本文件，路径为 - 时写到标准输出
+    def __init__(self, path: str):
+        self.path = path
+
+    def emit(self, datapack: Datapack) -> list[str]:
+        text = datapack.dump(blocks=True)
+        if self.path == "-":
+            sys.stdout.write(text)
+        else:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as f:
+                f.write(text)
+        return [self.path]
+
+
+def create_emitter(path: str):
+    if path.endswith(".zip"):
+        return ZipEmitter(path)
+    if path == "-" or path.endswith(".txt"):
+        return DumpEmitter(path)
+    return DirectoryEmitter(path)
@@ -1,40 +1,119 @@
+import argparse
 import sys
 from antlr4 import *
+from antlr4.error.ErrorListener import ErrorListener
 from gen.MCCDPLexer import MCCDPLexer
 from gen.MCCDPParser import MCCDPParser
+from datapack import create_emitter
+from linker import CompiledModule, link
 from listener_interp import ListenerInterp
+from settings import LIB_NAMESPACE, OPT_LEVEL, OUTPUT_PATH
 
-def main(argv):
-    input_stream = FileStream("test/test2.mccdp")
+
+class SyntaxErrorCollector(ErrorListener):
+    def __init__(self):
+        self.errors: list[str] = []
+
+    def syntaxError(self, recognizer, offendingSymbol, line, column, msg, e):
+        self.errors.append(f"line {line}:{column} {msg}")
+
+
+def create_parser(input_stream, collector: SyntaxErrorCollector) -> MCCDPParser:
     lexer = MCCDPLexer(input_stream)
+    lexer.removeErrorListeners()
+    lexer.addErrorListener(collector)
     stream = CommonTokenStream(lexer)
     parser = MCCDPParser(stream)
-    tree = parser.start_()
-    if parser.getNumberOfSyntaxErrors() > 0:
+    parser.removeErrorListeners()
+    parser.addErrorListener(collector)
+    return parser
+
+
+def parse(input_stream):
+    collector = SyntaxErrorCollector()
+    tree = create_parser(input_stream, collector).start_()
+    return tree, collector.errors
+
+
+def compile_stream(input_stream, listener_interp: ListenerInterp) -> list[str]:
+    # 逐条顶层语句解析并立即编译，编译完的语句不再被引用，其语法树可以回收，内存占用不随源文件长度增长
+    # （词法单元仍由 CommonTokenStream 全部缓存）；遇到语法错误即停止
+    collector = SyntaxErrorCollector()
+    parser = create_parser(input_stream, collector)
+    walker = ParseTreeWalker()
+    while parser.getTokenStream().LA(1) != Token.EOF:
+        statement_ctx = parser.statement()
+        if collector.errors:
+            return collector.errors
+        walker.walk(listener_interp, statement_ctx)
+    listener_interp.finish()
+    return []
+
+
+def main(argv):
+    arg_parser = argparse.ArgumentParser(prog="driver")
+    arg_parser.add_argument("source", nargs="?", default="test/test2.mccdp")
+    arg_parser.add_argument("-o", "--output", default=OUTPUT_PATH, help="output directory, .zip archive, or - / .txt for a text dump split into basic blocks")
+    arg_parser.add_argument("-l", "--link", action="append", default=[], metavar="MODULE", help="precompiled module to import and link")
+    arg_parser.add_argument("-O", "--opt-level", type=int, default=OPT_LEVEL, help="optimisation level; 2 enables compile-time evaluation of pure function calls")
+    arg_parser.add_argument("-j", "--jobs", type=int, metavar="N", help="compile top-level function bodies in N worker processes")
+    arg_parser.add_argument("--library", metavar="MODULE", help=f"compile the source as a library in the {LIB_NAMESPACE} namespace and save it as a module")
+    arg_parser.add_argument("--time-passes", action="store_true", help="print the time spent in each backend pass to stderr")
+    args = arg_parser.parse_args(argv[1:])
+    modules = [CompiledModule.load(path) for path in args.link]
+    listener_interp = ListenerInterp(mode="memory", namespace=LIB_NAMESPACE if args.library else "mydp", opt_level=args.opt_level)
+    for module in modules:
+        listener_interp.import_module(module)
+    if args.jobs is not None:
+        from parallel import compile_parallel
+        errors = compile_parallel(FileStream(args.source, encoding="utf-8"), listener_interp, args.jobs)
+    else:
+        errors = compile_stream(FileStream(args.source, encoding="utf-8"), listener_interp)
+    if errors:
+        for error in errors:
+            print(error)
         print("syntax errors")
+    elif args.library:
+        CompiledModule.from_listener(listener_interp).save(args.library)
     else:
-        listener_interp = ListenerInterp()
-        walker = ParseTreeWalker()
-        walker.walk(listener_interp, tree)
+        create_emitter(args.output).emit(link(listener_interp.datapack, modules, args.opt_level))
+        if args.time_passes and listener_interp.pass_manager is not None:
+            print(listener_interp.pass_manager.report(), file=sys.stderr)
 
 def shell():
+    from repl import ReplSession, unbalanced
+    session = ReplSession()
+    buffer = ""
     while True:
         try:
-            text = input('mccdp > ')
-            input_stream = InputStream(text)
-            lexer = MCCDPLexer(input_stream)
-            stream = CommonTokenStream(lexer)
-            parser = MCCDPParser(stream)
-            tree = parser.start_()
-            if parser.getNumberOfSyntaxErrors() > 0:
-                print("syntax errors")
-            else:
-                listener_interp = ListenerInterp()
-                walker = ParseTreeWalker()
-                walker.walk(listener_interp, tree)
+            text = input('mccdp > ' if not buffer else '    ... ')
         except EOFError:
             break
+        if not buffer and text.strip() == ":flush":
+            for name in session.flush():
+                print(f"wrote {name}")
+            continue
+        if not buffer and text.strip() == ":quit":
+            break
+        buffer += text + "\n"
+        if unbalanced(buffer):
+            continue
+        errors, changes = session.eval(buffer)
+        if errors and any("<EOF>" in error for error in errors):
+            continue
+        buffer = ""
+        if errors:
+            for error in errors:
+                print(error)
+            continue
+        for key, commands in changes.items():
+            if commands is None:
+                print(f"{key}: (removed)")
+                continue
+            print(f"{key}:")
+            for command in commands:
+                print(f"    {command}")
 
 if __name__ == '__main__':
     main(sys.argv)
-    # shell()
\ No newline at end of file
+    # shell()
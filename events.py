@@ -0,0 +1,218 @@
+import re
+from collections import defaultdict
+
+from command_gen import CommandGenerator
+from datapack import Datapack
+from partial_eval import CONDITIONS, PartialEvaluator, score_slot, split_run
+from settings import INTERNAL_PATH
+
+EXECUTORS = ("as", "at")
+GROUPABLE = EXECUTORS + CONDITIONS
+CHAT = ("<chat>", "")
+# 选择器作为记分板持有者时可能与 @s 以及同一记分项上的任何其他选择器指向同一实体，冲突分析中统一记为 ("@", 记分项)；
+# 实体标签记为 ("<tag>", 标签名)
+SELECTOR_HOLDER = "@"
+TAG = "<tag>"
+# 静态开销估计：每条命令和每次函数调用各计 1，execute as/at 按每个子命令选中 EXECUTOR_ESTIMATE 个实体计
+EXECUTOR_ESTIMATE = 2
+
+
+def dispatcher_key(namespace: str, tag: str, index: int = 0) -> str:
+    tag_namespace, tag_path = tag.split(":", 1)
+    return f"{namespace}:{INTERNAL_PATH}__dispatch.{tag_namespace}.{tag_path.replace('/', '.')}{f'_{index}' if index else ''}"
+
+
+def alias(slot: tuple[str, str]) -> tuple[str, str]:
+    holder, objective = slot
+    return (SELECTOR_HOLDER, objective) if holder.startswith("@") else slot
+
+
+def selector_reads(selector: str) -> set:
+    # 选择器参数 scores= 读取的记分项和 tag= 读取的标签
+    reads = set()
+    for scores in re.findall(r"scores=\{([^}]*)}", selector):
+        reads.update((SELECTOR_HOLDER, item.split("=", 1)[0].strip()) for item in scores.split(",") if "=" in item)
+    reads.update((TAG, tag) for tag in re.findall(r"tag=!?([^,\]\s]+)", selector))
+    return reads
+
+
+def sub_reads(sub) -> set:
+    # execute 子命令读取的槽位：条件子命令比较的记分板，执行者子命令的选择器参数
+    if sub.opcode in CONDITIONS:
+        slots = {alias(score_slot(sub.operands))}
+        if sub.operands[2] != "matches":
+            slots.add(alias(score_slot(sub.operands, 3)))
+        return slots
+    return selector_reads(str(sub.operands[0]))
+
+
+class EventLowering:
+    # 函数标签中连续的只有一条命令的处理函数内联到一个分发函数中，其余处理函数仍留在标签里；
+    # 相邻且以相同 execute 子命令开头的处理函数合并到同一个 execute 下，按声明顺序执行。
+    # 合并和分发函数都只在估计的开销低于原来时使用
+    def __init__(self, functions: dict[str, list]):
+        self.functions = functions
+        self.evaluator = PartialEvaluator(functions)
+        self.created: dict[str, list] = {}
+        self.counters = defaultdict(int)
+
+    def effects(self, command, visiting: set[str] = None) -> tuple[set, set] | None:
+        # 严格的副作用分析：只认识记分板命令、实体标签、聊天输出、execute as/at/if score 与函数调用，返回 (读取, 写入)，其余为 None；
+        # 选择器持有者按 alias 归并，选择器参数读取的记分项和标签也计入读取
+        if isinstance(command, str):
+            return (set(), set()) if command.startswith("#") else None
+        opcode, operands = command.opcode, command.operands
+        if opcode.startswith("scoreboard players"):
+            reads, writes = self.evaluator.reads(command), self.evaluator.writes(command)
+            if reads is None or writes is None:
+                return None
+            selectors = {slot for operand in operands if str(operand).startswith("@") for slot in selector_reads(str(operand))}
+            return {alias(slot) for slot in reads} | selectors, {alias(slot) for slot in writes}
+        elif opcode in ("say", "tellraw"):
+            return set(), {CHAT}
+        elif opcode == "tag" and len(operands) == 3 and operands[1] in ("add", "remove"):
+            return selector_reads(str(operands[0])), {(TAG, str(operands[2]))}
+        elif opcode == "execute":
+            subs, run = split_run(command)
+            if run is None or any(sub.opcode not in GROUPABLE for sub in subs):
+                return None
+            run_effects = self.effects(run, visiting)
+            if run_effects is None:
+                return None
+            return set().union(*(sub_reads(sub) for sub in subs)) | run_effects[0], run_effects[1]
+        elif opcode == "function" and len(operands) == 1:
+            visiting = visiting or set()
+            key = str(operands[0])
+            if key in visiting:
+                return set(), set()
+            if key not in self.functions:
+                return None
+            visiting.add(key)
+            reads, writes = set(), set()
+            for body_command in self.functions[key]:
+                body_effects = self.effects(body_command, visiting)
+                if body_effects is None:
+                    return None
+                reads |= body_effects[0]
+                writes |= body_effects[1]
+            return reads, writes
+        return None
+
+    def can_group(self, prefix: list, members: list[tuple[list, CommandGenerator]]) -> bool:
+        # 公共子命令只在组开始时求值一次：前面的成员不能写入后面成员依赖的条件槽位或执行者选择器读取的记分项和标签；
+        # 执行者子命令会把“逐个处理函数遍历实体”变成“逐个实体执行全部处理函数”，要求成员两两之间没有读写冲突
+        guards = set().union(*(sub_reads(sub) for sub in prefix))
+        effects = [self.effects(run) for _, run in members]
+        if any(effect is None for effect in effects):
+            return False
+        if any(writes & guards for _, writes in effects[:-1]):
+            return False
+        if any(sub.opcode not in CONDITIONS for sub in prefix):
+            for i, (reads1, writes1) in enumerate(effects):
+                for reads2, writes2 in effects[i + 1:]:
+                    if writes1 & (reads2 | writes2) or writes2 & reads1:
+                        return False
+        return True
+
+    def cost(self, command) -> int:
+        # 被调函数只计入降级时新建的函数体，其余函数的函数体在降级前后相同
+        if isinstance(command, str):
+            return 0 if command.startswith("#") else 1
+        if command.opcode == "execute":
+            subs, run = split_run(command)
+            if run is None:
+                return 1
+            return 1 + EXECUTOR_ESTIMATE ** sum(sub.opcode in EXECUTORS for sub in subs) * self.cost(run)
+        if command.opcode == "function" and len(command.operands) == 1:
+            return 2 + sum(self.cost(body_command) for body_command in self.created.get(str(command.operands[0]), []))
+        return 1
+
+    def group_cost(self, prefix: list, members: list[tuple[list, CommandGenerator]]) -> int:
+        # 合并后的 execute 加上组函数的调用和函数体（组内不再合并时的上限）
+        body = sum(self.cost(self.command(subs[len(prefix):], run)) for subs, run in members)
+        return 1 + EXECUTOR_ESTIMATE ** sum(sub.opcode in EXECUTORS for sub in prefix) * (2 + body)
+
+    @staticmethod
+    def common_prefix(subs1: list, subs2: list) -> list:
+        prefix = []
+        for sub1, sub2 in zip(subs1, subs2):
+            if sub1 != sub2 or sub1.opcode not in GROUPABLE:
+                break
+            prefix.append(sub1)
+        return prefix
+
+    @staticmethod
+    def command(subs: list, run: CommandGenerator) -> CommandGenerator:
+        return CommandGenerator("execute", (*subs, "run", run)) if subs else run
+
+    def lower(self, entries: list[tuple[list, CommandGenerator]], key: str) -> list:
+        commands = []
+        i = 0
+        while i < len(entries):
+            prefix = entries[i][0]
+            members = [entries[i]]
+            for subs, run in entries[i + 1:]:
+                candidate = self.common_prefix(prefix, subs)
+                if not candidate or not self.can_group(candidate, members + [(subs, run)]):
+                    break
+                prefix = candidate
+                members.append((subs, run))
+            if len(members) > 1 and self.group_cost(prefix, members) >= sum(self.cost(self.command(*member)) for member in members):
+                members = members[:1]
+            if len(members) == 1:
+                commands.append(self.command(*entries[i]))
+            else:
+                group_key = f"{key}.{self.counters[key]}"
+                self.counters[key] += 1
+                self.created[group_key] = self.lower([(subs[len(prefix):], run) for subs, run in members], group_key)
+                commands.append(self.command(prefix, CommandGenerator("function", (group_key,))))
+            i += len(members)
+        return commands
+
+    def entry(self, key: str) -> tuple[list, CommandGenerator] | None:
+        # 只有一条命令的处理函数拆成 (execute 子命令, run 命令)，其余返回 None
+        body = [command for command in self.functions[key] if not isinstance(command, str) or not command.startswith("#")]
+        if len(body) == 1 and isinstance(body[0], CommandGenerator):
+            if body[0].opcode == "execute" and split_run(body[0])[1] is not None:
+                return split_run(body[0])
+            return [], body[0]
+        return None
+
+    def dispatch(self, handlers: list[str], key: str) -> list[str]:
+        # 返回替换这些标签条目的函数：原来每个处理函数一次调用加一条命令，分发函数是一次调用加降级后的函数体
+        if len(handlers) >= 2:
+            entries = [self.entry(handler) for handler in handlers]
+            self.created[key] = self.lower(entries, key)
+            if self.cost(CommandGenerator("function", (key,))) - 1 < sum(1 + self.cost(self.command(*entry)) for entry in entries):
+                return [key]
+            for created in [created for created in self.created if created == key or created.startswith(key + ".")]:
+                del self.created[created]
+        return list(handlers)
+
+
+def lower_events(datapack: Datapack) -> Datapack:
+    functions = dict(datapack.functions)
+    function_tags = {}
+    lowering = EventLowering(functions)
+    for tag, values in datapack.function_tags.items():
+        if len(values) < 2 or any(value not in functions for value in values):
+            function_tags[tag] = list(values)
+            continue
+        namespace = values[0].split(":", 1)[0]
+        result = []
+        handlers = []
+        dispatchers = 0
+        for value in values + [None]:
+            if value is not None and lowering.entry(value) is not None:
+                handlers.append(value)
+                continue
+            lowered = lowering.dispatch(handlers, dispatcher_key(namespace, tag, dispatchers))
+            if lowered != handlers:
+                dispatchers += 1
+            result += lowered
+            handlers = []
+            if value is not None:
+                result.append(value)
+        function_tags[tag] = result
+    functions.update(lowering.created)
+    return Datapack(functions, function_tags)
@@ -0,0 +1,53 @@
+import math
+from fractions import Fraction
+
+INT_MAX = 2 ** 31 - 1
+MAX_DENOMINATOR = 10 ** 6
+
+# 定点数：记分板保存原始值 = 实际值 × 缩放系数。乘法与除法的中间结果会临时放大缩放系数，
+# 在除回目标系数之前可能溢出 32 位整数，这些位置会在编译时给出警告
+
+
+def to_fraction(value: int | float) -> Fraction:
+    return Fraction(value).limit_denominator(MAX_DENOMINATOR)
+
+
+def round_half_away(value: Fraction) -> int:
+    # 四舍五入，.5 远离零取整；内置 round 对 .5 取偶
+    magnitude = math.floor(abs(value) + Fraction(1, 2))
+    return magnitude if value >= 0 else -magnitude
+
+
+def raw_value(value: int | float, scale: int | float) -> int:
+    return round_half_away(to_fraction(value) * to_fraction(scale))
+
+
+def rescale_factor(target_scale: int | float, source_scale: int | float) -> Fraction:
+    # 把 source_scale 下的原始值换算到 target_scale 时乘上的系数
+    return to_fraction(target_scale) / to_fraction(source_scale)
+
+
+def result_scale(scale1: int | float, scale2: int | float) -> int | float:
+    return max(scale1, scale2)
+
+
+def safe_limit(scale: int | float) -> float:
+    # 原始值在该缩放系数下不溢出时实际值的最大绝对值
+    return INT_MAX / float(to_fraction(scale))
+
+
+def fold_constants(value1: int | float, value2: int | float, op: str) -> int | float:
+    # 常量折叠：整数除法和取模与记分板一致，向下取整
+    if op == "+":
+        return value1 + value2
+    elif op == "-":
+        return value1 - value2
+    elif op == "*":
+        return value1 * value2
+    if value2 == 0:
+        raise ValueError("Division by zero")
+    if op == "/":
+        return value1 // value2 if isinstance(value1, int) and isinstance(value2, int) else value1 / value2
+    elif op == "%":
+        return value1 % value2
+    raise ValueError(f"Unknown operator {op}")
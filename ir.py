@@ -0,0 +1,105 @@
+from command_gen import CommandGenerator
+from partial_eval import split_run
+
+# 函数级 IR：数据包函数内部没有跳转，控制转移只有函数调用（function、execute ... run function 和宏行），
+# 函数体按调用切分为基本块，每个基本块是一段不含调用的命令，以至多一条调用（终结命令）结束。
+# 条件分支和循环体等都是单独的内部函数，由调用它们的基本块引用，调用关系构成程序的调用图。
+# 后端的 pass 在 FunctionIR 上工作：调用点只出现在基本块末尾，直线代码的变换逐块进行
+
+
+def called_function(command) -> str | None:
+    # 命令调用的函数；execute 只看 run 后的命令
+    if not isinstance(command, CommandGenerator):
+        return None
+    if command.opcode == "function":
+        return str(command.operands[0])
+    if command.opcode == "execute":
+        run = split_run(command)[1]
+        return called_function(run) if run is not None else None
+    return None
+
+
+def is_macro(command) -> bool:
+    return isinstance(command, str) and command.startswith("$")
+
+
+def is_comment(command) -> bool:
+    return isinstance(command, str) and command.startswith("#")
+
+
+def ends_block(command) -> bool:
+    return called_function(command) is not None or is_macro(command)
+
+
+class BasicBlock:
+    def __init__(self, commands: list):
+        self.commands = commands
+
+    def terminator(self):
+        # 结束基本块的调用或宏行；函数的最后一个基本块可能没有
+        return self.commands[-1] if self.commands and ends_block(self.commands[-1]) else None
+
+    def call(self) -> str | None:
+        return called_function(self.commands[-1]) if self.commands else None
+
+
+class FunctionIR:
+    def __init__(self, key: str, blocks: list[BasicBlock]):
+        self.key = key
+        self.blocks = blocks
+
+    @classmethod
+    def from_commands(cls, key: str, commands: list) -> "FunctionIR":
+        blocks = []
+        current = []
+        for command in commands:
+            current.append(command)
+            if ends_block(command):
+                blocks.append(BasicBlock(current))
+                current = []
+        if current or not blocks:
+            blocks.append(BasicBlock(current))
+        return cls(key, blocks)
+
+    def commands(self) -> list:
+        return [command for block in self.blocks for command in block.commands]
+
+    def body(self) -> list:
+        # 不计注释的命令
+        return [command for command in self.commands() if not is_comment(command)]
+
+    def calls(self) -> list[str]:
+        return [call for call in (block.call() for block in self.blocks) if call is not None]
+
+    def macros(self) -> list[str]:
+        return [block.terminator() for block in self.blocks if is_macro(block.terminator())]
+
+    def map_blocks(self, transform) -> "FunctionIR":
+        # 逐块变换不改变终结命令的直线代码
+        return FunctionIR(self.key, [BasicBlock(transform(block.commands)) for block in self.blocks])
+
+    def replace_calls(self, replace) -> "FunctionIR":
+        # 替换基本块末尾的调用：replace 返回新命令、None（删除调用）或原命令（保留）。
+        # 调用被替换后所在的基本块与下一个基本块合并，因此重新切分
+        commands = []
+        changed = False
+        for block in self.blocks:
+            terminator = block.terminator()
+            if terminator is None or is_macro(terminator):
+                commands += block.commands
+                continue
+            replacement = replace(terminator)
+            changed |= replacement is not terminator
+            commands += block.commands[:-1]
+            if replacement is not None:
+                commands.append(replacement)
+        return FunctionIR.from_commands(self.key, commands) if changed else self
+
+
+def call_graph(functions: dict[str, FunctionIR]) -> dict[str, list[str]]:
+    # 被调函数 -> 调用点所在的函数（每个调用点一项）
+    callers = {}
+    for key, function in functions.items():
+        for callee in function.calls():
+            callers.setdefault(callee, []).append(key)
+    return callers
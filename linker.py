@@ -0,0 +1,174 @@
+import json
+from typing import Any
+
+import mcc_types
+from command_gen import CommandGenerator
+from datapack import Datapack
+from events import lower_events
+from mcc_types import *
+from settings import OPT_LEVEL
+
+MODULE_FORMAT = 1
+
+
+def encode_command(command):
+    if isinstance(command, CommandGenerator):
+        return {"op": command.opcode, "args": [encode_command(operand) for operand in command.operands]}
+    return str(command)
+
+
+def decode_command(data):
+    if isinstance(data, dict):
+        return CommandGenerator(data["op"], tuple(decode_command(operand) for operand in data["args"]))
+    return data
+
+
+def encode_type(type1):
+    if type1 is Any:
+        return "Any"
+    return type1.__name__
+
+
+def decode_type(name: str):
+    if name == "Any":
+        return Any
+    return getattr(mcc_types, name)
+
+
+def encode_constant(constant):
+    if constant is None:
+        return None
+    elif isinstance(constant, BooleanConstant):
+        return {"kind": "bool", "value": constant.bool_value()}
+    elif isinstance(constant, (IntConstant, FloatConstant)):
+        return {"kind": type(constant).__name__, "value": constant.value, "type": constant.type}
+    elif isinstance(constant, StringConstant):
+        return {"kind": "string", "value": constant.value}
+    elif isinstance(constant, ListConstant):
+        return {"kind": "list", "value": [encode_constant(item) for item in constant.value]}
+    elif isinstance(constant, ArrayConstant):
+        return {"kind": "array", "value": [encode_constant(item) for item in constant.value], "type": constant.type}
+    elif isinstance(constant, CompoundConstant):
+        return {"kind": "compound", "value": {k: encode_constant(v) for k, v in constant.value.items()}}
+    raise TypeError(f"Constant of type {type(constant)} cannot be exported")
+
+
+def decode_constant(data: dict | None):
+    if data is None:
+        return None
+    kind = data["kind"]
+    if kind == "bool":
+        return BooleanConstant(data["value"])
+    elif kind == "IntConstant":
+        return IntConstant(data["value"], data["type"])
+    elif kind == "FloatConstant":
+        return FloatConstant(data["value"], data["type"])
+    elif kind == "string":
+        return StringConstant(data["value"])
+    elif kind == "list":
+        return ListConstant([decode_constant(item) for item in data["value"]])
+    elif kind == "array":
+        return ArrayConstant([decode_constant(item) for item in data["value"]], data["type"])
+    elif kind == "compound":
+        return CompoundConstant({k: decode_constant(v) for k, v in data["value"].items()})
+    raise ValueError(f"Unknown constant kind {kind}")
+
+
+def encode_definition(definition):
+    if isinstance(definition, Scoreboard):
+        return {"kind": "score", "namespace": definition.namespace, "objective": definition.objective, "scope": definition.scope, "name": definition.name, "scale": definition.scale}
+    elif isinstance(definition, StorageDataPath):
+        return {"kind": "data", "namespace": definition.namespace, "id": definition.id, "scope": definition.scope, "name": definition.name}
+    elif isinstance(definition, Function):
+        return {"kind": "function", "namespace": definition.namespace, "name": definition.name, "scope": definition.scope, "params": [{"name": param.name, "type": encode_type(param.type), "default": encode_constant(param.default)} for param in definition.params], "returns": encode_type(definition.return_type) if definition.return_type is not None else None}
+    raise TypeError(f"Definition of type {type(definition)} cannot be exported")
+
+
+def decode_definition(data: dict):
+    kind = data["kind"]
+    if kind == "score":
+        return Scoreboard(data["namespace"], data["objective"], data["scope"], data["name"], data["scale"])
+    elif kind == "data":
+        return StorageDataPath(data["namespace"], data["id"], data["scope"], data["name"])
+    elif kind == "function":
+        return Function(data["namespace"], data["name"], [FunctionArgument(param["name"], decode_type(param["type"]), decode_constant(param.get("default"))) for param in data["params"]], data["scope"], return_type=decode_type(data["returns"]) if data.get("returns") else None)
+    raise ValueError(f"Unknown definition kind {kind}")
+
+
+def function_references(command) -> list[str]:
+    if not isinstance(command, CommandGenerator):
+        return []
+    if command.opcode == "function":
+        return [str(command.operands[0])]
+    return [reference for operand in command.operands for reference in function_references(operand)]
+
+
+class CompiledModule:
+    # 预编译模块：导出符号、IR 形式的函数体和函数标签，可序列化为 JSON 并在链接时合并进项目
+    def __init__(self, namespace: str, exports: dict[str, Any], functions: dict[str, list], function_tags: dict[str, list[str]]):
+        self.namespace = namespace
+        self.exports = exports
+        self.functions = functions
+        self.function_tags = function_tags
+
+    @classmethod
+    def from_listener(cls, listener_interp) -> "CompiledModule":
+        datapack = listener_interp.to_datapack()
+        # 类不导出：类型编号、字段槽位和分派函数在整个程序编译完之后才分配，无法与导入方的类层次合并。
+        # 库中的类只能在库内部使用，库函数可以照常构造实例和调用方法
+        exports = {name: value for name, value in listener_interp.symbols.root_symbols().items()
+                   if name.split(":", 1)[0] == listener_interp.namespace and not name.split(":", 1)[1].startswith("_") and not isinstance(value, ClassType)}
+        return cls(listener_interp.namespace, exports, datapack.functions, datapack.function_tags)
+
+    def to_json(self) -> dict:
+        return {
+            "format": MODULE_FORMAT,
+            "namespace": self.namespace,
+            "exports": {name: encode_definition(value) for name, value in self.exports.items()},
+            "functions": {key: [encode_command(command) for command in commands] for key, commands in self.functions.items()},
+            "function_tags": self.function_tags,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "CompiledModule":
+        if data.get("format") != MODULE_FORMAT:
+            raise ValueError(f"Unsupported module format {data.get('format')}")
+        return cls(
+            data["namespace"],
+            {name: decode_definition(value) for name, value in data["exports"].items()},
+            {key: [decode_command(command) for command in commands] for key, commands in data["functions"].items()},
+            data["function_tags"],
+        )
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_json(), f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> "CompiledModule":
+        with open(path, encoding="utf-8") as f:
+            return cls.from_json(json.load(f))
+
+
+def link(datapack: Datapack, modules: list[CompiledModule], opt_level: int = OPT_LEVEL) -> Datapack:
+    # 项目自身的函数与所有函数标签为根，只保留从根可达的模块函数；-O 1 及以上最后把多处理函数的标签降级为分发函数
+    module_functions = {}
+    for module in modules:
+        for key in module.functions:
+            if key in module_functions or key in datapack.functions:
+                raise ValueError(f"Function {key} is defined by more than one module")
+        module_functions.update(module.functions)
+    # 模块的标签条目排在项目之前，保证库的初始化先于项目执行
+    linked = Datapack({key: list(commands) for key, commands in datapack.functions.items()}, {})
+    for module in modules:
+        linked.merge(Datapack({}, module.function_tags))
+    linked.merge(Datapack({}, datapack.function_tags))
+    pending = [key for values in linked.function_tags.values() for key in values]
+    pending += [reference for commands in linked.functions.values() for command in commands for reference in function_references(command)]
+    while pending:
+        key = pending.pop()
+        if key in linked.functions or key not in module_functions:
+            continue
+        linked.functions[key] = list(module_functions[key])
+        pending += [reference for command in linked.functions[key] for reference in function_references(command)]
+    return lower_events(linked) if opt_level >= 1 else linked
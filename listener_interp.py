@@ -1,93 +1,342 @@
-import json
-import os
+import sys
+import warnings
 from collections import defaultdict
 from typing import Any
 
 from antlr4 import ParserRuleContext
 
-from built_in_functions import BUILT_IN_FUNCTIONS
+from built_in_functions import BUILT_IN_DECORATORS, BUILT_IN_FUNCTIONS, SCORE_PARAM_TYPES
+from class_lowering import class_objectives, dispatch_function, init_function, lower_classes
 from gen.MCCDPParser import MCCDPParser
 from gen.MCCDPListener import MCCDPListener
 from bidict import bidict
 
 from mcc_types import *
 from command_gen import *
+from datapack import Datapack, DirectoryEmitter
+from fixed_point import fold_constants, raw_value, rescale_factor, result_scale, safe_limit, to_fraction
+from linker import link
 
 import re
 
-from settings import OUTPUT_PATH
+from ir import BasicBlock, FunctionIR, called_function, is_comment
+from optimizations import add_optimizations, inline_call
+from pipeline import PassManager
+from partial_eval import NotConstant, PartialEvaluator, set_score
+from selector_optimizer import cache_selectors, optimize_selector
+from settings import OUTPUT_PATH, OPT_LEVEL
+from symbol_table import SymbolTable
 
 
 class ListenerInterp(MCCDPListener):
-    def __init__(self, mode: str = 'file'):
+    def __init__(self, mode: str = 'file', verbose: bool = True, namespace: str = "mydp", opt_level: int = OPT_LEVEL, unit: str | None = None):
         self.mode = mode
+        self.verbose = verbose
+        self.opt_level = opt_level
         self.result: dict[ParserRuleContext, Any] = {}
         self.affiliations = set()
         self.intermediate = {}
         self.commands = defaultdict(list)
         self.definitions = {}
+        self.symbols = SymbolTable()
         self.current_id = 0
         self.internal_identifiers = bidict()
         self.var_types = {}
-        self.namespace = "mydp"
+        self.namespace = namespace
         self.scope = []
+        # 编译单元前缀：分别编译再合并的多个源文件中，根作用域下的内部函数、变量和中间量以它区分
+        self.unit = unit
         self.scope_ready = None
+        self.function_ready: tuple[Function, MCCDPParser.ParamsContext | None] | None = None
         self.scope_counters = defaultdict(int)
         self.function_tags = defaultdict(list)
+        self.function_flags: dict[str, set[str]] = defaultdict(set)
         self.amend = False
+        self.allow_redefinition = False
+        # 被重新定义而丢弃过函数体的函数，由交互式会话读取并清空
+        self.redefined: set[str] = set()
+        self.datapack: Datapack | None = None
+        self.function_stack = []
+        self.current_function: Function | None = None
+        self.current_key: str | None = None
+        self.current_commands: list | None = None
+        self.constants: set[int] = set()
+        self.line = 0
+        self.defining: list[Function] = []
+        self.finished_functions: set[str] = set()
+        self.specialisations: dict[tuple, Function] = {}
+        # 以整数常量初始化的 data 变量及其 NBT 类型；被提升到记分板寄存器的变量按正在定义的函数分层记录
+        self.numeric_data: dict[str, str] = {}
+        self.promotions: list[tuple[dict[str, StorageDataPath], set[str]]] = []
+        # 已声明的类和接口；方法调用点调用的分派函数及其静态类型和方法名，在生成数据包时解析；正在定义的类及其继承的成员名
+        self.classes: dict[str, ClassType] = {}
+        self.dispatches: dict[str, tuple[str, str]] = {}
+        self.class_stack: list[tuple[ClassType, set[str]]] = []
+        self.pass_manager: PassManager | None = None
+        self.imported_functions: set[str] = set()
+        self.partial_evaluator = PartialEvaluator(self.commands)
+        self.update_current_function()
 
     def create_intermediate(self):
         intermediate = self.current_id
         self.current_id += 1
         return Intermediate(intermediate)
 
+    def update_current_function(self):
+        self.current_function = Function.from_whole_path(self.namespace, list(self.scope))
+        self.current_key = sys.intern(str(self.current_function))
+        # 命令列表在第一次添加命令时才创建，没有命令的函数和作用域不生成文件
+        self.current_commands = self.commands.get(self.current_key)
+
+    def push_function(self):
+        self.symbols.push()
+        self.function_stack.append((self.current_function, self.current_key, self.current_commands))
+        self.update_current_function()
+
+    def pop_function(self):
+        self.symbols.pop()
+        self.current_function, self.current_key, self.current_commands = self.function_stack.pop()
+
     def add_command(self, command, mode=None):
-        key = str(Function.from_whole_path(self.namespace, self.scope))
+        if self.current_commands is None:
+            self.current_commands = self.commands.setdefault(self.current_key, [])
         if mode == "prepend":
-            self.commands[key].insert(0, command)
+            self.current_commands.insert(0, command)
         else:
             if self.amend:
-                self.commands[key][-1] += command
+                self.current_commands[-1] += command
             else:
-                self.commands[key].append(command)
+                self.current_commands.append(command)
             self.amend = mode == "amend"
-        print(f"{key}: {command}{f' ({mode})' if mode else ''}")
+        if self.verbose:
+            print(f"{self.current_key}: {command}{f' ({mode})' if mode else ''}")
 
     def set_scoreboard(self, scoreboard: Scoreboard, value: float):
-        self.add_command(ScoreboardPlayersSetCommandGenerator(scoreboard, int(value * scoreboard.scale)))
+        self.add_command(ScoreboardPlayersSetCommandGenerator(scoreboard, raw_value(value, scoreboard.scale)))
 
     def add_scoreboard(self, scoreboard: Scoreboard, value: float):
-        self.add_command(ScoreboardPlayersAddCommandGenerator(scoreboard, int(value * scoreboard.scale)))
+        raw = raw_value(value, scoreboard.scale)
+        if raw < 0:
+            self.add_command(ScoreboardPlayersRemoveCommandGenerator(scoreboard, -raw))
+        elif raw > 0:
+            self.add_command(ScoreboardPlayersAddCommandGenerator(scoreboard, raw))
 
     def remove_scoreboard(self, scoreboard: Scoreboard, value: float):
-        self.add_command(ScoreboardPlayersRemoveCommandGenerator(scoreboard, int(value * scoreboard.scale)))
+        self.add_scoreboard(scoreboard, -value)
 
     def set_data(self, data: StorageDataPath, value):
         self.add_command(DataModifyStorageSetValueCommandGenerator(data, value))
 
+    @staticmethod
+    def load_command(data: StorageDataPath, scoreboard: Scoreboard) -> CommandGenerator:
+        return ExecuteRunCommandGenerator([ExecuteStoreResultScoreCommandGenerator(scoreboard)], DataGetStorageCommandGenerator(data))
+
+    def store_command(self, data: StorageDataPath, scoreboard: Scoreboard) -> CommandGenerator:
+        return ExecuteRunCommandGenerator([ExecuteStoreResultStorageCommandGenerator(data, self.numeric_data.get(str(data), "int"), 1)], ScoreboardPlayersGetCommandGenerator(scoreboard))
+
+    def load_data(self, data: StorageDataPath, scoreboard: Scoreboard = None) -> Scoreboard:
+        scoreboard = scoreboard or self.intermediate_scoreboard(self.create_intermediate())
+        self.add_command(self.load_command(data, scoreboard))
+        return scoreboard
+
+    def store_data(self, data: StorageDataPath, scoreboard: Scoreboard):
+        self.add_command(self.store_command(data, scoreboard))
+
+    def numeric_value(self, value):
+        # 未提升的数值 data 变量参与运算时，每次读取都复制到中间量
+        if isinstance(value, StorageDataPath) and str(value) in self.numeric_data:
+            return self.load_data(value)
+        return value
+
+    def register(self, data: StorageDataPath) -> Scoreboard:
+        return self.global_scoreboard(["__promoted", *data.scope], data.name)
+
+    def promotion_candidates(self, function: Function, block_ctx: MCCDPParser.BlockContext) -> tuple[dict[str, StorageDataPath], set[str]]:
+        # 统计函数体（不含嵌套函数）中对数值 data 变量的引用：默认引用至少两次才提升，
+        # @force_promote 强制提升所有引用到的变量，@no_promote 不提升；同时记录被赋值的变量，只有它们需要写回
+        flags = self.function_flags.get(str(function), set())
+        if "no_promote" in flags:
+            return {}, set()
+        counts = defaultdict(int)
+        variables = {}
+        written = set()
+        stack = [block_ctx]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, MCCDPParser.FunctionStatementContext):
+                continue
+            if isinstance(node, MCCDPParser.LvalContext):
+                value = self.symbols.resolve(str(self.analyse_namespaced_id(node.namespacedId())))
+                if isinstance(value, StorageDataPath) and value.kind == "storage" and str(value) in self.numeric_data:
+                    counts[str(value)] += 1
+                    variables[str(value)] = value
+                    expr_ctx = node.parentCtx
+                    parent = expr_ctx.parentCtx
+                    if isinstance(parent, (MCCDPParser.PreIncDecExprContext, MCCDPParser.PostIncDecExprContext)) or \
+                            isinstance(parent, MCCDPParser.AssignExprContext) and parent.expr(0) is expr_ctx:
+                        written.add(str(value))
+            if isinstance(node, ParserRuleContext) and node.children:
+                stack.extend(node.children)
+        threshold = 1 if "force_promote" in flags else 2
+        promoted = {key: data for key, data in variables.items() if counts[key] >= threshold}
+        return promoted, written & promoted.keys()
+
+    def mentions_storage(self, functions: dict[str, FunctionIR], key: str, text: str, visiting: set[str]) -> bool:
+        # 被调函数（含其调用的函数和虚调用的全部实现）是否可能访问某个 storage 路径；
+        # 没有命令的已编译函数不访问，其他未知的函数（例如链接的模块）和宏行按可能访问处理
+        if key in visiting:
+            return False
+        visiting.add(key)
+        if key in self.dispatches:
+            class_key, name = self.dispatches[key]
+            methods = [class_type.find_method(name) for class_type in self.classes.values() if class_type.is_subtype(self.classes[class_key])]
+            return any(self.mentions_storage(functions, str(method), text, visiting) for method in methods if method is not None)
+        if key not in functions:
+            return key not in self.finished_functions
+        for block in functions[key].blocks:
+            if any(isinstance(command, str) or text in str(command) for command in block.commands if not is_comment(command)):
+                return True
+            callee = block.call()
+            if callee is not None and self.mentions_storage(functions, callee, text, visiting):
+                return True
+        return False
+
+    def sync_promotions(self, function: Function) -> list[StorageDataPath]:
+        # 调用之前写回被赋值过的寄存器，返回调用之后需要重新读取的变量。同步命令带有标记，
+        # 被调函数是否可能访问这些变量要等整个程序编译完（并行编译时合并之后）才能判断，由 resolve_promotion_syncs 决定
+        if not self.promotions:
+            return []
+        promoted, written = self.promotions[-1]
+        for data in promoted.values():
+            if str(data) in written:
+                self.add_command(PromotionSyncCommandGenerator(self.store_command(data, self.register(data)), str(function), str(data)))
+        return list(promoted.values())
+
+    def reload_promotions(self, function: Function, synced: list[StorageDataPath]):
+        for data in synced:
+            self.add_command(PromotionSyncCommandGenerator(self.load_command(data, self.register(data)), str(function), str(data)))
+
+    def resolve_promotion_syncs(self, functions: dict[str, FunctionIR]) -> dict[str, FunctionIR]:
+        # 删除被调函数不会访问的变量的同步命令；同步命令不是调用，删除它们不改变基本块的划分
+        needed = {}
+
+        def keep(command) -> bool:
+            if not isinstance(command, PromotionSyncCommandGenerator):
+                return True
+            sync = (command.callee, command.path)
+            if sync not in needed:
+                needed[sync] = self.mentions_storage(functions, command.callee, command.path, set())
+            return needed[sync]
+
+        return {key: function.map_blocks(lambda commands: [command for command in commands if keep(command)]) for key, function in functions.items()}
+
+    def global_storage(self, scope, name, namespace=None):
+        return StorageDataPath(namespace or self.namespace, "__global", list(scope), name)
+
     def global_scoreboard(self, scope, name, scaling_factor: int | float = 1, namespace=None):
-        return Scoreboard(namespace or self.namespace, "__global", scope, name, scaling_factor)
+        return Scoreboard(namespace or self.namespace, "__global", list(scope), name, scaling_factor)
 
     def intermediate_scoreboard(self, intermediate: Intermediate, scale=1):
-        return self.global_scoreboard(["__intermediate"], intermediate.id, scale)
+        return self.global_scoreboard(["__intermediate"], f"{self.unit}.{intermediate.id}" if self.unit else intermediate.id, scale)
+
+    def constant_scoreboard(self, value: int):
+        # 常量槽位 __const.<值>，在入口函数中统一初始化，供 operation 使用
+        self.constants.add(value)
+        return self.global_scoreboard(["__const"], str(value))
+
+    def warn_overflow(self, message: str, limit: float):
+        warnings.warn(f"line {self.line}: {message} overflows when the magnitude exceeds {limit:g}", stacklevel=3)
+
+    def rescale(self, scoreboard: Scoreboard, factor, description: str):
+        # 原始值乘以 p/q：先乘后除保留精度，乘除都存在时中间结果可能溢出
+        p, q = factor.numerator, factor.denominator
+        if p == 0:
+            self.add_command(ScoreboardPlayersSetCommandGenerator(scoreboard, 0))
+            return
+        if p != 1:
+            self.add_command(ScoreboardPlayersOperationCommandGenerator(scoreboard, self.constant_scoreboard(p), "*="))
+        if q != 1:
+            if abs(p) != 1:
+                self.warn_overflow(f"{description} (intermediate ×{p})", safe_limit(scoreboard.scale * abs(p)))
+            self.add_command(ScoreboardPlayersOperationCommandGenerator(scoreboard, self.constant_scoreboard(q), "/="))
 
-    def op_scoreboard(self, scoreboard1: Scoreboard, scoreboard2: Scoreboard, op):
-        if scoreboard1.scale == scoreboard2.scale:
+    def op_scoreboard(self, scoreboard1: Scoreboard, scoreboard2, op):
+        # 定点数运算：结果保持 scoreboard1 的缩放系数；scoreboard2 可以是记分板或数值常量
+        if isinstance(scoreboard2, (IntConstant, FloatConstant)):
+            self.op_constant(scoreboard1, scoreboard2.value, op)
+        elif op == "=":
+            self.add_command(ScoreboardPlayersOperationCommandGenerator(scoreboard1, scoreboard2, op))
+            self.rescale(scoreboard1, rescale_factor(scoreboard1.scale, scoreboard2.scale), f"Rescaling {scoreboard2}")
+        elif op in ("+=", "-=", "%=", "<", ">", "><"):
+            if scoreboard1.scale != scoreboard2.scale:
+                if op == "><":
+                    raise ValueError(f"Cannot swap scores with different scales ({scoreboard1}, {scoreboard2})")
+                rescaled = self.intermediate_scoreboard(self.create_intermediate(), scoreboard1.scale)
+                self.op_scoreboard(rescaled, scoreboard2, "=")
+                scoreboard2 = rescaled
+            self.add_command(ScoreboardPlayersOperationCommandGenerator(scoreboard1, scoreboard2, op))
+        elif op == "*=":
+            # (a / s1) × (b / s2) × s1 = a × b / s2
+            self.add_command(ScoreboardPlayersOperationCommandGenerator(scoreboard1, scoreboard2, op))
+            factor = to_fraction(scoreboard2.scale)
+            if factor != 1:
+                self.warn_overflow(f"Multiplying {scoreboard1} by {scoreboard2}", safe_limit(scoreboard1.scale * scoreboard2.scale))
+                self.rescale(scoreboard1, 1 / factor, f"Multiplying {scoreboard1} by {scoreboard2}")
+        elif op == "/=":
+            # (a / s1) / (b / s2) × s1 = a × s2 / b
+            factor = to_fraction(scoreboard2.scale)
+            if factor != 1:
+                self.warn_overflow(f"Dividing {scoreboard1} by {scoreboard2}", safe_limit(scoreboard1.scale * scoreboard2.scale))
+                self.rescale(scoreboard1, factor, f"Dividing {scoreboard1} by {scoreboard2}")
             self.add_command(ScoreboardPlayersOperationCommandGenerator(scoreboard1, scoreboard2, op))
         else:
-            if op == "=":
-                self.add_command(ScoreboardPlayersOperationCommandGenerator(scoreboard1, scoreboard2, op))
-                intermediate = self.create_intermediate()
-                intermediate_scoreboard = self.intermediate_scoreboard(intermediate)
-                if scoreboard1.scale < scoreboard2.scale:
-                    self.set_scoreboard(intermediate_scoreboard, scoreboard2.scale / scoreboard1.scale)
-                    self.op_scoreboard(scoreboard1, intermediate_scoreboard, "/=")
-                else:
-                    self.set_scoreboard(intermediate_scoreboard, scoreboard1.scale / scoreboard2.scale)
-                    self.op_scoreboard(scoreboard1, intermediate_scoreboard, "*=")
-            elif op == "*=" or op == "/=":
-                if scoreboard2.scale == 1:
-                    self.add_command(ScoreboardPlayersOperationCommandGenerator(scoreboard1, scoreboard2, op))
+            raise ValueError(f"Unknown operator {op}")
+
+    def op_constant(self, scoreboard: Scoreboard, value: int | float, op):
+        if op == "=":
+            self.set_scoreboard(scoreboard, value)
+        elif op == "+=":
+            self.add_scoreboard(scoreboard, value)
+        elif op == "-=":
+            self.remove_scoreboard(scoreboard, value)
+        elif op == "*=":
+            self.rescale(scoreboard, to_fraction(value), f"Multiplying {scoreboard} by {value}")
+        elif op == "/=":
+            if value == 0:
+                raise ValueError("Division by zero")
+            self.rescale(scoreboard, 1 / to_fraction(value), f"Dividing {scoreboard} by {value}")
+        elif op == "%=":
+            raw = raw_value(value, scoreboard.scale)
+            if raw == 0:
+                raise ValueError("Modulo by zero")
+            self.add_command(ScoreboardPlayersOperationCommandGenerator(scoreboard, self.constant_scoreboard(raw), op))
+        else:
+            raise ValueError(f"Unknown operator {op}")
+
+    def arithmetic(self, value1, value2, op: str):
+        # 二元运算：常量直接折叠；否则复制左操作数到缩放系数为两者较大值的中间量，再原地运算
+        value1, value2 = self.numeric_value(value1), self.numeric_value(value2)
+        if isinstance(value1, (IntConstant, FloatConstant)) and isinstance(value2, (IntConstant, FloatConstant)):
+            result = fold_constants(value1.value, value2.value, op)
+            return FloatConstant(result) if isinstance(result, float) else IntConstant(result)
+        if not isinstance(value1, (Scoreboard, IntConstant, FloatConstant)) or not isinstance(value2, (Scoreboard, IntConstant, FloatConstant)):
+            raise NotImplementedError(f"Arithmetic between {type(value1)} and {type(value2)} is not supported")
+        if not isinstance(value1, Scoreboard):
+            if op in ("+", "*"):
+                value1, value2 = value2, value1
+            else:
+                constant = self.intermediate_scoreboard(self.create_intermediate(), value2.scale)
+                self.set_scoreboard(constant, value1.value)
+                value1 = constant
+        scale = result_scale(value1.scale, value2.scale) if isinstance(value2, Scoreboard) else value1.scale
+        if value1.scope == ["__intermediate"] and value1.scale == scale:
+            # 中间量只被使用一次，可以直接原地运算
+            intermediate_scoreboard = value1
+        else:
+            intermediate_scoreboard = self.intermediate_scoreboard(self.create_intermediate(), scale)
+            self.op_scoreboard(intermediate_scoreboard, value1, "=")
+        self.op_scoreboard(intermediate_scoreboard, value2, op + "=")
+        return intermediate_scoreboard
 
     def call_function(self, function: Function, args: dict[str, Any] = None):
         if isinstance(function, BuiltInFunction):
@@ -101,11 +350,127 @@ class ListenerInterp(MCCDPListener):
             else:
                 raise NotImplementedError(f"Unsupported built-in function {function.name}")
         else:
-            if not args:
-                self.add_command(FunctionCommandGenerator(function))
+            args = self.bind_arguments(function, args or {})
+            target = function
+            if self.opt_level >= 2 and str(function) in self.finished_functions:
+                evaluated = self.evaluate_call(function, args)
+                if evaluated is not None:
+                    target, args, result = evaluated
+                    if target is None:
+                        return result
+            synced = self.sync_promotions(target)
+            self.pass_arguments(function, args, target)
+            self.reload_promotions(target, synced)
+            if function.return_type is not None:
+                intermediate_scoreboard = self.intermediate_scoreboard(self.create_intermediate())
+                self.op_scoreboard(intermediate_scoreboard, function.return_slot(), "=")
+                return intermediate_scoreboard
         return None
 
+    def bind_arguments(self, function: Function, args: dict[str, Any]) -> dict[str, Any]:
+        bound = {}
+        for param in function.params:
+            value = args.get(param.name)
+            if value is None:
+                value = param.default
+            if value is None:
+                raise TypeError(f"Missing argument {param.name} for function {function}")
+            bound[param.name] = value
+        return bound
+
+    def evaluate_call(self, function: Function, args: dict[str, Any]):
+        # 部分求值（opt_level >= 2，且被调函数已编译完毕）：
+        # - 全部参数为常量的纯函数在编译期求值，调用被替换为返回值；参数槽位和被调函数写入的自身槽位在调用之后仍然可见，
+        #   改为按求值结果直接 set（中间量除外）；
+        # - 部分参数为常量时生成特化副本，仅当每次调用执行的命令数减少时才使用。
+        # 返回 (None, None, 结果) 表示已求值，(特化函数, 剩余参数, None) 表示改调特化副本，None 表示照常调用
+        constants = {}
+        for param in function.params:
+            slot = function.argument_slot(param)
+            value = args[param.name]
+            if isinstance(slot, Scoreboard) and isinstance(value, (IntConstant, FloatConstant)):
+                constants[(slot.final_name(), slot.final_objective())] = raw_value(value.value, slot.scale)
+        if not constants:
+            return None
+        key = str(function)
+        return_slot = function.return_slot()
+        return_key = (return_slot.final_name(), return_slot.final_objective())
+        if len(constants) == len(function.params):
+            try:
+                env = self.partial_evaluator.evaluate(key, constants)
+                written = self.partial_evaluator.function_slots(key, self.partial_evaluator.writes, None)
+                if written is not None and (function.return_type is None or return_key in env):
+                    for slot in sorted(written | set(constants)):
+                        if slot in env and not slot[0].startswith("__intermediate."):
+                            self.add_command(set_score(slot, env[slot]))
+                    return None, None, IntConstant(env[return_key]) if function.return_type is not None else None
+            except NotConstant:
+                pass
+        cache_key = (key, tuple(sorted(constants.items())))
+        specialisation = self.specialisations.get(cache_key)
+        if specialisation is None or str(specialisation) not in self.commands:
+            commands = self.partial_evaluator.specialise(key, constants)
+            original = [command for command in self.commands.get(key, []) if not isinstance(command, str)]
+            if len(commands) >= len(original) + len(constants):
+                return None
+            counter = (*function.scope, function.name, "__spec")
+            specialisation = Function(function.namespace, f"__spec_{self.scope_counters[counter]}", [], function.scope + [function.name], return_type=function.return_type)
+            self.scope_counters[counter] += 1
+            self.commands[str(specialisation)] = commands
+            self.specialisations[cache_key] = specialisation
+        remaining = {param.name: args[param.name] for param in function.params
+                     if not isinstance(function.argument_slot(param), Scoreboard) or not isinstance(args[param.name], (IntConstant, FloatConstant))}
+        return specialisation, remaining, None
+
+    def pass_arguments(self, function: Function, args: dict[str, Any], target: Function = None):
+        # 调用约定：
+        # - score 参数写入被调函数的专用记分板槽位，每个参数一条 set/operation 命令，不涉及 NBT；
+        # - data 参数写入 storage <ns>:__call 中该函数的一个复合标签：全部常量参数合并为一条 set value，其余每个参数一条 set from / execute store，
+        #   然后以 function ... with storage 调用，被调函数中的宏行可直接使用 $(参数名)，也可按普通 data 变量读取。
+        # 参数槽位按函数固定分配，递归调用会覆盖外层调用的参数。
+        target = target or function
+        constants = {}
+        data_commands = []
+        for param in function.params:
+            if param.name not in args:
+                continue
+            value = args[param.name]
+            slot = function.argument_slot(param)
+            if isinstance(slot, Scoreboard):
+                self.op_scoreboard(slot, value, "=")
+            elif isinstance(value, Constant):
+                constants[param.name] = value
+            elif isinstance(value, StorageDataPath):
+                data_commands.append(DataModifyStorageSetFromStorageCommandGenerator(slot, value))
+            elif isinstance(value, Scoreboard):
+                data_commands.append(ExecuteRunCommandGenerator([ExecuteStoreResultStorageCommandGenerator(slot, "int" if value.scale == 1 else "double", 1 / value.scale if value.scale != 1 else 1)], ScoreboardPlayersGetCommandGenerator(value)))
+            else:
+                raise TypeError(f"Argument {param.name} of type {type(value)} cannot be passed as data")
+        if any(not isinstance(function.argument_slot(param), Scoreboard) for param in function.params):
+            if constants:
+                self.set_data(function.arguments_storage(), CompoundConstant(constants))
+            for command in data_commands:
+                self.add_command(command)
+            call = FunctionWithStorageCommandGenerator(target, function.arguments_storage())
+        else:
+            call = FunctionCommandGenerator(target)
+        if function.executor is not None:
+            # 方法调用：在接收者上执行
+            call = ExecuteRunCommandGenerator([ExecuteAsCommandGenerator(function.executor)], call)
+        self.add_command(call)
+
+    def declare_params(self, function: Function, params_ctx: MCCDPParser.ParamsContext | None):
+        if params_ctx is None:
+            return
+        for param_ctx, default in zip(params_ctx.param(), self.result[params_ctx]):
+            type_name = param_ctx.type_().getText()
+            param = FunctionArgument(param_ctx.ID().getText(), Scoreboard if type_name in SCORE_PARAM_TYPES else StorageDataPath, default)
+            function.params.append(param)
+            self.define(NamespacedID(self.namespace, param.name), function.argument_slot(param))
+
     def enter_scope(self, name=None):
+        if not self.scope and self.unit:
+            self.scope.append(self.unit)
         if name is None:
             number = self.scope_counters[tuple(self.scope)]
             self.scope_counters[tuple(self.scope)] += 1
@@ -114,33 +479,112 @@ class ListenerInterp(MCCDPListener):
             number = self.scope_counters[tuple(self.scope + [name])]
             self.scope_counters[tuple(self.scope + [name])] += 1
             self.scope += [name, str(number)]
+        self.push_function()
 
     def leave_scope(self):
         last = self.scope.pop()
         if last.isdigit() and len(self.scope) > 0:
             if not self.scope[-1].isdigit():
-                if self.scope[-1] in ["if", "for", "while", "withf"]:
+                if self.scope[-1] in ["if", "for", "while", "with"]:
                     self.scope.pop()
+        if self.unit and self.scope == [self.unit]:
+            self.scope.pop()
+        self.pop_function()
+
+    def define(self, namespaced_id: NamespacedID, value):
+        self.symbols.define(str(namespaced_id), value, replace=self.allow_redefinition)
+        self.definitions[(*self.scope, str(namespaced_id))] = value
+
+    def import_module(self, module):
+        for name, value in module.exports.items():
+            self.symbols.define(name, value)
+            if isinstance(value, Function):
+                self.imported_functions.add(str(value))
 
-    def get_lval(self, namespaced_id: NamespacedID, current_scope: list[str]):
-        current_scope = current_scope.copy()
+    def discard_function(self, function: Function):
+        key = str(function)
+        internal_prefix = f"{function.namespace}:{INTERNAL_PATH}{'.'.join(function.scope + [function.name])}."
+        for k in [k for k in self.commands if k == key or k.startswith(internal_prefix)]:
+            del self.commands[k]
+            self.redefined.add(k)
+        self.redefined.add(key)
+        for k in [k for k in self.scope_counters if k[:len(function.scope) + 1] == (*function.scope, function.name)]:
+            del self.scope_counters[k]
+        for functions in self.function_tags.values():
+            functions[:] = [f for f in functions if str(f) != key]
+        self.finished_functions.discard(key)
+        self.function_flags.pop(key, None)
+        self.partial_evaluator.purity.clear()
+
+    def checkpoint(self):
+        # 仅在根作用域（两条语句之间）有效，供交互式会话在语句出错时回滚
+        if self.scope:
+            raise RuntimeError("Checkpoints can only be taken at the root scope")
+        return (
+            {key: list(commands) for key, commands in self.commands.items()},
+            dict(self.definitions),
+            self.symbols.copy(),
+            dict(self.scope_counters),
+            {key: list(functions) for key, functions in self.function_tags.items()},
+            self.current_id,
+            set(self.finished_functions),
+            {key: set(flags) for key, flags in self.function_flags.items()},
+            dict(self.numeric_data),
+            dict(self.classes),
+            dict(self.dispatches),
+        )
+
+    def rollback(self, checkpoint):
+        commands, definitions, symbols, scope_counters, function_tags, current_id, finished_functions, function_flags, numeric_data, classes, dispatches = checkpoint
+        self.numeric_data = dict(numeric_data)
+        self.classes = dict(classes)
+        self.dispatches = dict(dispatches)
+        self.commands = defaultdict(list, {key: list(v) for key, v in commands.items()})
+        self.finished_functions = set(finished_functions)
+        self.function_flags = defaultdict(set, {key: set(flags) for key, flags in function_flags.items()})
+        self.partial_evaluator = PartialEvaluator(self.commands)
+        self.definitions = dict(definitions)
+        self.symbols = symbols.copy()
+        self.scope_counters = defaultdict(int, scope_counters)
+        self.function_tags = defaultdict(list, {key: list(v) for key, v in function_tags.items()})
+        self.current_id = current_id
+        self.scope = []
+        self.scope_ready = None
+        self.amend = False
+        self.affiliations.clear()
+        self.result.clear()
+        self.function_stack = []
+        self.defining = []
+        self.promotions = []
+        self.class_stack = []
+        self.update_current_function()
+
+    def get_lval(self, namespaced_id: NamespacedID):
         if namespaced_id.id in BUILT_IN_FUNCTIONS:
             return BUILT_IN_FUNCTIONS[namespaced_id.id]
-        while True:
-            definition_key = (*current_scope, str(namespaced_id))
-            if definition_key in self.definitions:
-                return self.definitions[definition_key]
-            if len(current_scope) == 0:
-                break
-            else:
-                current_scope.pop()
-        raise ValueError(f"Undefined variable {namespaced_id.id}")
+        value = self.symbols.resolve(str(namespaced_id))
+        if value is None:
+            raise ValueError(f"Undefined variable {namespaced_id.id}")
+        return value
 
     def enterEveryRule(self, ctx):
         # return
         if isinstance(ctx, MCCDPParser.StatementContext):
+            parent = ctx.parentCtx
+            if isinstance(parent, MCCDPParser.IfStmtContext) and ctx is parent.statement(0) and not isinstance(ctx, MCCDPParser.BlockStmtContext):
+                # 条件在外层函数中求值，单条语句的分支到这里才进入 if 作用域
+                self.enter_scope("if")
+            self.line = ctx.start.line
             self.add_command("# " + re.sub(r"\s+", " ", ctx.getText()))
 
+    def exitEveryRule(self, ctx):
+        # 父节点处理完毕后释放子节点的结果；顶层语句编译完成后连同自身的结果一起释放，语法树随之可以回收
+        if ctx.children:
+            for child in ctx.children:
+                self.result.pop(child, None)
+        if isinstance(ctx, MCCDPParser.StatementContext) and (ctx.parentCtx is None or isinstance(ctx.parentCtx, MCCDPParser.Start_Context)):
+            self.result.pop(ctx, None)
+
     def exitInt(self, ctx: MCCDPParser.IntContext):
         if ctx.INT_DEC() is not None:
             value = int(ctx.INT_DEC().getText())
@@ -154,6 +598,22 @@ class ListenerInterp(MCCDPListener):
             int_type = ""
         self.result[ctx] = IntConstant(value, int_type)
 
+    def exitReal(self, ctx: MCCDPParser.RealContext):
+        value = float(ctx.realValue().getText())
+        if ctx.typeProfix() is not None:
+            float_type = ctx.typeProfix().getText()
+        else:
+            float_type = ""
+        self.result[ctx] = FloatConstant(value, float_type)
+
+    def exitRange(self, ctx: MCCDPParser.RangeContext):
+        bounds = [None, None]
+        for number_ctx in ctx.signedNumber():
+            text = number_ctx.getText()
+            value = float(text) if "." in text or "e" in text.lower() else int(text)
+            bounds[0 if number_ctx.start.tokenIndex < ctx.DOT_DOT().symbol.tokenIndex else 1] = value
+        self.result[ctx] = Range(*bounds)
+
     def exitLiteral(self, ctx: MCCDPParser.LiteralContext):
         if ctx.getChild(0) in self.result:
             self.result[ctx] = self.result[ctx.getChild(0)]
@@ -163,20 +623,123 @@ class ListenerInterp(MCCDPListener):
                 value = ctx.STRING().getText()[1:-1]
                 self.result[ctx] = StringConstant(value)
                 return
+            elif ctx.BOOL() is not None:
+                self.result[ctx] = BooleanConstant(ctx.BOOL().getText() == "true")
+                return
         raise NotImplementedError("Unsupported literal")
 
+    def constant_items(self, expr_list_ctx: MCCDPParser.ExprListContext | None) -> list[Constant]:
+        if expr_list_ctx is None:
+            return []
+        items = self.result[expr_list_ctx]
+        for item in items:
+            if not isinstance(item, Constant):
+                raise NotImplementedError(f"Non-constant value {item} in NBT literal is not supported")
+        return items
+
+    def exitExprList(self, ctx: MCCDPParser.ExprListContext):
+        self.result[ctx] = [self.result[expr_ctx] for expr_ctx in ctx.expr()]
+
+    def exitArg(self, ctx: MCCDPParser.ArgContext):
+        self.result[ctx] = (ctx.ID().getText() if ctx.ID() is not None else None, self.result[ctx.expr()])
+
+    def exitArgList(self, ctx: MCCDPParser.ArgListContext):
+        self.result[ctx] = [self.result[arg_ctx] for arg_ctx in ctx.arg()]
+
+    def exitPair(self, ctx: MCCDPParser.PairContext):
+        key = ctx.ID().getText() if ctx.ID() is not None else ctx.STRING().getText()[1:-1]
+        self.result[ctx] = (key, self.result[ctx.expr()])
+
+    def exitPairList(self, ctx: MCCDPParser.PairListContext):
+        self.result[ctx] = [self.result[pair_ctx] for pair_ctx in ctx.pair()]
+
+    def exitParam(self, ctx: MCCDPParser.ParamContext):
+        self.result[ctx] = self.result[ctx.expr()] if ctx.expr() is not None else None
+
+    def exitParams(self, ctx: MCCDPParser.ParamsContext):
+        self.result[ctx] = [self.result[param_ctx] for param_ctx in ctx.param()]
+
+    def exitScalingFactor(self, ctx: MCCDPParser.ScalingFactorContext):
+        self.result[ctx] = self.result[ctx.expr()]
+
     def exitAtom(self, ctx: MCCDPParser.AtomContext):
         if ctx.literal() is not None:
             self.result[ctx] = self.result[ctx.literal()]
+        elif ctx.getChild(0).getText() == "{":
+            value = {}
+            pair_list_ctx: MCCDPParser.PairListContext = ctx.pairList()
+            if pair_list_ctx is not None:
+                for key, item in self.result[pair_list_ctx]:
+                    if not isinstance(item, Constant):
+                        raise NotImplementedError(f"Non-constant value {item} in NBT literal is not supported")
+                    value[key] = item
+            self.result[ctx] = CompoundConstant(value)
+        elif ctx.getChildCount() > 2 and ctx.getChild(2).getText() == ";":
+            items = self.constant_items(ctx.exprList())
+            for item in items:
+                if not isinstance(item, IntConstant):
+                    raise TypeError(f"Array elements should be integers, not {type(item)}")
+            self.result[ctx] = ArrayConstant(items, ctx.getChild(1).getText())
+        else:
+            self.result[ctx] = ListConstant(self.constant_items(ctx.exprList()))
+
+    def in_class_body(self, ctx: MCCDPParser.DefineStatementContext | MCCDPParser.FunctionStatementContext) -> bool:
+        return isinstance(ctx.parentCtx, (MCCDPParser.ClassStatementContext, MCCDPParser.InterfaceStatementContext))
+
+    def declare_field(self, namespaced_id: NamespacedID, field_type: type, default, scale: int | float = 1):
+        # 字段的初值只能是常量，在构造时由 __init 函数写入
+        class_type = self.class_stack[-1][0]
+        name = namespaced_id.id
+        if class_type.is_interface:
+            raise ValueError(f"Interface {class_type} cannot declare field {name}")
+        if name in class_type.fields:
+            raise ValueError(f"Field {name} is already defined in {class_type}")
+        if field_type is Scoreboard:
+            if default is not None and not isinstance(default, (IntConstant, FloatConstant)):
+                raise ValueError(f"Default value of score field {name} should be a numeric constant")
+            field = Scoreboard(self.namespace, f"__field{class_type.score_fields()}", [], "@s", scale)
+        else:
+            if default is not None and not isinstance(default, Constant):
+                raise ValueError(f"Default value of data field {name} should be a constant")
+            field = EntityDataPath(Selector("s"), name)
+            if isinstance(default, IntConstant) and default.type in NBT_INT_TYPES:
+                nbt_type = NBT_INT_TYPES[default.type]
+                if self.numeric_data.setdefault(str(field), nbt_type) != nbt_type:
+                    raise TypeError(f"Data field {name} is declared with different types in different classes")
+        class_type.fields[name] = field
+        if default is not None:
+            class_type.defaults[name] = default
+        self.define(namespaced_id, field)
 
     def exitDataStmt(self, ctx: MCCDPParser.DataStmtContext):
-        super().exitDataStmt(ctx)
+        namespaced_id = self.analyse_namespaced_id(ctx.namespacedId())
+        if self.in_class_body(ctx):
+            self.declare_field(namespaced_id, EntityDataPath, self.result[ctx.expr()] if ctx.expr() is not None else None)
+            return
+        data = self.global_storage(self.scope, namespaced_id.id, namespaced_id.namespace)
+        self.define(namespaced_id, data)
+        if ctx.expr() is not None:
+            value = self.result[ctx.expr()]
+            if isinstance(value, IntConstant) and value.type in NBT_INT_TYPES:
+                self.numeric_data[str(data)] = NBT_INT_TYPES[value.type]
+            self.assign_data(data, self.numeric_value(value))
+
+    def assign_data(self, data: StorageDataPath, value):
+        if isinstance(value, Constant):
+            self.set_data(data, value)
+        elif isinstance(value, Scoreboard) and str(data) in self.numeric_data:
+            self.store_data(data, value)
+        else:
+            raise NotImplementedError(f"Assigning {type(value)} to data is not supported.")
 
     def exitAtomExpr(self, ctx: MCCDPParser.AtomExprContext):
         self.result[ctx] = self.result[ctx.atom()]
 
     def exitLval(self, ctx: MCCDPParser.LvalContext):
-        self.result[ctx] = self.get_lval(self.analyse_namespaced_id(ctx.namespacedId()), current_scope=self.scope)
+        value = self.get_lval(self.analyse_namespaced_id(ctx.namespacedId()))
+        if isinstance(value, StorageDataPath) and self.promotions and str(value) in self.promotions[-1][0]:
+            value = self.register(value)
+        self.result[ctx] = value
 
     def exitLvalExpr(self, ctx: MCCDPParser.LvalExprContext):
         self.result[ctx] = self.result[ctx.lval()]
@@ -185,36 +748,20 @@ class ListenerInterp(MCCDPListener):
         expr1_ctx: MCCDPParser.ExprContext = ctx.expr(0)
         expr2_ctx: MCCDPParser.ExprContext = ctx.expr(1)
         op = ctx.getChild(1).getText()
-        result1 = self.result[expr1_ctx]
-        result2 = self.result[expr2_ctx]
-        if isinstance(result1, IntConstant) and isinstance(result2, IntConstant):
-            if op == "+":
-                self.result[ctx] = IntConstant(result1.value + result2.value)
-            elif op == "-":
-                self.result[ctx] = IntConstant(result1.value - result2.value)
-            else:
-                raise ValueError(f"Unknown operator {op}")
-        if isinstance(result1, Scoreboard) and isinstance(result2, IntConstant):
-            if op == "+":
-                intermediate = self.create_intermediate()
-                intermediate_scoreboard = self.intermediate_scoreboard(intermediate, result1.scale)
-                self.op_scoreboard(intermediate_scoreboard, result1, "=")
-                self.add_scoreboard(intermediate_scoreboard, result2.value)
-                self.result[ctx] = intermediate_scoreboard
-            elif op == "-":
-                intermediate = self.create_intermediate()
-                intermediate_scoreboard = self.intermediate_scoreboard(intermediate, result1.scale)
-                self.op_scoreboard(intermediate_scoreboard, result1, "=")
-                self.remove_scoreboard(intermediate_scoreboard, result2.value)
-                self.result[ctx] = intermediate_scoreboard
-            else:
-                raise ValueError(f"Unknown operator {op}")
+        self.result[ctx] = self.arithmetic(self.result[expr1_ctx], self.result[expr2_ctx], op)
+
+    def exitMultiplicativeExpr(self, ctx: MCCDPParser.MultiplicativeExprContext):
+        op = ctx.getChild(1).getText()
+        self.result[ctx] = self.arithmetic(self.result[ctx.expr(0)], self.result[ctx.expr(1)], op)
+
+    def exitParenExpr(self, ctx: MCCDPParser.ParenExprContext):
+        self.result[ctx] = self.result[ctx.expr()]
 
     def exitScoreStmt(self, ctx: MCCDPParser.ScoreStmtContext):
         scaling_factor_ctx: MCCDPParser.ScalingFactorContext | None = ctx.scalingFactor()
         if scaling_factor_ctx is not None:
             if scaling_factor_ctx.expr() is not None:
-                scaling_factor_expr_ctx = self.result[scaling_factor_ctx.expr()]
+                scaling_factor_expr_ctx = self.result[scaling_factor_ctx]
                 if isinstance(scaling_factor_expr_ctx, IntConstant):
                     scaling_factor = scaling_factor_expr_ctx.value
                 elif isinstance(scaling_factor_expr_ctx, FloatConstant):
@@ -231,15 +778,18 @@ class ListenerInterp(MCCDPListener):
         id1 = namespaced_id.id
         expr_ctx: MCCDPParser.ExprContext = ctx.expr()
         if expr_ctx is not None:
-            expr_result = self.result[expr_ctx]
+            expr_result = self.numeric_value(self.result[expr_ctx])
         else:
             expr_result = None
+        if self.in_class_body(ctx):
+            self.declare_field(namespaced_id, Scoreboard, expr_result, scaling_factor)
+            return
         scoreboard = self.global_scoreboard(self.scope, id1, scaling_factor, namespace)
-        self.definitions[(*self.scope, str(namespaced_id))] = scoreboard
-        if isinstance(expr_result, IntConstant):
-            self.set_scoreboard(scoreboard, expr_result.value)
-        elif isinstance(expr_result, Scoreboard):
+        self.define(namespaced_id, scoreboard)
+        if isinstance(expr_result, (IntConstant, FloatConstant, Scoreboard)):
             self.op_scoreboard(scoreboard, expr_result, "=")
+        elif expr_result is not None:
+            raise NotImplementedError(f"Assigning {type(expr_result)} to scoreboard is not supported.")
 
     def analyse_namespaced_id(self, ctx: MCCDPParser.NamespacedIdContext | MCCDPParser.NamespacedIdSingleColonContext):
         if ctx.getChildCount() == 1:
@@ -253,17 +803,186 @@ class ListenerInterp(MCCDPListener):
     def enterFunctionStatement(self, ctx: MCCDPParser.FunctionStatementContext):
         name_ctx: MCCDPParser.NamespacedIdContext = ctx.namespacedId()
         name = self.analyse_namespaced_id(name_ctx)
-        decorator_ctx: MCCDPParser.DecoratorContext = ctx.decorator()
-        if decorator_ctx is not None:
-            function_tag = self.analyse_namespaced_id(decorator_ctx.namespacedIdSingleColon())
-            self.function_tags[str(function_tag)].append(Function(name.namespace, name.id, [], self.scope))
+        function = Function(name.namespace, name.id, [], list(self.scope))
+        if ctx.typeDecl() is not None:
+            return_type = ctx.typeDecl().type_().getText()
+            if return_type not in SCORE_PARAM_TYPES:
+                raise NotImplementedError(f"Return type {return_type} is not supported")
+            function.return_type = Scoreboard
+        previous = self.symbols.resolve(str(name))
+        if self.allow_redefinition and isinstance(previous, Function) and str(previous) == str(function):
+            self.discard_function(previous)
+        is_method = self.in_class_body(ctx)
+        decorator_ctx: MCCDPParser.DecoratorContext
+        for decorator_ctx in ctx.decorator():
+            name_ctx = decorator_ctx.namespacedIdSingleColon()
+            if name_ctx.getText() in BUILT_IN_DECORATORS:
+                self.function_flags[str(function)].add(name_ctx.getText())
+            elif is_method:
+                raise ValueError(f"Method {name.id} cannot be added to function tag {name_ctx.getText()}")
+            else:
+                function_tag = self.analyse_namespaced_id(name_ctx)
+                self.function_tags[str(function_tag)].append(function)
         self.scope_ready = name.id
-        self.definitions[(*self.scope, str(name))] = Function(name.namespace, name.id, [], self.scope)
+        self.function_ready = (function, ctx.params())
+        if is_method:
+            self.declare_method(name, function)
+        else:
+            self.define(name, function)
+
+    def overridden_methods(self, class_type: ClassType, name: str) -> dict[tuple[str, ...], Function]:
+        # 父类型中同名方法的声明，按参数槽位去重；同一方法的所有实现共用槽位
+        methods = {}
+        for supertype in class_type.supertypes():
+            method = supertype.find_method(name)
+            if method is not None:
+                methods.setdefault(tuple(method.slot_path()), method)
+        return methods
+
+    def declare_method(self, name: NamespacedID, function: Function):
+        class_type, inherited = self.class_stack[-1]
+        if name.id in class_type.methods or name.id in class_type.fields:
+            raise ValueError(f"Member {name.id} is already defined in {class_type}")
+        overridden = self.overridden_methods(class_type, name.id)
+        if len(overridden) > 1:
+            raise NotImplementedError(f"Method {name.id} of {class_type} overrides unrelated declarations {', '.join(str(method) for method in overridden.values())}")
+        if overridden:
+            method = next(iter(overridden.values()))
+            if method.return_type is not function.return_type:
+                raise TypeError(f"Method {function} should have the same return type as {method}")
+            function.slots = method.slot_path()
+        else:
+            function.slots = [class_type.name, name.id]
+        class_type.methods[name.id] = function
+        # 方法名在类中表示 this 上的虚调用
+        self.symbols.define(str(name), BoundMethod(ObjectReference(Selector("s"), class_type), name.id), replace=name.id in inherited)
+        self.definitions[(*self.scope, str(name))] = function
+
+    def exitFunctionStatement(self, ctx: MCCDPParser.FunctionStatementContext):
+        if not self.in_class_body(ctx):
+            return
+        class_type = self.class_stack[-1][0]
+        function = class_type.methods[self.analyse_namespaced_id(ctx.namespacedId()).id]
+        for method in self.overridden_methods(class_type, function.name).values():
+            if [(param.name, param.type) for param in function.params] != [(param.name, param.type) for param in method.params]:
+                raise TypeError(f"Method {function} should have the same parameters as {method}")
+
+    def enter_class(self, ctx: MCCDPParser.ClassStatementContext | MCCDPParser.InterfaceStatementContext, is_interface: bool):
+        # 类体是一个符号作用域：字段和方法名，以及表示当前实例的 this；继承的成员预先定义，方法可以被覆盖
+        if self.scope or self.class_stack:
+            raise NotImplementedError("Classes can only be declared at the top level")
+        name = self.analyse_namespaced_id(ctx.namespacedId(0))
+        supertypes = defaultdict(list)
+        keyword = None
+        for child in ctx.getChildren():
+            if isinstance(child, MCCDPParser.NamespacedIdContext) and keyword is not None:
+                supertype = self.get_lval(self.analyse_namespaced_id(child))
+                if not isinstance(supertype, ClassType):
+                    raise TypeError(f"{child.getText()} is not a class or interface")
+                if supertype.is_interface != (is_interface or keyword == "implements"):
+                    raise TypeError(f"{name.id} cannot {keyword} {'interface' if supertype.is_interface else 'class'} {supertype}")
+                supertypes[keyword].append(supertype)
+            elif child.getText() in ("extends", "implements"):
+                keyword = child.getText()
+        if is_interface:
+            class_type = ClassType(name.namespace, name.id, None, supertypes["extends"], True)
+        else:
+            parent = supertypes["extends"][0] if supertypes["extends"] else None
+            class_type = ClassType(name.namespace, name.id, parent, supertypes["implements"])
+        self.define(name, class_type)
+        self.classes[str(class_type)] = class_type
+        self.scope.append(name.id)
+        self.symbols.push()
+        this = ObjectReference(Selector("s"), class_type)
+        self.symbols.define(str(NamespacedID(self.namespace, "this")), this)
+        inherited = set()
+        for field_name, field in class_type.fields.items():
+            self.symbols.define(str(NamespacedID(self.namespace, field_name)), field)
+            inherited.add(field_name)
+        for ancestor in class_type.ancestors()[1:]:
+            for method_name in ancestor.methods:
+                if method_name not in inherited:
+                    self.symbols.define(str(NamespacedID(self.namespace, method_name)), BoundMethod(this, method_name))
+                    inherited.add(method_name)
+        self.class_stack.append((class_type, inherited))
+
+    def exit_class(self):
+        self.class_stack.pop()
+        self.symbols.pop()
+        self.scope.pop()
+
+    def enterClassStatement(self, ctx: MCCDPParser.ClassStatementContext):
+        if ctx.decorator() is not None:
+            raise NotImplementedError("Decorators on classes are not supported")
+        self.enter_class(ctx, False)
+
+    def exitClassStatement(self, ctx: MCCDPParser.ClassStatementContext):
+        self.exit_class()
+
+    def enterInterfaceStatement(self, ctx: MCCDPParser.InterfaceStatementContext):
+        self.enter_class(ctx, True)
+
+    def exitInterfaceStatement(self, ctx: MCCDPParser.InterfaceStatementContext):
+        self.exit_class()
+
+    def instances(self, class_type: ClassType) -> ObjectReference:
+        return ObjectReference(Selector("e", [SelectorArgument("tag", StringConstant(class_type.tag()))]), class_type)
+
+    def member(self, reference: ObjectReference, name: str):
+        class_type = reference.class_type
+        field = class_type.fields.get(name)
+        if field is None:
+            if class_type.find_method(name) is None:
+                raise ValueError(f"{class_type} has no member {name}")
+            return BoundMethod(reference, name)
+        if reference.is_executor():
+            return field
+        if isinstance(field, Scoreboard):
+            return Scoreboard(field.namespace, field.objective, [], str(reference.selector), field.scale)
+        data = EntityDataPath(reference.selector, name)
+        if str(field) in self.numeric_data:
+            self.numeric_data[str(data)] = self.numeric_data[str(field)]
+        return data
+
+    def call_method(self, method: BoundMethod, args: dict[str, Any]):
+        # 调用静态类型的分派函数，生成数据包时再按类层次去虚化或生成分派树；接收者不是 @s 时以 execute as 在接收者上执行
+        receiver = method.receiver
+        dispatch = dispatch_function(receiver.class_type, receiver.class_type.find_method(method.name), method.name,
+                                     None if receiver.is_executor() else receiver.selector)
+        self.dispatches[str(dispatch)] = (str(receiver.class_type), method.name)
+        return self.call_function(dispatch, args)
+
+    def construct(self, class_type: ClassType, args: dict) -> ObjectReference:
+        # 构造：把选中的实体（默认为 @s）初始化为类的实例
+        if class_type.is_interface:
+            raise TypeError(f"Cannot instantiate interface {class_type}")
+        if set(args) - {0}:
+            raise TypeError(f"Constructor of {class_type} takes a single entity")
+        target = args.get(0, Selector("s"))
+        if isinstance(target, ObjectReference):
+            target = target.selector
+        if not isinstance(target, Selector):
+            raise TypeError(f"Cannot instantiate {class_type} on {type(target)}")
+        reference = ObjectReference(target, class_type)
+        command = FunctionCommandGenerator(init_function(class_type))
+        if not reference.is_executor():
+            command = ExecuteRunCommandGenerator([ExecuteAsCommandGenerator(target)], command)
+        self.add_command(command)
+        return reference
 
     def enterBlock(self, ctx: MCCDPParser.BlockContext):
         if self.scope_ready is not None:
             if isinstance(ctx.parentCtx, MCCDPParser.FunctionStatementContext):
+                function = self.function_ready[0]
                 self.scope += [self.scope_ready]
+                self.push_function()
+                self.defining.append(function)
+                self.declare_params(*self.function_ready)
+                self.function_ready = None
+                # 被提升的 data 变量在函数开头读入寄存器，函数结束时写回被赋值的变量
+                self.promotions.append(self.promotion_candidates(function, ctx))
+                for data in self.promotions[-1][0].values():
+                    self.load_data(data, self.register(data))
             else:
                 self.enter_scope(self.scope_ready)
             self.scope_ready = None
@@ -271,10 +990,37 @@ class ListenerInterp(MCCDPListener):
             self.enter_scope()
 
     def exitBlock(self, ctx: MCCDPParser.BlockContext):
-        self.result[ctx] = Function(self.namespace, self.scope[-1], [], self.scope[:-1])
-        if ctx not in self.affiliations:
+        self.result[ctx] = self.current_function
+        if isinstance(ctx.parentCtx, MCCDPParser.FunctionStatementContext):
+            promoted, written = self.promotions.pop()
+            for key, data in promoted.items():
+                if key in written:
+                    self.store_data(data, self.register(data))
+            self.finished_functions.add(str(self.defining.pop()))
+        if ctx in self.affiliations:
+            self.affiliations.discard(ctx)
+        else:
             self.leave_scope()
 
+    def exitReturnStmt(self, ctx: MCCDPParser.ReturnStmtContext):
+        # 返回值写入函数作用域下的 __return 槽位，由调用方复制到中间量；只支持函数体顶层的 return
+        if not self.defining:
+            raise ValueError("Return outside of a function")
+        function = self.defining[-1]
+        if self.current_key != str(function):
+            raise NotImplementedError("Returning from a nested block is not supported")
+        if ctx.expr() is None:
+            if function.return_type is not None:
+                raise TypeError(f"Function {function} should return a value")
+            return
+        if function.return_type is None:
+            raise TypeError(f"Function {function} does not declare a return type")
+        value = self.result[ctx.expr()]
+        if isinstance(value, (IntConstant, FloatConstant, Scoreboard)):
+            self.op_scoreboard(function.return_slot(), value, "=")
+        else:
+            raise TypeError(f"Cannot return {type(value)} from function {function}")
+
     def exitBlockStmt(self, ctx: MCCDPParser.BlockStmtContext):
         self.result[ctx] = self.result[ctx.block()]
 
@@ -286,40 +1032,47 @@ class ListenerInterp(MCCDPListener):
         final_args = {}
         arg_ctx: MCCDPParser.ArgContext
         if args_ctx is not None:
-            for i, arg_ctx in enumerate(args_ctx.children):
-                if arg_ctx.ID() is not None:
-                    args[arg_ctx.ID().getText()] = self.result[arg_ctx.expr()]
-                else:
-                    args[i] = self.result[arg_ctx.expr()]
-        executor = None
-        if isinstance(to_call, Function):
-            for i, param in enumerate(to_call.params):
+            for i, (name, value) in enumerate(self.result[args_ctx]):
+                args[name if name is not None else i] = value
+        if isinstance(to_call, ClassType):
+            self.result[ctx] = self.construct(to_call, args)
+            return
+        signature = to_call
+        if isinstance(to_call, BoundMethod):
+            signature = to_call.receiver.class_type.find_method(to_call.name)
+        if isinstance(signature, Function):
+            for i, param in enumerate(signature.params):
                 if args.get(param.name) is not None:
-                    if param.type is not Any and not isinstance(args[param.name], param.type):
+                    if not param.accepts(args[param.name]):
                         raise TypeError(f"Argument {param.name} should be of type {param.type}, not {type(args[param.name])}")
                     else:
                         final_args[param.name] = args[param.name]
                 elif args.get(i) is not None:
-                    if param.type is not Any and not isinstance(args[i], param.type):
+                    if not param.accepts(args[i]):
                         raise TypeError(f"Argument {param.name} should be of type {param.type}, not {type(args[i])}")
                     else:
                         final_args[param.name] = args[i]
                 else:
                     final_args[param.name] = None
 
-            self.result[ctx] = self.call_function(to_call, final_args)
+            if isinstance(to_call, BoundMethod):
+                self.result[ctx] = self.call_method(to_call, final_args)
+            else:
+                self.result[ctx] = self.call_function(to_call, final_args)
 
     def exitSelector(self, ctx: MCCDPParser.SelectorContext):
         variant = ctx.getChild(0).getText()[1:]
         args_ctx: MCCDPParser.ArgListContext = ctx.argList()
         args: list[SelectorArgument] = []
         if args_ctx is not None:
-            for i, arg_ctx in enumerate(args_ctx.children):
-                if arg_ctx.ID() is not None:
-                    args.append(SelectorArgument(arg_ctx.ID().getText(), self.result[arg_ctx.expr()]))
-                else:
-                    args.append(SelectorArgument(i, self.result[arg_ctx.expr()]))
-        self.result[ctx] = Selector(variant, args)
+            for arg_ctx, (name, value) in zip(args_ctx.arg(), self.result[args_ctx]):
+                if name is None:
+                    raise ValueError(f"Selector arguments should be named: {arg_ctx.getText()}")
+                args.append(SelectorArgument(name, value))
+        selector = Selector(variant, args)
+        if self.has_flag(self.current_key, "optimize_selectors"):
+            selector = optimize_selector(selector)
+        self.result[ctx] = selector
 
     def exitSelectorExpr(self, ctx: MCCDPParser.SelectorExprContext):
         self.result[ctx] = self.result[ctx.selector()]
@@ -328,8 +1081,8 @@ class ListenerInterp(MCCDPListener):
         expr1_ctx: MCCDPParser.ExprContext = ctx.expr(0)
         expr2_ctx: MCCDPParser.ExprContext = ctx.expr(1)
         op = ctx.getChild(1).getText()
-        result1 = self.result[expr1_ctx]
-        result2 = self.result[expr2_ctx]
+        result1 = self.numeric_value(self.result[expr1_ctx])
+        result2 = self.numeric_value(self.result[expr2_ctx])
         if isinstance(result1, Scoreboard) and isinstance(result2, Scoreboard):
             self.result[ctx] = ScoreCompare(result1, result2, op)
         elif isinstance(result1, IntConstant) and isinstance(result2, IntConstant):
@@ -377,30 +1130,18 @@ class ListenerInterp(MCCDPListener):
     def enterIfStmt(self, ctx: MCCDPParser.IfStmtContext):
         if isinstance(ctx.statement(0), MCCDPParser.BlockStmtContext):
             self.scope_ready = "if"
-        else:
-            self.enter_scope("if")
 
     def exitIfStmt(self, ctx: MCCDPParser.IfStmtContext):
         condition_ctx: MCCDPParser.ExprContext = ctx.expr()
         condition = self.result[condition_ctx]
         statement_ctx: MCCDPParser.StatementContext = ctx.statement(0)
         if not isinstance(statement_ctx, MCCDPParser.BlockStmtContext):
-            scope = self.scope.copy()
+            function = self.current_function
             self.leave_scope()
-            key = str(Function.from_whole_path(self.namespace, scope))
-            if len(self.commands[key]) == 0:
-                del self.commands[key]
-                return
-            elif len(self.commands[key]) == 1:
-                command = self.commands[key][0]
-                del self.commands[key]
-            else:
-                function = Function.from_whole_path(self.namespace, scope, [])
-                command = FunctionCommandGenerator(function)
         else:
-            statement = self.result[statement_ctx]
-            function = statement
-            command = FunctionCommandGenerator(function)
+            function = self.result[statement_ctx]
+        # 分支总是单独的函数，只有一条命令的分支由 inline_blocks 内联
+        command = FunctionCommandGenerator(function)
         if isinstance(condition, ScoreCompare):
             self.add_command(ExecuteRunCommandGenerator([ExecuteIfScoreCompareCommandGenerator(condition.score1, condition.score2, condition.operation)], command))
         elif isinstance(condition, BooleanConstant):
@@ -408,6 +1149,8 @@ class ListenerInterp(MCCDPListener):
                 self.add_command(command)
         elif isinstance(condition, ScoreMatch):
             self.add_command(ExecuteRunCommandGenerator([ExecuteIfScoreMatchCommandGenerator(condition.score, condition.range)], command))
+        elif isinstance(condition, EntityMatch):
+            self.add_command(ExecuteRunCommandGenerator([ExecuteIfEntityCommandGenerator(condition.selector)], command))
         else:
             raise NotImplementedError(f"Condition of type {type(condition)} is not supported")
 
@@ -422,6 +1165,12 @@ class ListenerInterp(MCCDPListener):
                 self.add_scoreboard(lval, 1)
             elif ctx.getChild(1).getText() == "--":
                 self.remove_scoreboard(lval, 1)
+        elif isinstance(lval, StorageDataPath) and str(lval) in self.numeric_data:
+            self.result[ctx] = self.load_data(lval)
+            updated = self.intermediate_scoreboard(self.create_intermediate())
+            self.op_scoreboard(updated, self.result[ctx], "=")
+            self.add_scoreboard(updated, 1 if ctx.getChild(1).getText() == "++" else -1)
+            self.store_data(lval, updated)
 
     def exitPreIncDecExpr(self, ctx: MCCDPParser.PreIncDecExprContext):
         expr_ctx: MCCDPParser.LvalContext = ctx.expr()
@@ -432,22 +1181,53 @@ class ListenerInterp(MCCDPListener):
             elif ctx.getChild(0).getText() == "--":
                 self.remove_scoreboard(lval, 1)
             self.result[ctx] = lval
+        elif isinstance(lval, StorageDataPath) and str(lval) in self.numeric_data:
+            self.result[ctx] = self.load_data(lval)
+            self.add_scoreboard(self.result[ctx], 1 if ctx.getChild(0).getText() == "++" else -1)
+            self.store_data(lval, self.result[ctx])
 
     def exitAssignExpr(self, ctx: MCCDPParser.AssignExprContext):
         lval_ctx: MCCDPParser.LvalContext = ctx.expr(0)
         lval = self.result[lval_ctx]
         expr_ctx: MCCDPParser.ExprContext = ctx.expr(1)
         expr = self.result[expr_ctx]
+        op = ctx.getChild(1).getText()
         if isinstance(lval, Scoreboard):
-            if isinstance(expr, IntConstant):
-                self.set_scoreboard(lval, expr.value)
-            elif isinstance(expr, Scoreboard):
-                self.op_scoreboard(lval, expr, "=")
+            expr = self.numeric_value(expr)
+            if isinstance(expr, (IntConstant, FloatConstant, Scoreboard)):
+                self.op_scoreboard(lval, expr, op)
             else:
                 raise NotImplementedError(f"Assigning {type(expr)} to scoreboard is not supported.")
+        elif isinstance(lval, StorageDataPath):
+            if op != "=":
+                if str(lval) not in self.numeric_data:
+                    raise NotImplementedError(f"Compound assignment {op} to data is not supported.")
+                expr = self.arithmetic(lval, expr, op[0])
+            self.assign_data(lval, self.numeric_value(expr))
+        self.result[ctx] = lval
 
     def exitMemberExpr(self, ctx: MCCDPParser.MemberExprContext):
-        pass
+        value = self.result[ctx.expr()]
+        if isinstance(value, ClassType):
+            value = self.instances(value)
+        if not isinstance(value, ObjectReference):
+            raise NotImplementedError(f"Member access on {type(value)} is not supported")
+        self.result[ctx] = self.member(value, ctx.member().ID().getText())
+
+    def exitInstanceofExpr(self, ctx: MCCDPParser.InstanceofExprContext):
+        value = self.result[ctx.expr()]
+        class_type = self.get_lval(NamespacedID(self.namespace, ctx.type_().getText()))
+        if not isinstance(class_type, ClassType):
+            raise TypeError(f"{ctx.type_().getText()} is not a class or interface")
+        if isinstance(value, ObjectReference):
+            if value.class_type.is_subtype(class_type):
+                # 静态类型已经是目标类型的子类型，只需判断实体是否存在
+                self.result[ctx] = BooleanConstant(True) if value.is_executor() else EntityMatch(value.selector)
+                return
+            value = value.selector
+        if not isinstance(value, Selector):
+            raise TypeError(f"instanceof requires an entity, not {type(value)}")
+        self.result[ctx] = EntityMatch(Selector(value.variant, value.args + [SelectorArgument("tag", StringConstant(class_type.tag()))]))
 
     def enterWithStmt(self, ctx: MCCDPParser.WithStmtContext):
         statement_ctx: MCCDPParser.StatementContext = ctx.statement()
@@ -456,31 +1236,88 @@ class ListenerInterp(MCCDPListener):
         self.enter_scope("with")
 
     def exitWithStmt(self, ctx: MCCDPParser.WithStmtContext):
-        function = Function.from_whole_path(self.namespace, self.scope, [])
+        function = self.current_function
         self.leave_scope()
-        commands = self.commands[str(function)]
-        if len(commands) == 0:
-            del self.commands[str(function)]
-            return
-        elif len(commands) == 1:
-            command = commands[0]
-            del self.commands[str(function)]
-        else:
-            command = FunctionCommandGenerator(function)
+        command = FunctionCommandGenerator(function)
         expr_ctx = ctx.expr()
         expr = self.result[expr_ctx]
+        if isinstance(expr, ClassType):
+            expr = self.instances(expr)
+        if isinstance(expr, ObjectReference):
+            expr = expr.selector
         if isinstance(expr, Selector):
             self.add_command(ExecuteRunCommandGenerator([ExecuteAsCommandGenerator(expr)], command))
         elif isinstance(expr, ExecuteAtModifier):
             self.add_command(ExecuteRunCommandGenerator([ExecuteAtCommandGenerator(expr.selector)], command))
 
-    def exitStart_(self, ctx: MCCDPParser.Start_Context):
-        # 后处理
+    def has_flag(self, key: str, flag: str) -> bool:
+        # 装饰器选项同时作用于函数本身及其内部子函数（if、with 等块）
+        for function_key, flags in self.function_flags.items():
+            if flag in flags:
+                namespace, path = function_key.split(":", 1)
+                if key == function_key or key.startswith(f"{namespace}:{INTERNAL_PATH}{path.removeprefix(INTERNAL_PATH)}."):
+                    return True
+        return False
+
+    def select_caches(self, functions: dict[str, FunctionIR]) -> dict[str, FunctionIR]:
+        return {key: FunctionIR.from_commands(key, cache_selectors(function.commands(), key)) if self.has_flag(key, "cache_selectors") else function
+                for key, function in functions.items()}
+
+    def add_entrance(self, functions: dict[str, FunctionIR]) -> dict[str, FunctionIR]:
+        # 入口函数的第一个基本块开头创建记分项并初始化常量槽位
+        key = str(Function(self.namespace, ENTRANCE_FUNCTION, [], []))
+        functions = dict(functions)
+        entrance = functions.get(key) or FunctionIR.from_commands(key, [])
+        setup = [ScoreboardObjectivesAddCommandGenerator(self.namespace, "__global", "dummy", f'"{self.namespace} globals"')] + \
+            class_objectives(self.namespace, self.classes) + \
+            [ScoreboardPlayersSetCommandGenerator(self.constant_scoreboard(value), value) for value in sorted(self.constants)]
+        functions[key] = FunctionIR(key, [BasicBlock(setup + entrance.blocks[0].commands)] + entrance.blocks[1:])
+        return functions
+
+    def drop_empty_calls(self, functions: dict[str, FunctionIR], function_tags: dict[str, list[str]]) -> dict[str, FunctionIR]:
+        # 没有命令的函数不生成文件，删除对它们的调用；带参数或 store 的调用、函数标签和宏行引用的函数保留为空函数
+        prefix = f"{self.namespace}:"
+        references = [callee for function in functions.values() for callee in function.calls()]
+        kept = {value for values in function_tags.values() for value in values}
+        empty = {key: None for key in [*references, *kept] if key.startswith(prefix) and key not in functions and key not in self.imported_functions}
+        if not empty:
+            return functions
+        kept &= empty.keys()
+        macros = [macro for function in functions.values() for macro in function.macros()]
+        kept.update(key for key in empty if any(key in macro for macro in macros))
+
+        def replace(command):
+            callee = called_function(command)
+            replacement = inline_call(command, empty) if callee not in kept else command
+            if replacement is command and callee in empty:
+                kept.add(callee)
+            return replacement
+
+        result = {key: function.replace_calls(replace) for key, function in functions.items()}
+        result.update((key, FunctionIR.from_commands(key, [])) for key in kept)
+        return result
+
+    def create_pass_manager(self, function_tags: dict[str, list[str]]) -> PassManager:
+        # 降级 pass 总是执行，之后是按优化级别启用的优化
+        manager = PassManager(self.opt_level)
+        manager.add("promotion_syncs", self.resolve_promotion_syncs, program=True)
+        manager.add("cache_selectors", self.select_caches, program=True)
+        manager.add("lower_classes", lambda functions: lower_classes(functions, self.classes, self.dispatches), program=True)
+        manager.add("entrance", self.add_entrance, program=True)
+        manager.add("drop_empty_calls", lambda functions: self.drop_empty_calls(functions, function_tags), program=True)
+        add_optimizations(manager, function_tags)
+        return manager
+
+    def to_datapack(self) -> Datapack:
+        # 后处理（除了记录各个 pass 的耗时，不修改自身状态，可重复调用）
         entrance_function = Function(self.namespace, ENTRANCE_FUNCTION, [], [])
-        self.function_tags["minecraft:load"].insert(0, entrance_function)
-        self.commands[str(entrance_function)].insert(0, ScoreboardObjectivesAddCommandGenerator(self.namespace, "__global", "dummy", f'"{self.namespace} globals"'))
+        function_tags = {"minecraft:load": [str(entrance_function)]}
+        for k, v in self.function_tags.items():
+            function_tags.setdefault(k, []).extend(str(function) for function in v)
+        self.pass_manager = self.create_pass_manager(function_tags)
+        return Datapack(self.pass_manager.run(dict(self.commands)), function_tags)
 
-        # 输出结果
+    def dump(self, datapack: Datapack):
         print()
         print("-----------")
         print("[DEFINITIONS]")
@@ -491,39 +1328,17 @@ class ListenerInterp(MCCDPListener):
         for k, v in self.intermediate.items():
             print(f"{k}: {v}")
         print()
-        print("[FUNCTION TAGS]")
-        for k, v in self.function_tags.items():
-            tag_namespace, tag_name = k.split(":", 1)
-            tag_path = OUTPUT_PATH + f"data/{tag_namespace}/tags/function/"
-            print(f"{k}")
-            os.makedirs(tag_path, exist_ok=True)
-            data = {"values": []}
-            for function in v:
-                list_item_str = str(function)
-                print(f"- {list_item_str}")
-                data["values"].append(list_item_str)
-            with open(f"{tag_path}{tag_name}.json", "w") as f:
-                json.dump(data, f, indent=4)
-            print()
-        print()
-        print("[COMMANDS]")
-        for k, v in self.commands.items():
-            namespace, path_str = k.split(":", 1)
-            path = f"{OUTPUT_PATH}data/{namespace}/function/" + "".join(i + "/" for i in path_str.split("/")[:-1])
-            name = path_str.split("/")[-1] + ".mcfunction"
-            os.makedirs(path, exist_ok=True)
-            with open(path + name, "w") as f:
-                print(k)
-                print("-----------")
-                for i in v:
-                    f.write(str(i) + "\n")
-                    print(i)
-                print()
-        # for i in range(0, ctx.getChildCount(), 2):
-        #     print(self.result[ctx.getChild(i)])
-        # print("-----------")
-        # for k, v in self.intermediate.items():
-        #     print(k.getText(), v)
-        # print("-----------")
-        # for c in self.commands:
-        #     print(c)
+        print(datapack.dump(), end="")
+
+    def exitStart_(self, ctx: MCCDPParser.Start_Context):
+        self.finish()
+
+    def finish(self):
+        # 所有语句编译完毕后生成数据包并输出；逐条语句编译时由驱动程序调用
+        self.datapack = self.to_datapack()
+
+        # 输出结果
+        if self.verbose:
+            self.dump(self.datapack)
+        if self.mode == 'file':
+            DirectoryEmitter(OUTPUT_PATH).emit(link(self.datapack, [], self.opt_level))
@@ -1,3 +1,4 @@
+import re
 from abc import ABC, abstractmethod
 from typing import Any
 
@@ -49,23 +50,41 @@ class DataPath(Field, VariableType):
 
 
 class StorageDataPath(DataPath):
-    def __init__(self, namespace, id1, scope, name, immutable=False):
+    kind = "storage"
+
+    def __init__(self, namespace, id1, scope, name, immutable=False, member=None):
         super().__init__(immutable)
         self.namespace = namespace
         self.id = id1
         self.scope = scope
         self.name = name
+        self.member = member
 
     def final_name(self):
         return f"{self.namespace}:{self.id}"
 
     def final_path(self):
-        return f"\"{"".join(i + "." for i in self.scope)}{self.name}\""
+        return f"\"{"".join(i + "." for i in self.scope)}{self.name}\"{f".{self.member}" if self.member is not None else ""}"
 
     def __str__(self):
         return f"{self.final_name()} {self.final_path()}"
 
 
+class EntityDataPath(StorageDataPath):
+    # 实体的 data 复合标签（标记实体）中的键，用作类的 data 字段
+    kind = "entity"
+
+    def __init__(self, target: "Selector", name, immutable=False):
+        super().__init__(None, None, [], name, immutable)
+        self.target = target
+
+    def final_name(self):
+        return str(self.target)
+
+    def final_path(self):
+        return f"data.{snbt_key(self.name)}"
+
+
 class Constant:
     def __init__(self, value):
         self.value = value
@@ -74,6 +93,10 @@ class Constant:
         return str(self.value)
 
 
+# 整数常量的类型后缀对应的 NBT 类型
+NBT_INT_TYPES = {"b": "byte", "s": "short", "i": "int", "l": "long"}
+
+
 class IntConstant(Constant):
     def __init__(self, value: int, int_type: str = ""):
         super().__init__(value)
@@ -124,6 +147,40 @@ class StringConstant(Constant):
         return self.value
 
 
+def snbt_key(key: str):
+    if re.fullmatch(r"[A-Za-z0-9._+-]+", key):
+        return key
+    return "\"" + key.replace("\\", "\\\\").replace("\"", "\\\"") + "\""
+
+
+class ListConstant(Constant):
+    def __init__(self, value: list[Constant]):
+        super().__init__(value)
+
+    def __str__(self):
+        return f"[{','.join(str(item) for item in self.value)}]"
+
+
+class ArrayConstant(Constant):
+    def __init__(self, value: list[IntConstant], array_type: str):
+        super().__init__(value)
+        self.type = array_type.upper()
+        if self.type not in ["B", "I", "L"]:
+            raise ValueError(f"Invalid type {self.type} for ArrayConstant")
+
+    def __str__(self):
+        suffix = "" if self.type == "I" else self.type.lower()
+        return f"[{self.type};{','.join(f'{item.value}{suffix}' for item in self.value)}]"
+
+
+class CompoundConstant(Constant):
+    def __init__(self, value: dict[str, Constant]):
+        super().__init__(value)
+
+    def __str__(self):
+        return f"{{{','.join(f'{snbt_key(k)}:{v}' for k, v in self.value.items())}}}"
+
+
 class Range:
     def __init__(self, start: int | float | None = None, end: int | float | None = None):
         if start is not None and end is not None and start > end:
@@ -132,7 +189,7 @@ class Range:
         self.end = end
 
     def __str__(self):
-        return f"{self.start or ''}..{self.end or ''}"
+        return f"{'' if self.start is None else self.start}..{'' if self.end is None else self.end}"
 
 
 class NBTTag:
@@ -159,7 +216,7 @@ class NamespacedID:
 
 
 class Function:
-    def __init__(self, namespace, name, params: list["FunctionArgument"], scope=None, executor: "Selector" = None):
+    def __init__(self, namespace, name, params: list["FunctionArgument"], scope=None, executor: "Selector" = None, return_type=None):
         if scope is None:
             scope = []
         self.namespace = namespace
@@ -167,6 +224,9 @@ class Function:
         self.scope = scope
         self.params = params
         self.executor = executor
+        self.return_type = return_type
+        # 参数和返回值槽位所在的路径，默认为函数自身的路径；同名方法的各个实现共用最早声明它的类型的槽位
+        self.slots: list[str] | None = None
 
     @classmethod
     def from_whole_path(cls, namespace, whole_path: list[str], params: list["FunctionArgument"] = None, executor: "Selector" = None):
@@ -179,6 +239,23 @@ class Function:
         else:
             return Function(namespace, whole_path[-1], params, whole_path[:-1])
 
+    def slot_path(self) -> list[str]:
+        return self.slots if self.slots is not None else self.scope + [self.name]
+
+    def argument_slot(self, param: "FunctionArgument"):
+        # score 参数：被调函数作用域下的记分板槽位；data 参数：storage <ns>:__call 中以函数路径为键的复合标签的成员
+        path = self.slot_path()
+        if param.type is Scoreboard:
+            return Scoreboard(self.namespace, "__global", path, param.name)
+        return StorageDataPath(self.namespace, "__call", path[:-1], path[-1], member=param.name)
+
+    def return_slot(self):
+        return Scoreboard(self.namespace, "__global", self.slot_path(), "__return")
+
+    def arguments_storage(self):
+        path = self.slot_path()
+        return StorageDataPath(self.namespace, "__call", path[:-1], path[-1])
+
     def __repr__(self):
         return f"Function(namespace='{self.namespace}', name='{self.name}', args={self.params}, scope={self.scope})"
 
@@ -189,6 +266,81 @@ class Function:
             return f"{self.namespace}:{INTERNAL_PATH}{'.'.join(self.scope + [self.name])}"
 
 
+class ClassType:
+    # 类或接口。实例是带有类标签的实体（同时带有所有祖先类型的标签），__type 记分项保存实例的类型编号；
+    # score 字段按槽位编号存放在 __field<i> 记分项上，子类的字段排在父类之后，互不相关的类共用槽位；data 字段在实体的 data 复合标签中
+    def __init__(self, namespace, name, parent: "ClassType | None" = None, interfaces: list["ClassType"] = None, is_interface=False):
+        self.namespace = namespace
+        self.name = name
+        self.parent = parent
+        self.interfaces = interfaces or []
+        self.is_interface = is_interface
+        self.fields: dict[str, Scoreboard | EntityDataPath] = dict(parent.fields) if parent is not None else {}
+        self.defaults: dict[str, Constant] = dict(parent.defaults) if parent is not None else {}
+        self.methods: dict[str, Function] = {}
+
+    def tag(self):
+        return f"{self.namespace}.{self.name}"
+
+    def supertypes(self) -> list["ClassType"]:
+        return ([self.parent] if self.parent is not None else []) + self.interfaces
+
+    def ancestors(self) -> list["ClassType"]:
+        # 自身及所有父类和接口，按广度优先去重
+        result = {}
+        queue = [self]
+        while queue:
+            class_type = queue.pop(0)
+            if str(class_type) not in result:
+                result[str(class_type)] = class_type
+                queue.extend(class_type.supertypes())
+        return list(result.values())
+
+    def is_subtype(self, other: "ClassType") -> bool:
+        return any(str(ancestor) == str(other) for ancestor in self.ancestors())
+
+    def score_fields(self) -> int:
+        return sum(isinstance(field, Scoreboard) for field in self.fields.values())
+
+    def find_method(self, name) -> Function | None:
+        # 先找自身，再沿父类链查找，最后使用接口中的默认实现
+        if name in self.methods:
+            return self.methods[name]
+        for supertype in self.supertypes():
+            method = supertype.find_method(name)
+            if method is not None:
+                return method
+        return None
+
+    def __repr__(self):
+        return f"ClassType(namespace='{self.namespace}', name='{self.name}', parent={self.parent}, interfaces={[str(i) for i in self.interfaces]})"
+
+    def __str__(self):
+        return f"{self.namespace}:{self.name}"
+
+
+class ObjectReference:
+    # 静态类型已知的实体引用，例如方法中的 this（@s）或以类名表示的全部实例
+    def __init__(self, selector: "Selector", class_type: ClassType):
+        self.selector = selector
+        self.class_type = class_type
+
+    def is_executor(self):
+        return self.selector.variant == "s" and not self.selector.args
+
+    def __str__(self):
+        return f"{self.selector}: {self.class_type}"
+
+
+class BoundMethod:
+    def __init__(self, receiver: ObjectReference, name):
+        self.receiver = receiver
+        self.name = name
+
+    def __str__(self):
+        return f"{self.receiver}.{self.name}"
+
+
 class BuiltInFunction(Function):
     def __init__(self, name, params: list["FunctionArgument"]):
         super().__init__("__builtin", name, params)
@@ -203,6 +355,18 @@ class FunctionArgument:
         self.type = type
         self.default = default
 
+    def accepts(self, value):
+        if self.type is Any:
+            return True
+        elif self.type is Scoreboard:
+            return isinstance(value, (Scoreboard, IntConstant, FloatConstant))
+        elif self.type is StorageDataPath:
+            return isinstance(value, (Constant, DataPath, Scoreboard))
+        return isinstance(value, self.type)
+
+    def __repr__(self):
+        return f"FunctionArgument(name='{self.name}', type={getattr(self.type, '__name__', self.type)}, default={self.default})"
+
 
 class Selector:
     def __init__(self, variant, args: list["SelectorArgument"] = None):
@@ -224,6 +388,9 @@ class SelectorArgument:
         self.value = value
 
     def __str__(self):
+        # 资源位置、标签名等简单字符串不加引号，例如 type=zombie、tag=!boss；nbt、scores 等参数的字符串按原样写出
+        if isinstance(self.value, StringConstant) and (self.name in ("nbt", "scores", "advancements") or re.fullmatch(r"!?#?[A-Za-z0-9_.:/+-]+", self.value.value)):
+            return f"{self.name}={self.value.value}"
         return f"{self.name}={self.value}"
 
     def __repr__(self):
@@ -270,6 +437,11 @@ class ScoreMatch(RelationalOperation):
         self.range = range1
 
 
+class EntityMatch(RelationalOperation):
+    def __init__(self, selector: "Selector"):
+        self.selector = selector
+
+
 class Wrapper:
     def __int__(self, wrapped_obj):
         self.wrapped_obj = wrapped_obj
@@ -0,0 +1,144 @@
+import re
+
+from command_gen import *
+from ir import FunctionIR, call_graph, called_function, is_comment
+from partial_eval import split_run
+from pipeline import PassManager
+from settings import INTERNAL_PATH
+from value_numbering import eliminate_common_subexpressions
+
+QUOTED_KEY = r'"(?:[^"\\]|\\.)*"'
+PLAIN_KEY = r"[A-Za-z0-9_+-]+"
+
+
+def split_nbt_path(path: str) -> tuple[str | None, str] | None:
+    # 把 NBT 路径拆成（父路径，末级键）；根下的键父路径为 None；带索引等无法拆分的路径返回 None
+    match = re.fullmatch(rf"(?:(.+)\.)?({QUOTED_KEY}|{PLAIN_KEY})", path)
+    if match is None:
+        return None
+    parent, leaf = match.groups()
+    if parent is not None and re.fullmatch(rf"(?:{QUOTED_KEY}|{PLAIN_KEY})(?:\.(?:{QUOTED_KEY}|{PLAIN_KEY}))*", parent) is None:
+        return None
+    return parent, leaf
+
+
+def storage_write(command) -> tuple[str, str | None, str, str] | None:
+    # 返回可合并的常量写入 (存储, 父路径, 键, 值)；复合标签的 set value 是整体替换，而 merge 是递归合并，语义不同，不参与合并
+    if not isinstance(command, CommandGenerator) or command.opcode != "data modify storage":
+        return None
+    operands = command.operands
+    if len(operands) != 5 or operands[2] != "set" or operands[3] != "value":
+        return None
+    value = str(operands[4])
+    if value.startswith("{"):
+        return None
+    split = split_nbt_path(str(operands[1]))
+    if split is None:
+        return None
+    return str(operands[0]), split[0], split[1], value
+
+
+def merge_block_writes(commands: list) -> list:
+    # 将连续的、写入同一存储同一父路径下各个键的常量 set value 合并为一条 data merge / merge value 命令，中间的注释保持原位
+    result = []
+    group = []
+    group_index = 0
+
+    def flush():
+        if len(group) > 1:
+            storage, parent = group[0][:2]
+            values = {}
+            for _, _, key, value in group:
+                values.pop(key, None)
+                values[key] = value
+            compound = "{" + ",".join(f"{key}:{value}" for key, value in values.items()) + "}"
+            if parent is None:
+                result[group_index] = DataMergeStorageCommandGenerator(storage, compound)
+            else:
+                result[group_index] = DataModifyStorageMergeValueCommandGenerator(storage, parent, compound)
+        group.clear()
+
+    for command in commands:
+        if is_comment(command):
+            result.append(command)
+            continue
+        # 宏行等其他文本命令可能读取 storage，与普通命令一样结束当前分组
+        write = storage_write(command)
+        if write is not None and group and write[:2] == group[0][:2]:
+            group.append(write)
+            continue
+        flush()
+        if write is not None:
+            group_index = len(result)
+            group.append(write)
+        result.append(command)
+    flush()
+    return result
+
+
+def merge_storage_writes(function: FunctionIR) -> FunctionIR:
+    # 调用和宏行结束基本块，被调函数可能读取 storage，分组不跨越基本块
+    return function.map_blocks(merge_block_writes)
+
+
+def inline_call(command, bodies: dict[str, CommandGenerator | None]):
+    # 返回替换后的调用点：None 表示删除调用，原命令表示无法内联（带参数或宏的调用、execute store 等）
+    callee = called_function(command)
+    if callee not in bodies:
+        return command
+    body = bodies[callee]
+    if command.opcode == "function":
+        return command if len(command.operands) != 1 else body
+    subs, run = split_run(command)
+    if run.opcode != "function" or len(run.operands) != 1 or any(sub.opcode.startswith("store") for sub in subs):
+        return command
+    if body is None:
+        return None
+    if body.opcode == "execute":
+        inner_subs, inner_run = split_run(body)
+        if inner_run is None:
+            return command
+        return ExecuteRunCommandGenerator(subs + inner_subs, inner_run)
+    return ExecuteRunCommandGenerator(subs, body)
+
+
+def inline_blocks(functions: dict[str, FunctionIR], roots: set[str]) -> dict[str, FunctionIR]:
+    # 只有一个调用点、至多一条命令（不计注释）的内部函数（if、with 的分支，方法等）内联到调用点并删除，空函数直接删除调用；
+    # 被函数标签引用、被宏行提及或递归调用自身的函数不内联。内联后调用点所在的函数可能又满足条件，重复直到不再变化
+    while True:
+        callers = call_graph(functions)
+        macros = [macro for function in functions.values() for macro in function.macros()]
+        bodies = {}
+        for key, function in functions.items():
+            if INTERNAL_PATH not in key or key in roots or len(callers.get(key, [])) != 1 or callers[key][0] == key:
+                continue
+            body = function.body()
+            if len(body) <= 1 and not any(isinstance(command, str) for command in body) and not any(key in macro for macro in macros):
+                bodies[key] = body[0] if body else None
+        for key in list(bodies):
+            if callers[key][0] in bodies:
+                # 调用者本身也将被内联，留到下一轮
+                del bodies[key]
+        if not bodies:
+            return functions
+        inlined = set()
+
+        def replace(command):
+            replacement = inline_call(command, bodies)
+            if replacement is not command:
+                inlined.add(called_function(command))
+            return replacement
+
+        result = {key: function.replace_calls(replace) for key, function in functions.items()}
+        if not inlined:
+            return functions
+        functions = {key: function for key, function in result.items() if key not in inlined}
+
+
+def add_optimizations(manager: PassManager, function_tags: dict[str, list[str]]):
+    # 程序级的优化需要分析其他函数（调用关系、被调函数写入哪些槽位），先于逐函数的优化执行
+    # 内联在 -O 0 下也执行：分支和 with 块总是生成单独的函数，只有一条命令时不内联会多一次函数调用
+    roots = {value for values in function_tags.values() for value in values}
+    manager.add("inline_blocks", lambda functions: inline_blocks(functions, roots), 0, program=True)
+    manager.add("eliminate_common_subexpressions", eliminate_common_subexpressions, 1, program=True)
+    manager.add("merge_storage_writes", merge_storage_writes, 1)
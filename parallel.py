@@ -0,0 +1,187 @@
+import re
+from collections import defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from antlr4 import InputStream, ParseTreeWalker, Token
+from gen.MCCDPParser import MCCDPParser
+from command_gen import CommandGenerator
+from driver import SyntaxErrorCollector, compile_stream, create_parser
+from listener_interp import ListenerInterp
+from mcc_types import Function
+from partial_eval import PartialEvaluator
+from settings import ENTRANCE_FUNCTION
+from symbol_table import SymbolTable
+
+INTERMEDIATE = re.compile(r"__intermediate\.(\d+)")
+
+# 文件内并行编译：主进程逐条编译顶层语句，但顶层函数只做声明（名称、装饰器、参数），函数体交给工作进程，
+# 各工作进程从 0 开始分配中间量，合并时按源码顺序重新编号，输出与串行编译一致。
+
+
+class FunctionJob:
+    def __init__(self, text: str, line: int, namespace: str, opt_level: int, symbols: SymbolTable, numeric_data: dict[str, str]):
+        self.text = text
+        self.line = line
+        self.namespace = namespace
+        self.opt_level = opt_level
+        self.symbols = symbols
+        self.numeric_data = numeric_data
+
+
+class FunctionResult:
+    def __init__(self, listener_interp: ListenerInterp):
+        entrance = str(Function(listener_interp.namespace, ENTRANCE_FUNCTION, [], []))
+        # 工作进程的入口函数只有函数语句的注释和参数默认值，主进程已经生成过
+        self.commands = {key: commands for key, commands in listener_interp.commands.items() if key != entrance}
+        self.definitions = list(listener_interp.definitions.items())
+        self.function_tags = dict(listener_interp.function_tags)
+        self.function_flags = dict(listener_interp.function_flags)
+        self.constants = listener_interp.constants
+        self.finished_functions = listener_interp.finished_functions
+        self.dispatches = listener_interp.dispatches
+        self.intermediates = listener_interp.current_id
+
+
+class DeclarationWalker(ParseTreeWalker):
+    # 只进出顶层函数的函数体而不遍历其内容：函数和参数照常声明，函数体留空等待工作进程的结果
+    def walk(self, listener, t):
+        if isinstance(t, MCCDPParser.BlockContext) and isinstance(t.parentCtx, MCCDPParser.FunctionStatementContext):
+            self.enterRule(listener, t)
+            self.exitRule(listener, t)
+            return
+        super().walk(listener, t)
+
+
+class Unit:
+    # 一条顶层语句在主进程中的产出：中间量编号区间、新增的定义和函数标签
+    def __init__(self, listener_interp: ListenerInterp):
+        self.first_id = listener_interp.current_id
+        self.last_id = listener_interp.current_id
+        self.last_key = len(listener_interp.commands)
+        self.definitions = len(listener_interp.definitions)
+        self.function_tags = {tag: len(functions) for tag, functions in listener_interp.function_tags.items()}
+        self.key: str | None = None
+        self.future: Future | None = None
+        self.result: FunctionResult | None = None
+
+    def close(self, listener_interp: ListenerInterp):
+        self.last_id = listener_interp.current_id
+        self.last_key = len(listener_interp.commands)
+        self.definitions = list(listener_interp.definitions.items())[self.definitions:]
+        self.function_tags = {tag: functions[self.function_tags.get(tag, 0):] for tag, functions in listener_interp.function_tags.items()}
+
+
+def compile_function(job: FunctionJob) -> FunctionResult:
+    listener_interp = ListenerInterp(mode="memory", verbose=False, namespace=job.namespace, opt_level=job.opt_level)
+    listener_interp.symbols = job.symbols
+    listener_interp.numeric_data = job.numeric_data
+    collector = SyntaxErrorCollector()
+    # 补齐前面的行，警告中的行号与源文件一致
+    parser = create_parser(InputStream("\n" * (job.line - 1) + job.text), collector)
+    ParseTreeWalker().walk(listener_interp, parser.statement())
+    return FunctionResult(listener_interp)
+
+
+def renumber(command, mapping):
+    if isinstance(command, CommandGenerator):
+        operands = tuple(renumber(operand, mapping) for operand in command.operands)
+        if all(new is old for new, old in zip(operands, command.operands)):
+            return command
+        return CommandGenerator(command.opcode, operands)
+    if isinstance(command, str):
+        match = INTERMEDIATE.fullmatch(command)
+        if match is not None:
+            return f"__intermediate.{mapping(int(match.group(1)))}"
+    return command
+
+
+def compile_parallel(input_stream, listener_interp: ListenerInterp, jobs: int) -> list[str]:
+    # 部分求值依赖已编译完的被调函数体，并且特化副本全局编号，-O 2 时退回串行编译
+    if listener_interp.opt_level >= 2:
+        return compile_stream(input_stream, listener_interp)
+    collector = SyntaxErrorCollector()
+    parser = create_parser(input_stream, collector)
+    walker = ParseTreeWalker()
+    declaration_walker = DeclarationWalker()
+    executor = ProcessPoolExecutor(jobs) if jobs > 1 else None
+    units: list[Unit] = []
+    preamble = dict(listener_interp.definitions)
+    try:
+        while parser.getTokenStream().LA(1) != Token.EOF:
+            statement_ctx = parser.statement()
+            if collector.errors:
+                return collector.errors
+            unit = Unit(listener_interp)
+            if isinstance(statement_ctx, MCCDPParser.FunctionStmtContext):
+                function_ctx = statement_ctx.functionStatement()
+                name = listener_interp.analyse_namespaced_id(function_ctx.namespacedId())
+                unit.key = str(Function(name.namespace, name.id, [], []))
+                job = FunctionJob(input_stream.getText(statement_ctx.start.start, statement_ctx.stop.stop), statement_ctx.start.line,
+                                  listener_interp.namespace, listener_interp.opt_level, listener_interp.symbols.copy(),
+                                  dict(listener_interp.numeric_data))
+                if executor is None:
+                    unit.result = compile_function(job)
+                else:
+                    unit.future = executor.submit(compile_function, job)
+                declaration_walker.walk(listener_interp, statement_ctx)
+            else:
+                walker.walk(listener_interp, statement_ctx)
+            unit.close(listener_interp)
+            units.append(unit)
+        for unit in units:
+            if unit.future is not None:
+                unit.result = unit.future.result()
+                unit.future = None
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    merge(listener_interp, units, preamble)
+    listener_interp.finish()
+    return []
+
+
+def merge(listener_interp: ListenerInterp, units: list[Unit], preamble: dict):
+    # 按源码顺序给每条语句分配串行编译时的中间量编号；函数语句在主进程中只分配了参数默认值用到的部分，
+    # 工作进程从同一位置开始重新分配了一遍，两者前缀一致
+    offsets = {}
+    main_ids = {}
+    current_id = 0
+    for unit in units:
+        for i in range(unit.first_id, unit.last_id):
+            main_ids[i] = current_id + i - unit.first_id
+        offsets[unit.key] = current_id
+        current_id += unit.last_id - unit.first_id if unit.result is None else unit.result.intermediates
+    # 函数按第一次添加命令的顺序排列：每条语句中主进程新建的函数在前，工作进程编译的函数体在后
+    main_keys = list(listener_interp.commands)
+    commands = {}
+    for unit in units:
+        for key in main_keys[:unit.last_key]:
+            if key not in commands:
+                commands[key] = [renumber(command, main_ids.__getitem__) for command in listener_interp.commands[key]]
+        if unit.result is not None:
+            offset = offsets[unit.key]
+            for result_key, result_commands in unit.result.commands.items():
+                commands[result_key] = [renumber(command, lambda i: offset + i) for command in result_commands]
+    for key in main_keys:
+        if key not in commands:
+            commands[key] = [renumber(command, main_ids.__getitem__) for command in listener_interp.commands[key]]
+    listener_interp.commands = defaultdict(list, commands)
+    listener_interp.partial_evaluator = PartialEvaluator(listener_interp.commands)
+    listener_interp.update_current_function()
+    listener_interp.current_id = current_id
+
+    definitions = dict(preamble)
+    function_tags = defaultdict(list)
+    for unit in units:
+        source = unit.result if unit.result is not None else unit
+        definitions.update(source.definitions)
+        for tag, functions in source.function_tags.items():
+            function_tags[tag].extend(functions)
+        if unit.result is not None:
+            for key, flags in unit.result.function_flags.items():
+                listener_interp.function_flags[key] |= flags
+            listener_interp.constants |= unit.result.constants
+            listener_interp.finished_functions |= unit.result.finished_functions
+            listener_interp.dispatches.update(unit.result.dispatches)
+    listener_interp.definitions = definitions
+    listener_interp.function_tags = function_tags
@@ -0,0 +1,350 @@
+from command_gen import CommandGenerator
+from settings import INTERNAL_PATH
+
+INT_MIN = -2 ** 31
+MAX_STEPS = 100000
+
+SCORE_WRITES = ("scoreboard players set", "scoreboard players add", "scoreboard players remove")
+CONDITIONS = ("if score", "unless score")
+
+
+class NotConstant(Exception):
+    pass
+
+
+def wrap_int(value: int) -> int:
+    # 记分板为 32 位有符号整数，溢出时回绕
+    return (value - INT_MIN) % 2 ** 32 + INT_MIN
+
+
+def score_operation(operation: str, a: int | None, b: int) -> tuple[int, int]:
+    # 返回运算后的 (目标, 来源)；除法和取模按 Java 版的 floorDiv / floorMod，除数为 0 时命令失败
+    if operation == "=":
+        return b, b
+    elif operation == "+=":
+        return wrap_int(a + b), b
+    elif operation == "-=":
+        return wrap_int(a - b), b
+    elif operation == "*=":
+        return wrap_int(a * b), b
+    elif operation == "/=":
+        if b == 0:
+            raise NotConstant("Division by zero")
+        return wrap_int(a // b), b
+    elif operation == "%=":
+        if b == 0:
+            raise NotConstant("Division by zero")
+        return a % b, b
+    elif operation == "<":
+        return min(a, b), b
+    elif operation == ">":
+        return max(a, b), b
+    elif operation == "><":
+        return b, a
+    raise NotConstant(f"Unknown operation {operation}")
+
+
+def parse_range(text: str) -> tuple[int | None, int | None]:
+    if ".." not in text:
+        return int(float(text)), int(float(text))
+    start, end = text.split("..", 1)
+    return int(float(start)) if start else None, int(float(end)) if end else None
+
+
+def compare_scores(a: int, operation: str, b: int) -> bool:
+    if operation in ("=", "=="):
+        return a == b
+    elif operation == "<":
+        return a < b
+    elif operation == "<=":
+        return a <= b
+    elif operation == ">":
+        return a > b
+    elif operation == ">=":
+        return a >= b
+    raise NotConstant(f"Unknown comparison {operation}")
+
+
+def score_slot(operands: tuple, index: int = 0) -> tuple[str, str]:
+    return str(operands[index]), str(operands[index + 1])
+
+
+def split_run(command: CommandGenerator) -> tuple[list, CommandGenerator | None]:
+    # 把 execute 拆成（子命令，run 后的命令）；没有 run 的 execute 返回 None
+    operands = command.operands
+    if len(operands) < 2 or operands[-2] != "run":
+        return list(operands), None
+    return list(operands[:-2]), operands[-1]
+
+
+def constant_slot(slot: tuple[str, str]) -> int | None:
+    # 常量槽位 __const.<值> 在入口函数中初始化后不再改变
+    name = slot[0]
+    if name.startswith("__const.") and name[len("__const."):].lstrip("-").isdigit() and slot[1].endswith(".__global"):
+        return int(name[len("__const."):])
+    return None
+
+
+def set_score(slot: tuple[str, str], value: int) -> CommandGenerator:
+    return CommandGenerator("scoreboard players set", (*slot, str(value)))
+
+
+class PartialEvaluator:
+    # 编译期求值器：在 IR 上解释记分板命令的子集（set/add/remove/operation、execute if|unless score ... run、无参 function），
+    # 槽位以 (玩家名, 记分项) 表示；纯函数指只写自身作用域和中间量槽位、不访问其他状态的函数
+    def __init__(self, functions: dict[str, list]):
+        self.functions = functions
+        self.purity: dict[str, bool | None] = {}
+
+    @staticmethod
+    def owner(key: str) -> tuple[str, str]:
+        namespace, path = key.split(":", 1)
+        return namespace, path.removeprefix(INTERNAL_PATH)
+
+    def owns(self, owner: tuple[str, str], slot: tuple[str, str]) -> bool:
+        namespace, prefix = owner
+        name, objective = slot
+        return objective == f"{namespace}.__global" and (name.startswith(prefix + ".") or name.startswith("__intermediate."))
+
+    def subfunction(self, owner: tuple[str, str], key: str) -> bool:
+        namespace, prefix = owner
+        return key.startswith(f"{namespace}:{INTERNAL_PATH}{prefix}.")
+
+    def is_pure(self, key: str) -> bool:
+        # 正在分析中的函数（递归）按非纯处理，结果只会偏保守
+        if key not in self.purity:
+            self.purity[key] = None
+            self.purity[key] = key in self.functions and self.pure_commands(self.functions[key], self.owner(key), {key})
+        return self.purity[key] is True
+
+    def pure_commands(self, commands: list, owner: tuple[str, str], visiting: set[str]) -> bool:
+        return all(self.pure_command(command, owner, visiting) for command in commands)
+
+    def pure_command(self, command, owner: tuple[str, str], visiting: set[str]) -> bool:
+        if isinstance(command, str):
+            return command.startswith("#")
+        opcode, operands = command.opcode, command.operands
+        if opcode in SCORE_WRITES:
+            return self.owns(owner, score_slot(operands))
+        elif opcode == "scoreboard players operation":
+            return self.owns(owner, score_slot(operands)) and (operands[2] != "><" or self.owns(owner, score_slot(operands, 3)))
+        elif opcode == "execute":
+            subs, run = split_run(command)
+            return run is not None and all(sub.opcode in CONDITIONS for sub in subs) and self.pure_command(run, owner, visiting)
+        elif opcode == "function" and len(operands) == 1:
+            key = str(operands[0])
+            if self.subfunction(owner, key):
+                if key in visiting:
+                    return False
+                return key in self.functions and self.pure_commands(self.functions[key], owner, visiting | {key})
+            return self.is_pure(key)
+        return False
+
+    def evaluate(self, key: str, env: dict[tuple[str, str], int]) -> dict[tuple[str, str], int]:
+        # 以给定的槽位初值完整执行纯函数；读到未知槽位、超过步数上限等情况抛出 NotConstant
+        if not self.is_pure(key):
+            raise NotConstant(f"Function {key} is not pure")
+        env = dict(env)
+        self.run(self.functions[key], env, [MAX_STEPS])
+        return env
+
+    def run(self, commands: list, env: dict, budget: list[int]):
+        for command in commands:
+            budget[0] -= 1
+            if budget[0] < 0:
+                raise NotConstant("Evaluation step limit exceeded")
+            self.step(command, env, budget)
+
+    def read(self, env: dict, slot: tuple[str, str]) -> int:
+        if slot not in env and constant_slot(slot) is not None:
+            return constant_slot(slot)
+        if slot not in env:
+            raise NotConstant(f"Unknown score {slot[0]} {slot[1]}")
+        return env[slot]
+
+    def condition(self, sub: CommandGenerator, env: dict) -> bool:
+        operands = sub.operands
+        value = self.read(env, score_slot(operands))
+        if operands[2] == "matches":
+            start, end = parse_range(str(operands[3]))
+            result = (start is None or value >= start) and (end is None or value <= end)
+        else:
+            result = compare_scores(value, operands[2], self.read(env, score_slot(operands, 3)))
+        return result if sub.opcode == "if score" else not result
+
+    def step(self, command, env: dict, budget: list[int]):
+        if isinstance(command, str):
+            return
+        opcode, operands = command.opcode, command.operands
+        if opcode == "scoreboard players set":
+            env[score_slot(operands)] = wrap_int(int(operands[2]))
+        elif opcode == "scoreboard players add":
+            slot = score_slot(operands)
+            env[slot] = wrap_int(self.read(env, slot) + int(operands[2]))
+        elif opcode == "scoreboard players remove":
+            slot = score_slot(operands)
+            env[slot] = wrap_int(self.read(env, slot) - int(operands[2]))
+        elif opcode == "scoreboard players operation":
+            target, source = score_slot(operands), score_slot(operands, 3)
+            a = None if operands[2] == "=" else self.read(env, target)
+            env[target], env[source] = score_operation(operands[2], a, self.read(env, source))
+        elif opcode == "execute":
+            subs, run = split_run(command)
+            if all(self.condition(sub, env) for sub in subs):
+                self.run([run], env, budget)
+        elif opcode == "function":
+            self.run(self.functions[str(operands[0])], env, budget)
+        else:
+            raise NotConstant(f"Cannot evaluate {command}")
+
+    def writes(self, command, visiting: set[str] = None) -> set[tuple[str, str]] | None:
+        # 命令可能写入的记分板槽位；None 表示无法确定
+        if isinstance(command, str):
+            return set() if command.startswith("#") else None
+        opcode, operands = command.opcode, command.operands
+        if opcode in SCORE_WRITES:
+            return {score_slot(operands)}
+        elif opcode == "scoreboard players operation":
+            return {score_slot(operands), score_slot(operands, 3)} if operands[2] == "><" else {score_slot(operands)}
+        elif opcode == "execute":
+            subs, run = split_run(command)
+            if run is None or any(sub.opcode.startswith("store") and "score" in sub.opcode for sub in subs):
+                return None
+            return self.writes(run, visiting)
+        elif opcode == "function":
+            return self.function_slots(str(operands[0]), self.writes, visiting)
+        elif opcode.startswith("scoreboard"):
+            return None
+        return set()
+
+    def reads(self, command, visiting: set[str] = None) -> set[tuple[str, str]] | None:
+        # 命令可能读取的记分板槽位；None 表示无法确定
+        if isinstance(command, str):
+            return set() if command.startswith("#") else None
+        opcode, operands = command.opcode, command.operands
+        if opcode == "scoreboard players set":
+            return set()
+        elif opcode in SCORE_WRITES or opcode == "scoreboard players get":
+            return {score_slot(operands)}
+        elif opcode == "scoreboard players operation":
+            return {score_slot(operands, 3)} if operands[2] == "=" else {score_slot(operands), score_slot(operands, 3)}
+        elif opcode == "execute":
+            subs, run = split_run(command)
+            slots = set()
+            for sub in subs:
+                if sub.opcode in CONDITIONS:
+                    slots.add(score_slot(sub.operands))
+                    if sub.operands[2] != "matches":
+                        slots.add(score_slot(sub.operands, 3))
+                elif "score" in sub.opcode:
+                    return None
+            run_slots = self.reads(run, visiting) if run is not None else set()
+            return None if run_slots is None else slots | run_slots
+        elif opcode == "function":
+            return self.function_slots(str(operands[0]), self.reads, visiting)
+        elif opcode.startswith("scoreboard"):
+            return None
+        return set()
+
+    def function_slots(self, key: str, analysis, visiting: set[str] | None) -> set[tuple[str, str]] | None:
+        visiting = visiting or set()
+        if key in visiting:
+            return set()
+        if key not in self.functions:
+            return None
+        visiting.add(key)
+        slots = set()
+        for command in self.functions[key]:
+            command_slots = analysis(command, visiting)
+            if command_slots is None:
+                return None
+            slots |= command_slots
+        return slots
+
+    def specialise(self, key: str, env: dict[tuple[str, str], int]) -> list:
+        # 常量传播生成特化函数体：已知条件的分支被折叠或内联，已知操作数的运算化为 set/add；
+        # 所有写入都保留，被剩余代码读取的参数槽位在开头初始化
+        residual = []
+        self.propagate(self.functions.get(key, []), dict(env), self.owner(key), {key}, residual)
+        reads = set()
+        for command in residual:
+            command_reads = self.reads(command)
+            if command_reads is None:
+                reads = None
+                break
+            reads |= command_reads
+        initial = [set_score(slot, value) for slot, value in env.items() if reads is None or slot in reads]
+        return initial + residual
+
+    def forget(self, command, env: dict):
+        slots = self.writes(command)
+        if slots is None:
+            env.clear()
+        else:
+            for slot in slots:
+                env.pop(slot, None)
+
+    def propagate(self, commands: list, env: dict, owner: tuple[str, str], active: set[str], residual: list):
+        for command in commands:
+            if isinstance(command, str):
+                if not command.startswith("#"):
+                    env.clear()
+                    residual.append(command)
+                continue
+            opcode, operands = command.opcode, command.operands
+            if opcode in SCORE_WRITES:
+                slot = score_slot(operands)
+                if opcode == "scoreboard players set":
+                    env[slot] = wrap_int(int(operands[2]))
+                    residual.append(command)
+                elif slot in env:
+                    delta = int(operands[2]) if opcode == "scoreboard players add" else -int(operands[2])
+                    env[slot] = wrap_int(env[slot] + delta)
+                    residual.append(set_score(slot, env[slot]))
+                else:
+                    residual.append(command)
+            elif opcode == "scoreboard players operation":
+                target, operation, source = score_slot(operands), operands[2], score_slot(operands, 3)
+                if source not in env and constant_slot(source) is not None:
+                    env[source] = constant_slot(source)
+                try:
+                    if source in env and (operation == "=" or target in env):
+                        env[target], env[source] = score_operation(operation, env.get(target), env[source])
+                        residual.append(set_score(target, env[target]))
+                        if operation == "><":
+                            residual.append(set_score(source, env[source]))
+                        continue
+                except NotConstant:
+                    pass
+                env.pop(target, None)
+                if operation == "><":
+                    env.pop(source, None)
+                if source in env and operation in ("+=", "-="):
+                    delta = env[source] if operation == "+=" else -env[source]
+                    residual.append(CommandGenerator("scoreboard players add" if delta >= 0 else "scoreboard players remove", (*target, str(abs(delta)))))
+                else:
+                    residual.append(command)
+            elif opcode == "execute" and split_run(command)[1] is not None and all(sub.opcode in CONDITIONS for sub in split_run(command)[0]):
+                subs, run = split_run(command)
+                unknown = []
+                for sub in subs:
+                    try:
+                        if not self.condition(sub, env):
+                            break
+                    except NotConstant:
+                        unknown.append(sub)
+                else:
+                    if not unknown:
+                        self.propagate([run], env, owner, active, residual)
+                    else:
+                        folded = []
+                        self.propagate([run], dict(env), owner, active, folded)
+                        run = folded[0] if len(folded) == 1 else run
+                        residual.append(CommandGenerator("execute", (*unknown, "run", run)))
+                        self.forget(run, env)
+            elif opcode == "function" and len(operands) == 1 and self.subfunction(owner, str(operands[0])) and str(operands[0]) not in active:
+                key = str(operands[0])
+                self.propagate(self.functions.get(key, []), env, owner, active | {key}, residual)
+            else:
+                residual.append(command)
+                self.forget(command, env)
@@ -0,0 +1,45 @@
+import time
+from typing import Callable
+
+from ir import FunctionIR
+
+# 后端流水线：监听器把语法树降级为每个函数的命令序列之后，转换为按基本块切分的 FunctionIR，依次执行注册的 pass，
+# 最后展开为命令序列交给发射器输出。程序级 pass 接收并返回全部函数 {函数键: FunctionIR}，函数级 pass 逐个函数接收并返回 FunctionIR；
+# 优化级别低于 pass 要求的级别时跳过。每个 pass 的累计耗时记录在 timings 中
+
+
+class Pass:
+    def __init__(self, name: str, run: Callable, level: int = 0, program: bool = False):
+        self.name = name
+        self.run = run
+        self.level = level
+        self.program = program
+
+
+class PassManager:
+    def __init__(self, opt_level: int):
+        self.opt_level = opt_level
+        self.passes: list[Pass] = []
+        self.timings: dict[str, float] = {}
+
+    def add(self, name: str, run: Callable, level: int = 0, program: bool = False) -> "PassManager":
+        self.passes.append(Pass(name, run, level, program))
+        return self
+
+    def run(self, functions: dict[str, list]) -> dict[str, list]:
+        functions = {key: FunctionIR.from_commands(key, commands) for key, commands in functions.items()}
+        for compiler_pass in self.passes:
+            if self.opt_level < compiler_pass.level:
+                continue
+            start = time.perf_counter()
+            if compiler_pass.program:
+                functions = compiler_pass.run(functions)
+            else:
+                functions = {key: compiler_pass.run(function) for key, function in functions.items()}
+            self.timings[compiler_pass.name] = self.timings.get(compiler_pass.name, 0.0) + time.perf_counter() - start
+        return {key: function.commands() for key, function in functions.items()}
+
+    def report(self) -> str:
+        lines = [f"{name:<32} {seconds * 1000:>10.2f} ms" for name, seconds in self.timings.items()]
+        lines.append(f"{'total':<32} {sum(self.timings.values()) * 1000:>10.2f} ms")
+        return "\n".join(lines)
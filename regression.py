@@ -0,0 +1,150 @@
+import argparse
+import json
+import os
+import sys
+import warnings
+
+from antlr4 import FileStream
+from compile_server import CompileServer
+from datapack import Datapack
+from driver import compile_stream
+from parallel import compile_parallel
+from linker import decode_command, link
+from listener_interp import ListenerInterp
+from optimizations import add_optimizations
+from pipeline import PassManager
+from simulator import Simulator
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "regression")
+BASELINE_FILE = "baseline.json"
+OPT_LEVELS = (0, 1, 2)
+PARALLEL_JOBS = 2
+
+# 优化回归测试：语料中的每个程序在每个优化级别下编译，用本地模型执行一次 load 和若干 tick，
+# 检查最终的记分板、storage 和聊天输出是否与 <程序名>.json 一致，并把执行的命令数与基线比较，
+# 任何一项结果错误或命令数增加都以非零状态退出；更高优化级别每 tick 执行的命令数多于 -O 0 时同样失败（更新基线时也不接受）。单文件程序还要以 -j 并行编译一次，输出必须与串行编译逐字节相同。
+# 语料中的目录是多文件项目，经编译服务器逐个文件编译后链接；<程序名>.pack.json 是手写的数据包（函数体的格式与预编译模块相同），
+# 用于覆盖编译器自身不会生成的命令（例如宏行），只经过优化 pass。期望文件的格式：
+#   {"players": 1, "ticks": 1, "scores": {记分项: {持有者: 原始值}}, "storage": {存储: {键: 值}}, "chat": [...]}
+
+
+def compile_program(path: str, opt_level: int, jobs: int | None = None) -> Datapack:
+    listener_interp = ListenerInterp(mode="memory", verbose=False, opt_level=opt_level)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        if jobs is not None:
+            errors = compile_parallel(FileStream(path, encoding="utf-8"), listener_interp, jobs)
+        else:
+            errors = compile_stream(FileStream(path, encoding="utf-8"), listener_interp)
+    if errors:
+        raise ValueError("; ".join(errors))
+    return link(listener_interp.datapack, [], opt_level)
+
+
+def compile_project(path: str, opt_level: int) -> Datapack:
+    compile_server = CompileServer(path, opt_level=opt_level)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        compile_server.update()
+    errors = [error for unit in compile_server.units.values() for error in unit.errors]
+    if errors:
+        raise ValueError("; ".join(errors))
+    return compile_server.link()
+
+
+def optimize_pack(path: str, opt_level: int) -> Datapack:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    functions = {key: [decode_command(command) for command in commands] for key, commands in data["functions"].items()}
+    manager = PassManager(opt_level)
+    add_optimizations(manager, data["function_tags"])
+    return link(Datapack(manager.run(functions), data["function_tags"]), [], opt_level)
+
+
+def run_program(datapack: Datapack, expectation: dict) -> tuple[Simulator, dict[str, int]]:
+    simulator = Simulator(datapack, expectation.get("players", 1))
+    simulator.run_tag("minecraft:load")
+    load = simulator.executed
+    for _ in range(expectation.get("ticks", 1)):
+        simulator.run_tag("minecraft:tick")
+    return simulator, {"load": load, "tick": simulator.executed - load}
+
+
+def check_state(simulator: Simulator, expectation: dict) -> list[str]:
+    mismatches = []
+    for objective, holders in expectation.get("scores", {}).items():
+        for holder, value in holders.items():
+            actual = simulator.scores.get((holder, objective))
+            if actual != value:
+                mismatches.append(f"score {holder} {objective}: expected {value}, got {actual}")
+    for storage, values in expectation.get("storage", {}).items():
+        for key, value in values.items():
+            actual = simulator.storage[storage].get(key)
+            if actual != value:
+                mismatches.append(f"storage {storage} {key}: expected {json.dumps(value)}, got {json.dumps(actual)}")
+    if "chat" in expectation and simulator.chat != expectation["chat"]:
+        mismatches.append(f"chat: expected {expectation['chat']}, got {simulator.chat}")
+    return mismatches
+
+
+def main(argv) -> int:
+    arg_parser = argparse.ArgumentParser(prog="regression")
+    arg_parser.add_argument("corpus", nargs="?", default=CORPUS_PATH)
+    arg_parser.add_argument("--update-baseline", action="store_true", help="accept the current command counts as the new baseline")
+    args = arg_parser.parse_args(argv[1:])
+    baseline_path = os.path.join(args.corpus, BASELINE_FILE)
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)
+    counts = {}
+    failures = []
+    for file_name in sorted(os.listdir(args.corpus)):
+        path = os.path.join(args.corpus, file_name)
+        if os.path.isdir(path):
+            name, compile_function = file_name, compile_project
+        elif file_name.endswith(".mccdp"):
+            name, compile_function = file_name[:-len(".mccdp")], compile_program
+        elif file_name.endswith(".pack.json"):
+            name, compile_function = file_name[:-len(".pack.json")], optimize_pack
+        else:
+            continue
+        with open(os.path.join(args.corpus, name + ".json"), encoding="utf-8") as f:
+            expectation = json.load(f)
+        for opt_level in OPT_LEVELS:
+            label = f"{name} -O {opt_level}"
+            try:
+                datapack = compile_function(path, opt_level)
+                if compile_function is compile_program and compile_program(path, opt_level, PARALLEL_JOBS).dump() != datapack.dump():
+                    failures.append(f"{label}: -j {PARALLEL_JOBS} output differs from the serial build")
+                simulator, program_counts = run_program(datapack, expectation)
+            except Exception as e:
+                failures.append(f"{label}: {type(e).__name__}: {e}")
+                continue
+            failures.extend(f"{label}: {mismatch}" for mismatch in check_state(simulator, expectation))
+            counts.setdefault(name, {})[f"O{opt_level}"] = program_counts
+            previous = baseline.get(name, {}).get(f"O{opt_level}")
+            notes = []
+            for phase, count in program_counts.items():
+                if previous is None or phase not in previous:
+                    notes.append(f"{phase} has no baseline")
+                elif count > previous[phase] and not args.update_baseline:
+                    failures.append(f"{label}: {phase} executed {count} commands, baseline {previous[phase]}")
+                elif count != previous[phase]:
+                    notes.append(f"{phase} {previous[phase]} -> {count}")
+            per_tick = program_counts["tick"] / expectation.get("ticks", 1)
+            print(f"{label:<24} load {program_counts['load']:>6}  per tick {per_tick:>8.1f}  {', '.join(notes)}".rstrip())
+            unoptimised = counts[name].get("O0")
+            if opt_level > 0 and unoptimised is not None and program_counts["tick"] > unoptimised["tick"]:
+                failures.append(f"{label}: tick executed {program_counts['tick']} commands, more than {unoptimised['tick']} at -O 0")
+    if args.update_baseline:
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(counts, f, indent=4)
+            f.write("\n")
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,72 @@
+from antlr4 import InputStream, ParseTreeWalker
+from gen.MCCDPLexer import MCCDPLexer
+
+from datapack import create_emitter
+from driver import parse
+from linker import link
+from listener_interp import ListenerInterp
+from settings import OUTPUT_PATH
+
+OPENING_BRACKETS = ("(", "[", "{")
+CLOSING_BRACKETS = (")", "]", "}")
+
+
+def unbalanced(text: str) -> bool:
+    # 按词法单元计数，字符串和注释中的括号不算；还有未闭合的括号时输入没有结束
+    lexer = MCCDPLexer(InputStream(text))
+    lexer.removeErrorListeners()
+    depth = 0
+    for token in lexer.getAllTokens():
+        if token.text in OPENING_BRACKETS:
+            depth += 1
+        elif token.text in CLOSING_BRACKETS:
+            depth -= 1
+    return depth > 0
+
+
+class ReplSession:
+    # 在多次输入间保持同一个解释器状态：每行只编译新语句，并只报告新增或变化的函数；:flush 时才写出文件
+    def __init__(self, output: str = OUTPUT_PATH):
+        self.listener_interp = ListenerInterp(mode="memory", verbose=False)
+        self.listener_interp.allow_redefinition = True
+        self.walker = ParseTreeWalker()
+        self.emitter = create_emitter(output)
+        self.reported: dict[str, tuple] = {}
+
+    def eval(self, text: str) -> tuple[list[str], dict[str, list | None]]:
+        tree, errors = parse(InputStream(text))
+        if errors:
+            return errors, {}
+        checkpoint = self.listener_interp.checkpoint()
+        try:
+            for statement_ctx in tree.statement():
+                self.walker.walk(self.listener_interp, statement_ctx)
+        except Exception as e:
+            self.listener_interp.rollback(checkpoint)
+            return [f"{type(e).__name__}: {e}"], {}
+        return [], self.changes()
+
+    def changes(self) -> dict[str, list | None]:
+        # 对于只追加了命令的函数，只返回新追加的部分；被删除的函数对应 None；
+        # 重新定义过的函数即使新函数体以旧函数体开头也返回完整的函数体，客户端应整体替换
+        changes = {}
+        commands = self.listener_interp.commands
+        redefined = self.listener_interp.redefined
+        self.listener_interp.redefined = set()
+        for key in (self.reported.keys() | redefined) - commands.keys():
+            self.reported.pop(key, None)
+            changes[key] = None
+        for key, function_commands in commands.items():
+            current = tuple(function_commands)
+            previous = self.reported.get(key)
+            if previous == current and key not in redefined:
+                continue
+            if previous is not None and current[:len(previous)] == previous and key not in redefined:
+                changes[key] = list(current[len(previous):])
+            else:
+                changes[key] = list(current)
+            self.reported[key] = current
+        return changes
+
+    def flush(self) -> list[str]:
+        return self.emitter.emit(link(self.listener_interp.to_datapack(), [], self.listener_interp.opt_level))
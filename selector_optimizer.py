@@ -0,0 +1,118 @@
+from command_gen import CommandGenerator
+from mcc_types import Selector, SelectorArgument, StringConstant
+
+# 游戏按参数出现的顺序依次过滤实体：廉价的类型、坐标与标签检查放在前面，计分、进度、谓词和 NBT 放在最后
+ARGUMENT_ORDER = ["type", "x", "y", "z", "dx", "dy", "dz", "distance", "tag", "team", "name", "gamemode", "level",
+                  "x_rotation", "y_rotation", "scores", "advancements", "predicate", "nbt", "sort", "limit"]
+PLAYER_ONLY_ARGUMENTS = {"gamemode", "level", "advancements"}
+CONTEXT_ARGUMENTS = {"x", "y", "z", "dx", "dy", "dz", "distance", "x_rotation", "y_rotation"}
+
+
+def argument_rank(name: str) -> int:
+    if name in ARGUMENT_ORDER:
+        return ARGUMENT_ORDER.index(name)
+    return ARGUMENT_ORDER.index("nbt")
+
+
+def optimize_selector(selector: Selector) -> Selector:
+    # 去掉重复参数和默认的 sort=arbitrary，只能匹配玩家的 @e 补上 type=player，再按代价排序参数
+    args = []
+    seen = set()
+    for arg in selector.args:
+        if str(arg) in seen:
+            continue
+        seen.add(str(arg))
+        if selector.variant in ("e", "a") and arg.name == "sort" and str(arg) == "sort=arbitrary":
+            continue
+        args.append(arg)
+    names = {arg.name for arg in args}
+    if selector.variant == "e" and "type" not in names and names & PLAYER_ONLY_ARGUMENTS:
+        args.append(SelectorArgument("type", StringConstant("player")))
+    args.sort(key=lambda arg: argument_rank(arg.name))
+    return Selector(selector.variant, args)
+
+
+def selector_arguments(text: str) -> list[tuple[str, str]] | None:
+    # 把 @e[...] 的参数按顶层逗号拆成 (名称, 值)；不是带参数的 @e 选择器时返回 None
+    if not text.startswith("@e[") or not text.endswith("]"):
+        return None
+    args = []
+    depth = 0
+    quote = None
+    current = ""
+    for char in text[3:-1]:
+        if quote is not None:
+            if char == quote and not current.endswith("\\"):
+                quote = None
+        elif char in "\"'":
+            quote = char
+        elif char in "[{":
+            depth += 1
+        elif char in "]}":
+            depth -= 1
+        elif char == "," and depth == 0:
+            args.append(current)
+            current = ""
+            continue
+        current += char
+    args.append(current)
+    result = []
+    for arg in args:
+        if "=" not in arg:
+            return None
+        name, value = arg.split("=", 1)
+        result.append((name.strip(), value.strip()))
+    return result
+
+
+def cacheable(text: str, first: bool) -> bool:
+    # 随机选择每次结果不同，不缓存；依赖执行位置或朝向的选择器只有在 execute 的第一个子命令中（上下文即函数本身的上下文）才缓存
+    args = selector_arguments(text)
+    if args is None or ("sort", "random") in args:
+        return False
+    return first or not any(name in CONTEXT_ARGUMENTS or (name == "sort" and value != "arbitrary") for name, value in args)
+
+
+def selector_uses(command) -> list[tuple[int, str]]:
+    if not isinstance(command, CommandGenerator) or command.opcode != "execute":
+        return []
+    uses = []
+    for i, sub in enumerate(command.operands):
+        if not isinstance(sub, CommandGenerator):
+            break
+        if sub.opcode in ("as", "at") and cacheable(str(sub.operands[0]), i == 0):
+            uses.append((i, str(sub.operands[0])))
+    return uses
+
+
+def cache_selectors(commands: list, key: str) -> list:
+    # 同一函数中出现多次的 @e[...] 选择器只求值一次：首次使用前用 tag ... add 给匹配的实体打上临时标签，
+    # 之后以 @e[tag=...] 查询，函数末尾移除标签。期间实体的增减与变化不会反映到后续使用中，因此只对显式声明的函数启用
+    counts = {}
+    for command in commands:
+        for _, text in selector_uses(command):
+            counts[text] = counts.get(text, 0) + 1
+    prefix = "__sel." + key.replace(":", ".").replace("/", ".")
+    tags = {}
+    for text, count in counts.items():
+        if count > 1:
+            tags[text] = f"{prefix}.{len(tags)}"
+    if not tags:
+        return commands
+    result = []
+    tagged = set()
+    for command in commands:
+        uses = [(i, text) for i, text in selector_uses(command) if text in tags]
+        if not uses:
+            result.append(command)
+            continue
+        operands = list(command.operands)
+        for i, text in uses:
+            if text not in tagged:
+                result.append(CommandGenerator("tag", (text, "add", tags[text])))
+                tagged.add(text)
+            operands[i] = CommandGenerator(operands[i].opcode, (f"@e[tag={tags[text]}]",))
+        result.append(CommandGenerator("execute", tuple(operands)))
+    for tag in tags.values():
+        result.append(CommandGenerator("tag", (f"@e[tag={tag}]", "remove", tag)))
+    return result
@@ -1,4 +1,8 @@
 LIB_NAMESPACE = "mcclib"
 INTERNAL_PATH = ".internal/"
 ENTRANCE_FUNCTION = ".init"
-OUTPUT_PATH = "out/"
\ No newline at end of file
+OUTPUT_PATH = "out/"
+SOURCE_SUFFIX = ".mccdp"
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 25580
+OPT_LEVEL = 1
@@ -0,0 +1,532 @@
+import math
+import re
+from collections import defaultdict
+
+from datapack import Datapack
+from partial_eval import NotConstant, compare_scores, parse_range, score_operation, wrap_int
+
+MAX_COMMANDS = 65536
+INTEGER_TYPES = ("byte", "short", "int", "long")
+NUMBER = re.compile(r"([+-]?(?:\d+\.?\d*|\.\d+)(?:e[+-]?\d+)?)([bslfd]?)", re.IGNORECASE)
+PATH_KEY = re.compile(r'"((?:[^"\\]|\\.)*)"|([A-Za-z0-9_+-]+)|\[(-?\d+)\]')
+
+# 数据包的本地模型：在输出的命令文本上解释记分板、storage、execute、函数与宏、实体标签和聊天输出，
+# 只覆盖编译器会生成的命令；实体没有位置，execute at 只按匹配数分叉。用于检查优化前后的最终状态和执行的命令数
+
+
+class Reader:
+    # 逐个读取命令参数：引号、方括号和花括号内的空白不作为分隔
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+
+    def skip(self):
+        while self.pos < len(self.text) and self.text[self.pos] == " ":
+            self.pos += 1
+
+    def at_end(self) -> bool:
+        self.skip()
+        return self.pos >= len(self.text)
+
+    def token(self) -> str:
+        self.skip()
+        start = self.pos
+        depth = 0
+        quote = None
+        while self.pos < len(self.text):
+            c = self.text[self.pos]
+            if quote is not None:
+                if c == "\\":
+                    self.pos += 1
+                elif c == quote:
+                    quote = None
+            elif c == '"':
+                quote = c
+            elif c in "[{":
+                depth += 1
+            elif c in "]}":
+                depth -= 1
+            elif c == " " and depth == 0:
+                break
+            self.pos += 1
+        if start == self.pos:
+            raise ValueError(f"Missing argument in {self.text!r}")
+        return self.text[start:self.pos]
+
+    def rest(self) -> str:
+        self.skip()
+        text = self.text[self.pos:]
+        self.pos = len(self.text)
+        return text
+
+
+def parse_snbt(text: str):
+    value, pos = snbt_value(text, 0)
+    if text[pos:].strip():
+        raise ValueError(f"Unexpected {text[pos:]!r} in SNBT")
+    return value
+
+
+def skip_spaces(text: str, pos: int) -> int:
+    while pos < len(text) and text[pos] in " \n\t":
+        pos += 1
+    return pos
+
+
+def snbt_string(text: str, pos: int) -> tuple[str, int]:
+    quote = text[pos]
+    chars = []
+    pos += 1
+    while text[pos] != quote:
+        if text[pos] == "\\":
+            pos += 1
+        chars.append(text[pos])
+        pos += 1
+    return "".join(chars), pos + 1
+
+
+def snbt_value(text: str, pos: int):
+    # 数值去掉类型后缀，true/false 按字节 1/0 处理，带类型的数组视为列表
+    pos = skip_spaces(text, pos)
+    c = text[pos]
+    if c == "{":
+        compound = {}
+        pos = skip_spaces(text, pos + 1)
+        while text[pos] != "}":
+            if text[pos] in "\"'":
+                key, pos = snbt_string(text, pos)
+            else:
+                end = text.index(":", pos)
+                key, pos = text[pos:end].strip(), end
+            pos = skip_spaces(text, pos)
+            if text[pos] != ":":
+                raise ValueError(f"Expected ':' in SNBT {text!r}")
+            compound[key], pos = snbt_value(text, pos + 1)
+            pos = skip_spaces(text, pos)
+            if text[pos] == ",":
+                pos = skip_spaces(text, pos + 1)
+        return compound, pos + 1
+    if c == "[":
+        items = []
+        pos = skip_spaces(text, pos + 1)
+        if re.match(r"[BIL];", text[pos:pos + 2]):
+            pos = skip_spaces(text, pos + 2)
+        while text[pos] != "]":
+            item, pos = snbt_value(text, pos)
+            items.append(item)
+            pos = skip_spaces(text, pos)
+            if text[pos] == ",":
+                pos = skip_spaces(text, pos + 1)
+        return items, pos + 1
+    if c in "\"'":
+        return snbt_string(text, pos)
+    end = pos
+    while end < len(text) and text[end] not in ",]} \n\t":
+        end += 1
+    word = text[pos:end]
+    if word in ("true", "false"):
+        return int(word == "true"), end
+    match = NUMBER.fullmatch(word)
+    if match is None:
+        return word, end
+    number, suffix = match.groups()
+    if suffix.lower() in ("f", "d") or "." in number or "e" in number.lower():
+        return float(number), end
+    return int(number), end
+
+
+def format_snbt(value, quote_strings: bool = True) -> str:
+    if isinstance(value, dict):
+        return "{" + ",".join(f"{key}:{format_snbt(item)}" for key, item in value.items()) + "}"
+    if isinstance(value, list):
+        return "[" + ",".join(format_snbt(item) for item in value) + "]"
+    if isinstance(value, str):
+        return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"' if quote_strings else value
+    return str(value)
+
+
+def parse_path(text: str) -> list[str | int]:
+    keys = []
+    pos = 0
+    while pos < len(text):
+        match = PATH_KEY.match(text, pos)
+        if match is None:
+            raise NotImplementedError(f"Unsupported NBT path {text}")
+        quoted, plain, index = match.groups()
+        keys.append(int(index) if index is not None else quoted if quoted is not None else plain)
+        pos = match.end()
+        if pos < len(text) and text[pos] == ".":
+            pos += 1
+    return keys
+
+
+def merge_compound(target: dict, source: dict):
+    for key, value in source.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_compound(target[key], value)
+        else:
+            target[key] = value
+
+
+class Entity:
+    def __init__(self, name: str, type1: str = "minecraft:player"):
+        self.name = name
+        self.type = type1
+        self.tags: set[str] = set()
+
+
+class Simulator:
+    def __init__(self, datapack: Datapack, players: int = 1):
+        self.functions = {key: [str(command) for command in commands] for key, commands in datapack.functions.items()}
+        self.function_tags = datapack.function_tags
+        self.objectives: set[str] = set()
+        self.scores: dict[tuple[str, str], int] = {}
+        self.storage: dict[str, dict] = defaultdict(dict)
+        self.entities = [Entity(f"player{i}") for i in range(players)]
+        self.chat: list[str] = []
+        # 执行的命令数：函数中的每一行计 1，execute run 的命令在每个执行者上再计 1
+        self.executed = 0
+        self.chain = 0
+
+    def run_tag(self, tag: str):
+        # 一次 load 或一个 tick：与游戏相同，单次触发执行的命令数有上限
+        self.chain = 0
+        for value in self.function_tags.get(tag, []):
+            self.call_function(value, None)
+
+    def call_function(self, key: str, executor: Entity | None, arguments: dict | None = None):
+        if key.startswith("#"):
+            for value in self.function_tags.get(key[1:], []):
+                self.call_function(value, executor)
+            return
+        if key not in self.functions:
+            raise ValueError(f"Unknown function {key}")
+        for line in self.functions[key]:
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("$"):
+                if arguments is None:
+                    raise ValueError(f"Macro line in {key} called without arguments")
+                line = re.sub(r"\$\((\w+)\)", lambda match: format_snbt(arguments[match.group(1)], False), line[1:])
+            self.count()
+            self.command(Reader(line), executor)
+
+    def count(self):
+        self.executed += 1
+        self.chain += 1
+        if self.chain > MAX_COMMANDS:
+            raise ValueError("Command chain limit exceeded")
+
+    def command(self, reader: Reader, executor: Entity | None) -> int | None:
+        # 返回命令结果；命令失败时返回 None，与游戏一样不中断函数
+        name = reader.token()
+        if name == "scoreboard":
+            return self.scoreboard(reader, executor)
+        elif name == "data":
+            return self.data(reader)
+        elif name == "execute":
+            return self.execute(reader, executor)
+        elif name == "function":
+            key = reader.token()
+            if reader.at_end():
+                self.call_function(key, executor)
+                return None
+            if reader.token() != "with" or reader.token() != "storage":
+                raise NotImplementedError(f"Unsupported function call {reader.text}")
+            arguments = self.get_data(reader.token(), reader.token())
+            if not isinstance(arguments, dict):
+                return None
+            self.call_function(key, executor, arguments)
+            return None
+        elif name == "say":
+            self.chat.append(reader.rest())
+            return 1
+        elif name == "tellraw":
+            reader.token()
+            self.chat.append(reader.rest())
+            return 1
+        elif name == "tag":
+            entities = self.select(reader.token(), executor)
+            action, tag = reader.token(), reader.token()
+            if action not in ("add", "remove"):
+                raise NotImplementedError(f"Unsupported tag action {action}")
+            for entity in entities:
+                if action == "add":
+                    entity.tags.add(tag)
+                else:
+                    entity.tags.discard(tag)
+            return len(entities)
+        raise NotImplementedError(f"Unsupported command {name}")
+
+    def holders(self, token: str, executor: Entity | None) -> list[str]:
+        if token.startswith("@"):
+            return [entity.name for entity in self.select(token, executor)]
+        return [token]
+
+    def objective(self, name: str) -> str:
+        if name not in self.objectives:
+            raise ValueError(f"Unknown scoreboard objective {name}")
+        return name
+
+    def scoreboard(self, reader: Reader, executor: Entity | None) -> int | None:
+        group, action = reader.token(), reader.token()
+        if group == "objectives":
+            if action != "add":
+                raise NotImplementedError(f"Unsupported scoreboard objectives {action}")
+            self.objectives.add(reader.token())
+            return 0
+        if group != "players":
+            raise NotImplementedError(f"Unsupported scoreboard {group}")
+        holders = self.holders(reader.token(), executor)
+        if action == "reset":
+            objective = None if reader.at_end() else reader.token()
+            for slot in [slot for slot in self.scores if slot[0] in holders and objective in (None, slot[1])]:
+                del self.scores[slot]
+            return len(holders)
+        objective = self.objective(reader.token())
+        result = None
+        if action in ("set", "add", "remove"):
+            value = int(reader.token())
+            for holder in holders:
+                current = self.scores.get((holder, objective), 0)
+                result = self.scores[(holder, objective)] = value if action == "set" else wrap_int(current + value if action == "add" else current - value)
+        elif action == "get":
+            return self.scores.get((holders[0], objective)) if len(holders) == 1 else None
+        elif action == "operation":
+            operation = reader.token()
+            sources = self.holders(reader.token(), executor)
+            source_objective = self.objective(reader.token())
+            for holder in holders:
+                for source in sources:
+                    if (source, source_objective) not in self.scores:
+                        return None
+                    try:
+                        target, value = score_operation(operation, self.scores.get((holder, objective), 0), self.scores[(source, source_objective)])
+                    except NotConstant:
+                        return None
+                    self.scores[(holder, objective)] = target
+                    self.scores[(source, source_objective)] = value
+                    result = target
+        else:
+            raise NotImplementedError(f"Unsupported scoreboard players {action}")
+        return result
+
+    def get_data(self, storage: str, path: str):
+        value = self.storage[storage]
+        for key in parse_path(path):
+            if isinstance(key, int):
+                if not isinstance(value, list) or not -len(value) <= key < len(value):
+                    return None
+            elif not isinstance(value, dict) or key not in value:
+                return None
+            value = value[key]
+        return value
+
+    def set_data(self, storage: str, path: str, value) -> bool:
+        keys = parse_path(path)
+        parent = self.storage[storage]
+        for key in keys[:-1]:
+            if isinstance(key, int):
+                if not isinstance(parent, list) or not -len(parent) <= key < len(parent):
+                    return False
+                parent = parent[key]
+            else:
+                parent = parent.setdefault(key, {})
+                if not isinstance(parent, (dict, list)):
+                    return False
+        key = keys[-1]
+        if isinstance(key, int) != isinstance(parent, list):
+            return False
+        if isinstance(key, int) and not -len(parent) <= key < len(parent):
+            return False
+        parent[key] = value
+        return True
+
+    def data(self, reader: Reader) -> int | None:
+        action = reader.token()
+        if reader.token() != "storage":
+            raise NotImplementedError(f"Unsupported data target in {reader.text}")
+        storage = reader.token()
+        if action == "merge":
+            merge_compound(self.storage[storage], parse_snbt(reader.rest()))
+            return 1
+        path = reader.token()
+        if action == "get":
+            value = self.get_data(storage, path)
+            scale = 1 if reader.at_end() else float(reader.token())
+            return None if isinstance(value, (dict, str)) or value is None else math.floor(value * scale) if not isinstance(value, list) else len(value)
+        elif action == "remove":
+            keys = parse_path(path)
+            parent = self.get_data(storage, path[:path.rfind(".")]) if len(keys) > 1 else self.storage[storage]
+            if isinstance(parent, dict) and keys[-1] in parent:
+                del parent[keys[-1]]
+                return 1
+            return None
+        elif action != "modify":
+            raise NotImplementedError(f"Unsupported data {action}")
+        operation, source = reader.token(), reader.token()
+        if source == "value":
+            value = parse_snbt(reader.rest())
+        elif source == "from" and reader.token() == "storage":
+            value = self.get_data(reader.token(), reader.token())
+            if value is None:
+                return None
+        else:
+            raise NotImplementedError(f"Unsupported data modify source in {reader.text}")
+        if operation == "set":
+            return 1 if self.set_data(storage, path, value) else None
+        elif operation == "merge":
+            target = self.get_data(storage, path)
+            if target is None:
+                return 1 if self.set_data(storage, path, dict(value)) else None
+            if not isinstance(target, dict) or not isinstance(value, dict):
+                return None
+            merge_compound(target, value)
+            return 1
+        elif operation in ("append", "prepend"):
+            target = self.get_data(storage, path)
+            if not isinstance(target, list):
+                return None
+            target.insert(len(target) if operation == "append" else 0, value)
+            return 1
+        raise NotImplementedError(f"Unsupported data modify {operation}")
+
+    def select(self, selector: str, executor: Entity | None) -> list[Entity]:
+        match = re.fullmatch(r"@([aeprs])(?:\[(.*)])?", selector)
+        if match is None:
+            raise NotImplementedError(f"Unsupported selector {selector}")
+        kind, arguments = match.groups()
+        if kind == "s":
+            entities = [executor] if executor is not None else []
+        elif kind == "e":
+            entities = list(self.entities)
+        else:
+            entities = [entity for entity in self.entities if entity.type == "minecraft:player"]
+        limit = 1 if kind in "pr" else None
+        for argument in split_arguments(arguments or ""):
+            key, value = argument.split("=", 1)
+            key, value = key.strip(), value.strip()
+            negate = value.startswith("!")
+            value = value[1:] if negate else value
+            if key == "type":
+                value = value if ":" in value else "minecraft:" + value
+                entities = [entity for entity in entities if (entity.type == value) != negate]
+            elif key == "tag":
+                entities = [entity for entity in entities if (value in entity.tags if value else not entity.tags) != negate]
+            elif key == "name":
+                entities = [entity for entity in entities if (entity.name == value.strip('"')) != negate]
+            elif key == "scores":
+                for score in split_arguments(value[1:-1]):
+                    objective, range_text = (part.strip() for part in score.split("=", 1))
+                    low, high = parse_range(range_text)
+                    entities = [entity for entity in entities if (entity.name, objective) in self.scores and
+                                (low is None or self.scores[(entity.name, objective)] >= low) and (high is None or self.scores[(entity.name, objective)] <= high)]
+            elif key == "limit":
+                limit = int(value)
+            elif key != "sort":
+                raise NotImplementedError(f"Unsupported selector argument {key}")
+        return entities[:limit] if limit is not None else entities
+
+    def condition(self, reader: Reader, executor: Entity | None) -> bool:
+        kind = reader.token()
+        if kind == "entity":
+            return bool(self.select(reader.token(), executor))
+        if kind != "score":
+            raise NotImplementedError(f"Unsupported execute condition {kind}")
+        holders = self.holders(reader.token(), executor)
+        objective = self.objective(reader.token())
+        operation = reader.token()
+        if len(holders) != 1 or (holders[0], objective) not in self.scores:
+            if operation != "matches":
+                reader.token()
+            reader.token()
+            return False
+        value = self.scores[(holders[0], objective)]
+        if operation == "matches":
+            low, high = parse_range(reader.token())
+            return (low is None or value >= low) and (high is None or value <= high)
+        others = self.holders(reader.token(), executor)
+        other_objective = self.objective(reader.token())
+        if len(others) != 1 or (others[0], other_objective) not in self.scores:
+            return False
+        return compare_scores(value, operation, self.scores[(others[0], other_objective)])
+
+    def store(self, target: tuple, result: int | None, executor: Entity | None):
+        kind, store_type = target[:2]
+        value = 0 if result is None else (1 if store_type == "success" else result)
+        if kind == "score":
+            for holder in self.holders(target[2], executor):
+                self.scores[(holder, target[3])] = wrap_int(int(value))
+        else:
+            storage, path, data_type, scale = target[2:]
+            scaled = value * scale
+            self.set_data(storage, path, int(scaled) if data_type in INTEGER_TYPES else float(scaled))
+
+    def execute(self, reader: Reader, executor: Entity | None) -> int | None:
+        contexts = [executor]
+        stores = []
+        while not reader.at_end():
+            sub = reader.token()
+            if sub == "run":
+                text = reader.rest()
+                result = None
+                for context in contexts:
+                    self.count()
+                    result = self.command(Reader(text), context)
+                    for target in stores:
+                        self.store(target, result, context)
+                return result
+            elif sub == "as":
+                selector = reader.token()
+                contexts = [entity for context in contexts for entity in self.select(selector, context)]
+            elif sub == "at":
+                selector = reader.token()
+                contexts = [context for context in contexts for _ in self.select(selector, context)]
+            elif sub in ("if", "unless"):
+                start = reader.pos
+                passed = []
+                for context in contexts:
+                    reader.pos = start
+                    if self.condition(reader, context) == (sub == "if"):
+                        passed.append(context)
+                if not contexts:
+                    reader.pos = start
+                    self.condition(reader, executor)
+                contexts = passed
+            elif sub == "store":
+                store_type, kind = reader.token(), reader.token()
+                if kind == "score":
+                    stores.append((kind, store_type, reader.token(), self.objective(reader.token())))
+                elif kind == "storage":
+                    stores.append((kind, store_type, reader.token(), reader.token(), reader.token(), float(reader.token())))
+                else:
+                    raise NotImplementedError(f"Unsupported execute store target {kind}")
+            else:
+                raise NotImplementedError(f"Unsupported execute subcommand {sub}")
+        for context in contexts:
+            for target in stores:
+                self.store(target, 1, context)
+        return len(contexts) or None
+
+
+def split_arguments(text: str) -> list[str]:
+    # 按顶层逗号拆分选择器参数
+    arguments = []
+    depth = 0
+    quote = False
+    start = 0
+    for i, c in enumerate(text):
+        if c == '"':
+            quote = not quote
+        elif quote:
+            continue
+        elif c in "[{":
+            depth += 1
+        elif c in "]}":
+            depth -= 1
+        elif c == "," and depth == 0:
+            arguments.append(text[start:i])
+            start = i + 1
+    if text[start:].strip():
+        arguments.append(text[start:])
+    return arguments
@@ -0,0 +1,58 @@
+import warnings
+from typing import Any
+
+
+class SymbolTable:
+    # 每个名字对应一个绑定栈，栈顶即当前可见的定义，查找为 O(1)；每个作用域帧记录自己定义的名字，离开时弹出
+    def __init__(self):
+        self.bindings: dict[str, list[tuple[int, Any]]] = {}
+        self.frames: list[list[str]] = [[]]
+
+    @property
+    def depth(self):
+        return len(self.frames) - 1
+
+    def push(self):
+        self.frames.append([])
+
+    def pop(self):
+        if len(self.frames) == 1:
+            raise RuntimeError("Cannot leave the root scope")
+        for name in self.frames.pop():
+            stack = self.bindings[name]
+            stack.pop()
+            if not stack:
+                del self.bindings[name]
+
+    def define(self, name: str, value, replace: bool = False):
+        stack = self.bindings.get(name)
+        if stack:
+            depth, previous = stack[-1]
+            if depth == self.depth:
+                if not replace:
+                    raise ValueError(f"Redefinition of {name} (previously defined as {previous})")
+                stack[-1] = (depth, value)
+                return
+            warnings.warn(f"Definition of {name} shadows an outer definition ({previous})", stacklevel=2)
+            stack.append((self.depth, value))
+        else:
+            self.bindings[name] = [(self.depth, value)]
+        self.frames[-1].append(name)
+
+    def resolve(self, name: str):
+        stack = self.bindings.get(name)
+        if not stack:
+            return None
+        return stack[-1][1]
+
+    def __contains__(self, name: str):
+        return name in self.bindings
+
+    def copy(self) -> "SymbolTable":
+        symbol_table = SymbolTable()
+        symbol_table.bindings = {name: list(stack) for name, stack in self.bindings.items()}
+        symbol_table.frames = [list(frame) for frame in self.frames]
+        return symbol_table
+
+    def root_symbols(self) -> dict[str, Any]:
+        return {name: self.bindings[name][0][1] for name in self.frames[0]}
@@ -0,0 +1,166 @@
+from command_gen import CommandGenerator
+from ir import FunctionIR
+from partial_eval import PartialEvaluator, constant_slot, score_slot, wrap_int
+
+INTERMEDIATE_PREFIX = "__intermediate."
+COMMUTATIVE = ("+=", "*=", "<", ">")
+
+# 公共子表达式消除：在每个函数上做值编号。表达式的结果都放在中间量里，
+# 某个中间量第一次被使用时，如果已有另一个中间量持有相同的值，并且在它的所有使用处都不会被改写，
+# 就删去计算它的命令，把使用处改为读取已有的中间量。编号跨越基本块，结束基本块的调用只使被调函数写入的槽位失效
+
+
+def is_intermediate(slot: tuple[str, str]) -> bool:
+    return slot[0].startswith(INTERMEDIATE_PREFIX) and slot[1].endswith(".__global")
+
+
+def mentioned_intermediates(command) -> set[tuple[str, str]]:
+    if not isinstance(command, CommandGenerator):
+        return set()
+    operands = command.operands
+    slots = set()
+    for i, operand in enumerate(operands):
+        if isinstance(operand, CommandGenerator):
+            slots |= mentioned_intermediates(operand)
+        elif isinstance(operand, str) and operand.startswith(INTERMEDIATE_PREFIX) and i + 1 < len(operands):
+            slot = score_slot(operands, i)
+            if is_intermediate(slot):
+                slots.add(slot)
+    return slots
+
+
+def defined_slot(command) -> tuple[str, str] | None:
+    # 只写入目标槽位、可以整条删除的记分板命令，返回其目标
+    if not isinstance(command, CommandGenerator):
+        return None
+    opcode, operands = command.opcode, command.operands
+    if opcode in ("scoreboard players set", "scoreboard players add", "scoreboard players remove"):
+        return score_slot(operands)
+    if opcode == "scoreboard players operation" and operands[2] != "><" and score_slot(operands) != score_slot(operands, 3):
+        return score_slot(operands)
+    return None
+
+
+def rename(command, names: dict[str, str]):
+    if isinstance(command, CommandGenerator):
+        operands = tuple(rename(operand, names) for operand in command.operands)
+        if all(new is old for new, old in zip(operands, command.operands)):
+            return command
+        return CommandGenerator(command.opcode, operands)
+    if isinstance(command, str):
+        return names.get(command, command)
+    return command
+
+
+class ValueNumbering:
+    # 槽位的值用编号表示；读到未知值的槽位时分配一个新的编号，槽位被改写后旧编号作废
+    def __init__(self, evaluator: PartialEvaluator):
+        self.evaluator = evaluator
+        self.numbers: dict[tuple, int] = {}
+        self.values: dict[tuple[str, str], int] = {}
+
+    def number(self, expression: tuple) -> int:
+        return self.numbers.setdefault(expression, len(self.numbers))
+
+    def constant(self, value: int) -> int:
+        return self.number(("const", wrap_int(value)))
+
+    def value(self, slot: tuple[str, str]) -> int:
+        if constant_slot(slot) is not None:
+            return self.constant(constant_slot(slot))
+        if slot not in self.values:
+            self.values[slot] = self.number(("unknown", slot, len(self.numbers)))
+        return self.values[slot]
+
+    def combine(self, operation: str, a: int, b: int) -> int:
+        if operation in COMMUTATIVE:
+            a, b = min(a, b), max(a, b)
+        return self.number((operation, a, b))
+
+    def apply(self, command):
+        if isinstance(command, str) and command.startswith("#"):
+            return
+        opcode, operands = (command.opcode, command.operands) if isinstance(command, CommandGenerator) else (None, ())
+        if opcode == "scoreboard players set":
+            self.values[score_slot(operands)] = self.constant(int(operands[2]))
+        elif opcode in ("scoreboard players add", "scoreboard players remove"):
+            slot = score_slot(operands)
+            delta = int(operands[2]) if opcode.endswith("add") else -int(operands[2])
+            self.values[slot] = self.combine("+=", self.value(slot), self.constant(delta))
+        elif opcode == "scoreboard players operation":
+            target, source, operation = score_slot(operands), score_slot(operands, 3), operands[2]
+            if operation == "=":
+                self.values[target] = self.value(source)
+            elif operation == "><":
+                self.values[target], self.values[source] = self.value(source), self.value(target)
+            elif operation == "-=" and constant_slot(source) is not None:
+                self.values[target] = self.combine("+=", self.value(target), self.constant(-constant_slot(source)))
+            else:
+                self.values[target] = self.combine(operation, self.value(target), self.value(source))
+        else:
+            writes = self.evaluator.writes(command)
+            if writes is None:
+                self.values.clear()
+            else:
+                for slot in writes:
+                    self.values.pop(slot, None)
+
+
+def eliminate_common_subexpressions(functions: dict[str, FunctionIR]) -> dict[str, FunctionIR]:
+    # 被多个函数引用的中间量（例如在子函数中读取）不参与消除
+    commands = {key: function.commands() for key, function in functions.items()}
+    evaluator = PartialEvaluator(commands)
+    owners: dict[tuple[str, str], set[str]] = {}
+    for key, function_commands in commands.items():
+        for command in function_commands:
+            for slot in mentioned_intermediates(command):
+                owners.setdefault(slot, set()).add(key)
+    shared = {slot for slot, keys in owners.items() if len(keys) > 1}
+    result = {}
+    for key, function in functions.items():
+        eliminated = eliminate(commands[key], evaluator, shared)
+        result[key] = function if eliminated is commands[key] else FunctionIR.from_commands(key, eliminated)
+    return result
+
+
+def eliminate(commands: list, evaluator: PartialEvaluator, shared: set[tuple[str, str]]) -> list:
+    definitions: dict[tuple[str, str], list[int]] = {}
+    uses: dict[tuple[str, str], list[int]] = {}
+    for i, command in enumerate(commands):
+        for slot in mentioned_intermediates(command):
+            (definitions if defined_slot(command) == slot else uses).setdefault(slot, []).append(i)
+    first_uses: dict[int, list[tuple[str, str]]] = {}
+    for slot, indices in uses.items():
+        first_uses.setdefault(indices[0], []).append(slot)
+
+    def reusable(slot: tuple[str, str], holder: tuple[str, str], first: int) -> bool:
+        if slot in shared or any(i > first for i in definitions.get(slot, [])):
+            return False
+        for i in uses[slot]:
+            writes = evaluator.writes(commands[i])
+            if writes is None or slot in writes:
+                return False
+        for i in range(first, uses[slot][-1] + 1):
+            writes = evaluator.writes(commands[i])
+            if writes is None or holder in writes:
+                return False
+        return True
+
+    numbering = ValueNumbering(evaluator)
+    available: dict[int, tuple[str, str]] = {}
+    removed = set()
+    names: dict[int, dict[str, str]] = {}
+    for i, command in enumerate(commands):
+        for slot in first_uses.get(i, []):
+            value = numbering.value(slot)
+            holder = available.get(value)
+            if holder is not None and numbering.values.get(holder) == value and reusable(slot, holder, i):
+                removed.update(definitions.get(slot, []))
+                for use in uses[slot]:
+                    names.setdefault(use, {})[slot[0]] = holder[0]
+            else:
+                available[value] = slot
+        numbering.apply(command)
+    if not removed and not names:
+        return commands
+    return [rename(command, names[i]) if i in names else command for i, command in enumerate(commands) if i not in removed]